@@ -0,0 +1,81 @@
+r"""
+Micro-benchmarks for the packer.
+
+Run from the src directory:
+
+    python -m benchmarks.packer [--repeat N]
+
+Every case is packed and unpacked with fixed inputs; the best of all repetitions is reported, so results of
+different runs (and revisions) can be compared directly.
+"""
+import argparse
+import random
+import timeit
+
+from common.packer import pack, pack_segments, unpack
+
+
+def _control_message() -> dict:
+    # an acknowledgement as it is sent over the wire
+    return dict(
+        topic="client",
+        command="ack",
+        params={},
+        meta=dict(
+            ack_manager=dict(for_message_id=4711),
+            r_broadcast=dict(sender=["localhost", 50000], message_id=[1700000000, 123456], to=[["localhost", 51000]]),
+            sendreceive=dict(origin=["localhost", 50000]),
+        ),
+    )
+
+
+def _metadata_tree(depth: int = 6, width: int = 4) -> dict:
+    # nested dicts with all scalar types
+    if depth == 0:
+        return dict(name="leaf", size=1234567, ratio=0.5, flag=True, missing=None, negative=-42)
+    return {f"node{i}": _metadata_tree(depth - 1, width) for i in range(width)}
+
+
+def _file_message(size: int) -> dict:
+    message = _control_message()
+    message["topic"] = "file"
+    message["command"] = "modify"
+    message["params"] = dict(is_directory=False, src_path="watched/data/blob.bin",
+                             content=random.Random(0).randbytes(size))
+    return message
+
+
+CASES = {
+    "control message": (_control_message(), 20000),
+    "metadata tree": (_metadata_tree(), 20),
+    "file 1 MiB": (_file_message(1 << 20), 200),
+    "file 64 MiB": (_file_message(64 << 20), 5),
+}
+
+
+def _best(statement, number: int, repeat: int) -> float:
+    return min(timeit.repeat(statement, number=number, repeat=repeat)) / number
+
+
+def run(repeat: int) -> None:
+    print(f"{'case':<18}{'bytes':>12}{'pack':>14}{'segments':>14}{'unpack':>14}{'unpack (views)':>16}")
+    for name, (obj, number) in CASES.items():
+        blob = pack(obj)
+        results = [
+            _best(lambda: pack(obj), number, repeat),
+            _best(lambda: pack_segments(obj), number, repeat),
+            _best(lambda: unpack(blob), number, repeat),
+            _best(lambda: unpack(blob, zero_copy=True), number, repeat),
+        ]
+        print(f"{name:<18}{len(blob):>12}" + "".join(f"{result * 1e6:>12.1f}us" for result in results[:3])
+              + f"{results[3] * 1e6:>14.1f}us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Packer micro-benchmarks")
+    parser.add_argument("--repeat", type=int, default=5, help="number of repetitions per case")
+    run(parser.parse_args().repeat)
+
+
+if __name__ == '__main__':
+    main()
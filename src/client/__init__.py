@@ -1,4 +1,6 @@
+import asyncio
 import logging
+import os
 from pathlib import Path
 
 from common.communication.ack_manager import AckManager
@@ -20,10 +22,16 @@ class BaseClient:
     # ready for it
     outgoing_message_queue: list[Message]
 
-    def __init__(self):
+    def __init__(self, address: Address = ("localhost", 51000)):
         self.state = ClientState.STARTED
         self.outgoing_message_queue = []
-        self.comm = AckManager(self.route, ("localhost", 51000))  # TODO don't hardcode address
+        self.comm = AckManager(self.route, address)
+        self.comm.ack_callback = self._handle_ack
+
+        # ordering keys (see _ordering_keys) of the sent messages that have not been acknowledged yet, by message ID
+        self._in_flight: dict[int, set[str] | None] = {}
+        # queued messages that are only sent to some of the servers (see _send_first), the others to all servers
+        self._recipients: dict[Message, set[Address]] = {}
 
         logging.info("Client started")
 
@@ -38,14 +46,84 @@ class BaseClient:
 
     def run(self):
         self.comm.run()
+        self._send_queued()
 
-        # send messages that are in the queue
-        if not self.comm.is_awaiting_ack():
-            try:
-                msg = self.outgoing_message_queue.pop(0)
-                self.comm.r_broadcast(self.servers, msg, expect_ack=True)
-            except IndexError:
-                pass
+    def run_forever(self):
+        """
+        Handle incoming messages and send queued messages as soon as possible, until an error occurs
+        :return:
+        """
+        self.comm.run_forever()
+
+    def _ordering_keys(self, message: Message) -> set[str] | None:
+        """
+        Messages with overlapping ordering keys are processed in the order in which they were queued,
+        messages without keys are processed after all previous and before all following messages.
+        :param message:
+        :return: ordering keys, None if the message must not overlap with any other message
+        """
+        return None
+
+    def _prepare(self, message: Message) -> None:
+        """
+        Called right before a queued message is sent for the first time, e.g. to read data that should not be held in
+        memory while the message is queued
+        :param message:
+        :return:
+        """
+        pass
+
+    @staticmethod
+    def _keys_overlap(keys: set[str], other_keys: set[str]) -> bool:
+        # keys are paths, a path also overlaps with everything inside it
+        for key in keys:
+            for other in other_keys:
+                if key == other or other.startswith(key + os.sep) or key.startswith(other + os.sep):
+                    return True
+        return False
+
+    def _send_queued(self):
+        """
+        Send queued messages as long as the window of unacknowledged messages allows it.
+        A message is held back while an earlier message with overlapping ordering keys is unacknowledged or queued.
+        :return:
+        """
+        if None in self._in_flight.values():
+            return
+
+        # ordering keys of the messages that were skipped in this pass
+        held_back: list[set[str]] = []
+        i = 0
+        while i < len(self.outgoing_message_queue) and self.comm.credit() > 0:
+            message = self.outgoing_message_queue[i]
+            keys = self._ordering_keys(message)
+
+            if keys is None:
+                if self._in_flight or held_back:
+                    return
+            elif any(self._keys_overlap(keys, other) for other in [*self._in_flight.values(), *held_back]):
+                held_back.append(keys)
+                i += 1
+                continue
+
+            self.outgoing_message_queue.pop(i)
+            to = self.servers
+            recipients = self._recipients.pop(message, None)
+            if recipients is not None:
+                to = [server for server in self.servers if server in recipients]
+                if not to:
+                    logging.info(f"Dropping {message.topic.name}.{message.command.name}, its servers have left")
+                    continue
+            self._prepare(message)
+            message_id = self.comm.r_broadcast(to, message, expect_ack=True)
+            self._in_flight[message_id] = keys
+
+            if keys is None:
+                return
+
+    def _handle_ack(self, message_id: int):
+        self._in_flight.pop(message_id, None)
+        self._send_queued()
 
     def route(self, message: Message):
         match message.topic:
@@ -59,6 +137,20 @@ class BaseClient:
 
     def send(self, message: Message):
         self.outgoing_message_queue.append(message)
+        # messages are also queued by the file watcher threads, so wake up the event loop in a thread-safe way
+        self.comm.loop.call_soon_threadsafe(self._send_queued)
+
+    def _send_first(self, messages: list[Message], to: set[Address] | None = None):
+        """
+        Queue messages before all other queued messages, e.g. to repair a request that is still in flight
+        :param messages:
+        :param to: the servers to send the messages to, None for all servers
+        :return:
+        """
+        if to is not None:
+            for message in messages:
+                self._recipients[message] = set(to)
+        self.outgoing_message_queue[:0] = messages
 
     def connect(self, server: Address) -> None:
         if self.state != ClientState.STARTED:
@@ -123,6 +215,8 @@ class ActiveReplClient(BaseClient):
                         return self.handle_message_client_set_servers(message)
                     case Command.ADD_SERVER:
                         return self.handle_message_client_add_server(message)
+                    case Command.REMOVE_SERVER:
+                        return self.handle_message_client_remove_server(message)
         super().route(message)
 
     def handle_message_client_set_servers(self, message: Message):
@@ -133,9 +227,22 @@ class ActiveReplClient(BaseClient):
 
     def handle_message_client_add_server(self, message: Message):
         new_server = tuple(message.params["server"])
+        # servers that were available before are announced again when they recover from a failure
+        if new_server in self.servers:
+            return
         logging.info(f"`New server: {new_server}")
         self.servers.append(new_server)
 
+    def handle_message_client_remove_server(self, message: Message):
+        server = tuple(message.params["server"])
+        # every remaining server reports the failure
+        if server not in self.servers:
+            return
+        logging.info(f"Server {server} has failed, removing it")
+        self.servers.remove(server)
+        # requests that were only meant for this server would never be acknowledged
+        self.comm.give_up(server)
+
 
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler, EVENT_TYPE_CREATED, EVENT_TYPE_DELETED, \
@@ -143,15 +250,49 @@ from watchdog.events import FileSystemEventHandler, EVENT_TYPE_CREATED, EVENT_TY
 
 from os import path
 
+import hashlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from client.coalescer import EventCoalescer
+from common import compression
+from common.delta import Signature, delta, file_delta
+
 
 class FolderEventHandler(FileSystemEventHandler):
     # absolute path to the watched folder on the local disk
     folder: Path
 
-    def __init__(self, folder: Path, sender):
+    def __init__(self, folder: Path, sender, loop: asyncio.AbstractEventLoop,
+                 compress: Callable[[dict], dict] | None = None):
         super().__init__()
         self.folder = folder
         self.send_file_message = sender
+        # compresses the content or delta in the params of a file message
+        self.compress = compress
+        self.loop = loop
+        # events are merged before they are sent, e.g. an editor saving a file only causes one upload
+        self.coalescer = EventCoalescer(self._send_change, loop)
+
+        # files are read, and signatures and deltas computed, in a thread of their own instead of the event loop
+        # (see run_in_order), the signatures are only used in this thread
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"read-{folder.name}")
+        # functions running in the thread and the callbacks their results are passed to, in the order they were run
+        self._running: deque[tuple[asyncio.Future, Callable]] = deque()
+
+        # block signatures of the file versions that were sent last, by local path, modifications of these files are
+        # sent as deltas
+        self.signatures: dict[str, Signature] = {}
+        # files smaller than this are always sent in full
+        self.min_delta_size = 64 * 1024
+        # a delta is only sent if it contains at most this fraction of the file as new data
+        self.max_delta_ratio = 0.5
+        # larger files are never read into memory at once, they are uploaded in chunks (see FileServiceClient.upload)
+        self.max_content_size = 4 * 1024 * 1024
+        # files of at least this size that are not sent as delta are uploaded, too, the servers then check whether they
+        # have the content already
+        self.min_upload_size = 64 * 1024
 
     def _get_relative(self, file_path: Path) -> str:
         return path.join(
@@ -160,7 +301,7 @@ class FolderEventHandler(FileSystemEventHandler):
         )
 
     def on_any_event(self, event):
-        """Handle all relevant file system events by sending message to the server
+        """Handle all relevant file system events by passing them on to the coalescer
 
         :param event:
             The event object representing the file system event.
@@ -183,38 +324,231 @@ class FolderEventHandler(FileSystemEventHandler):
         except KeyError:
             raise NotImplementedError(f"Unknown event type '{event.event_type}'")
 
-        src_path = self._get_relative(event.src_path)
+        logging.debug(f"Registered event '{event.event_type}' at path '{event.src_path}'")
+
+        dest_path = event.dest_path if event.event_type == EVENT_TYPE_MOVED else None
+        self.coalescer.add(command, event.is_directory, event.src_path, dest_path)
+
+    def run_in_order(self, function: Callable, callback: Callable, *args):
+        """
+        Run a function that reads files or uses the signatures in the thread of the handler, and pass its result to a
+        callback in the event loop. Results are passed on in the order in which the functions were run, results that
+        are None are dropped.
+        :param function:
+        :param callback:
+        :param args: arguments of the function
+        :return:
+        """
+        future = self.loop.run_in_executor(self._executor, function, *args)
+        self._running.append((future, callback))
+        future.add_done_callback(self._pass_on_results)
+
+    def _pass_on_results(self, _future: asyncio.Future):
+        while self._running and self._running[0][0].done():
+            future, callback = self._running.popleft()
+            result = future.result()
+            if result is not None:
+                callback(result)
+
+    def _send_change(self, command: Command, is_directory: bool, src_path: str, dest_path: str | None):
+        """
+        Send a merged change to the server, once its file has been read
+        """
+        self.run_in_order(self._read_change, lambda change: self.send_file_message(*change),
+                          command, is_directory, src_path, dest_path)
 
+    def _read_change(self, command: Command, is_directory: bool, src_path: str,
+                     dest_path: str | None) -> tuple[Command, dict] | None:
+        """
+        Runs in the thread of the handler
+        :return: command and params of the file message, None if there is nothing to send
+        """
         params = dict(
-            is_directory=event.is_directory,
-            src_path=src_path
+            is_directory=is_directory,
+            src_path=self._get_relative(src_path)
         )
 
         # if the file was moved, inlcude the new path
-        if event.event_type == EVENT_TYPE_MOVED:
-            params["dest_path"] = self._get_relative(event.dest_path)
+        if command == Command.MOVED:
+            params["dest_path"] = self._get_relative(dest_path)
+            self._move_signatures(src_path, dest_path)
+        elif command == Command.DELETED:
+            self._move_signatures(src_path, None)
+
+        # a file that replaced a file known to the server (e.g. saved through a temporary file) is a modification
+        if command == Command.CREATED and src_path in self.signatures:
+            command = Command.MODIFIED
 
-        logging.info(f"Registered event '{event.event_type}' at path '{event.src_path}'")
+        logging.info(f"Sending change '{command.value}' at path '{src_path}'")
 
         # if the file was modified, include the new content
-        filepath = Path(event.src_path)
-        if event.event_type in {EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED} and not event.is_directory:
-            try:
-                params["content"] = filepath.read_bytes()
-            except FileNotFoundError:
-                logging.warning(f"FileNotFoundError while attempting to read '{event.src_path}'. "
-                                f"Was the file deleted too quickly?")
-                return
+        if command in {Command.CREATED, Command.MODIFIED} and not is_directory:
+            content_params = self.content_params(src_path, allow_delta=command == Command.MODIFIED)
+            if content_params is None:
+                return None
+            params.update(content_params)
+            if self.compress is not None:
+                params = self.compress(params)
 
-        self.send_file_message(command, params)
+        return command, params
+
+    def content_params(self, local_path: str, allow_delta: bool = True) -> dict | None:
+        """
+        Read a file to send its content, or only the changes since the version that was sent last.
+        Only call this in the thread of the handler (see run_in_order).
+        :param local_path:
+        :param allow_delta: False to send the whole content
+        :return: params with either the content, a delta or an upload (which FileServiceClient sends in chunks), None if
+            the file does not exist anymore
+        """
+        try:
+            if os.path.getsize(local_path) > self.max_content_size:
+                return self._large_content_params(local_path, allow_delta)
+            content = Path(local_path).read_bytes()
+        except FileNotFoundError:
+            logging.warning(f"FileNotFoundError while attempting to read '{local_path}'. "
+                            f"Was the file deleted too quickly?")
+            return None
+
+        signature = Signature.of(content)
+        previous = self.signatures.get(local_path)
+        self.signatures[local_path] = signature
+
+        if allow_delta and previous is not None and len(content) >= self.min_delta_size:
+            ops, literal_bytes = delta(previous, content)
+            if literal_bytes <= len(content) * self.max_delta_ratio:
+                logging.info(f"Sending {literal_bytes} of {len(content)} bytes of '{local_path}' as delta")
+                return dict(delta=dict(
+                    base=previous.digest,
+                    digest=signature.digest,
+                    block_size=previous.block_size,
+                    length=len(content),
+                    ops=ops
+                ))
+
+        if len(content) >= self.min_upload_size:
+            return dict(upload=dict(local_path=local_path, length=len(content), digest=signature.digest))
+        return dict(content=content)
+
+    def _large_content_params(self, local_path: str, allow_delta: bool) -> dict:
+        """
+        Like content_params(), but the file is only read block by block
+        """
+        previous = self.signatures.get(local_path)
+        if allow_delta and previous is not None:
+            max_literal = min(self.max_content_size, int(previous.length * self.max_delta_ratio))
+            ops, signature = file_delta(previous, Path(local_path), max_literal)
+        else:
+            ops, signature = None, Signature.of_file(Path(local_path))
+        self.signatures[local_path] = signature
+
+        if ops is not None:
+            logging.info(f"Sending {sum(len(op) for op in ops if not isinstance(op, list))} of {signature.length} "
+                         f"bytes of '{local_path}' as delta")
+            return dict(delta=dict(
+                base=previous.digest,
+                digest=signature.digest,
+                block_size=previous.block_size,
+                length=signature.length,
+                ops=ops
+            ))
+
+        return dict(upload=dict(local_path=local_path, length=signature.length, digest=signature.digest))
+
+    def _move_signatures(self, src_path: str, dest_path: str | None):
+        """
+        Keep the signatures in line with moved or deleted (dest_path None) files and directories
+        """
+        prefix = src_path + os.sep
+        for local_path in [p for p in self.signatures if p == src_path or p.startswith(prefix)]:
+            signature = self.signatures.pop(local_path)
+            if dest_path is not None:
+                self.signatures[dest_path + local_path[len(src_path):]] = signature
+
+
+class _Upload:
+    """
+    A file that is uploaded in chunks
+    """
+    __slots__ = ("local_path", "command", "src_path", "length", "digest", "codec", "to", "offset")
+
+    def __init__(self, local_path: str, command: Command, src_path: str, length: int, digest: bytes,
+                 codec: compression.Codec | None, to: set[Address] | None):
+        self.local_path = local_path
+        # CREATED or MODIFIED
+        self.command = command
+        self.src_path = src_path
+        self.length = length
+        # hash of the content, the servers only commit the upload if the chunks they received match it
+        self.digest = digest
+        # codec the chunks are compressed with, None if the content does not compress
+        self.codec = codec
+        # the servers the file is uploaded to, None for all servers
+        self.to = to
+        # offset the chunks sent to all of these servers start at, None until the first of them replied
+        self.offset: int | None = None
 
 
 class FileServiceClient(ActiveReplClient):
     observers: set[Observer]
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, address: Address = ("localhost", 51000)):
+        super().__init__(address)
         self.observers = set()
+        # handlers of the watched folders, by folder name
+        self.handlers: dict[str, FolderEventHandler] = {}
+
+        # size of the chunks large files are uploaded in
+        self.chunk_size = 1024 * 1024
+        # uploads whose commit was not sent yet, by upload ID
+        self._uploads: dict[str, _Upload] = {}
+        # recent uploads the first server had the content of already, in case another server replies that it has not
+        self._stored_uploads: OrderedDict[str, _Upload] = OrderedDict()
+        self.max_stored_uploads = 1024
+
+        # codec file contents are compressed with, "auto" to choose one per file, or "none"
+        self.compression = "auto"
+        # codecs the servers support, nothing is compressed until they are known
+        self.codecs: set[str] = set()
+
+        self.comm.late_reply_callback = self._handle_late_reply
+
+    def route(self, message: Message):
+        match message.topic:
+            case Topic.CLIENT:
+                match message.command:
+                    case Command.DELTA_REJECTED:
+                        return self.handle_message_client_delta_rejected(message)
+                    case Command.UPLOAD_STATUS:
+                        return self.handle_message_client_upload_status(message)
+                    case Command.UPLOAD_REJECTED:
+                        return self.handle_message_client_upload_rejected(message)
+                    case Command.CONTENT_REJECTED:
+                        return self.handle_message_client_content_rejected(message)
+        super().route(message)
+
+    def _handle_late_reply(self, message: Message):
+        """
+        A server replied to a request after another server had answered it already. Only the replies that concern the
+        server itself are handled, e.g. it could not apply a delta the others did apply
+        :param message:
+        :return:
+        """
+        if message.topic == Topic.CLIENT and message.command in (Command.DELTA_REJECTED, Command.UPLOAD_STATUS,
+                                                                  Command.UPLOAD_REJECTED, Command.CONTENT_REJECTED):
+            self.route(message)
+            # no request was completed, which would send the queued messages
+            self._send_queued()
+
+    def handle_message_client_set_servers(self, message: Message):
+        super().handle_message_client_set_servers(message)
+        self.codecs = set(message.params["codecs"])
+
+    def handle_message_client_add_server(self, message: Message):
+        super().handle_message_client_add_server(message)
+        # a server that joins the group may not support all codecs of the others
+        # (a new set, the codecs are also read by the threads of the handlers)
+        self.codecs = self.codecs & set(message.params["codecs"])
 
     def add_watched_folder(self, folder: Path):
         """
@@ -227,7 +561,8 @@ class FileServiceClient(ActiveReplClient):
             raise FileNotFoundError(f"{folder} is not a directory")
 
         observer = Observer()
-        handler = FolderEventHandler(folder, self.send_file_message)
+        handler = FolderEventHandler(folder, self.send_file_message, self.comm.loop, self._compress)
+        self.handlers[folder.name] = handler
         self.observers.add(observer)
         observer.schedule(handler, folder, recursive=True)
         observer.start()
@@ -235,10 +570,266 @@ class FileServiceClient(ActiveReplClient):
         logging.info(f"Watcher started for '{folder}'")
         self.send_file_message(Command.WATCHED, dict(path=folder.name))
 
+    def _ordering_keys(self, message: Message) -> set[str] | None:
+        if message.topic != Topic.FILE:
+            return super()._ordering_keys(message)
+
+        match message.command:
+            case Command.UPLOAD_CHUNK:
+                # the chunks of an upload are written to a staging file, so they are sent without waiting for each
+                # other, and its commit waits for all of them
+                return set()
+            case Command.UPLOAD_COMMIT:
+                return None
+
+        params = message.params
+        keys = {params[key] for key in ("path", "src_path", "dest_path") if key in params}
+        return keys or None
+
     def send_file_message(self, command: Command, params: dict):
+        upload = params.pop("upload", None)
+        if upload is not None:
+            return self.upload(command, params["src_path"], **upload)
+
         message = Message(
             topic=Topic.FILE,
             command=command,
             params=params
         )
         self.send(message)
+
+    def _compress(self, params: dict) -> dict:
+        """
+        Compress the content or the new data of a delta in the params of a file message, the servers pass it on
+        in compressed form. Runs in the threads of the handlers.
+        :param params:
+        :return: params
+        """
+        if "content" in params:
+            content = params["content"]
+            codec = compression.choose_codec(compression.samples(content), self.codecs, self.compression)
+            if codec is not None:
+                compressed = codec.compress(content)
+                if len(compressed) < len(content):
+                    logging.debug(f"Compressed content of '{params['src_path']}' from {len(content)} to "
+                                  f"{len(compressed)} bytes ({codec.name})")
+                    params.update(content=compressed, encoding=codec.name, length=len(content))
+        elif "delta" in params:
+            delta = params["delta"]
+            literals = [op for op in delta["ops"] if not isinstance(op, list)]
+            samples = [sample for literal in literals for sample in compression.samples(literal)]
+            codec = compression.choose_codec(samples, self.codecs, self.compression)
+            if codec is not None:
+                delta["ops"] = [op if isinstance(op, list) else codec.compress(op) for op in delta["ops"]]
+                delta.update(encoding=codec.name, lengths=[len(literal) for literal in literals])
+        return params
+
+    def upload(self, command: Command, src_path: str, local_path: str, length: int, digest: bytes,
+               to: set[Address] | None = None, first: bool = False, compress: bool = True):
+        """
+        Upload a file in chunks, which are read right before they are sent, so only the chunks in flight are held in
+        memory.
+        The upload starts with the hash of the content: if the servers have the content already (e.g. the file is a
+        copy, or was deleted and created again), they create the file from it and no chunks are sent.
+        Otherwise, they write the chunks to a staging file and replace the file with it when the upload is committed.
+        An upload is identified by the path and content of the file, so if the same version is uploaded again after
+        an interruption, the servers report how much of it they already have and only the rest is sent.
+        :param command: CREATED or MODIFIED
+        :param src_path: path of the file on the server
+        :param local_path:
+        :param length:
+        :param digest: hash of the content
+        :param to: the servers to upload to, None for all servers
+        :param first: send the upload before all queued messages
+        :param compress: False to send the chunks uncompressed
+        :return:
+        """
+        upload_id = hashlib.blake2b(src_path.encode() + b"\0" + digest, digest_size=16).hexdigest()
+        try:
+            codec = compression.choose_codec(compression.file_samples(Path(local_path), length), self.codecs,
+                                             self.compression) if compress else None
+        except FileNotFoundError:
+            # the servers reject the upload, and the file's deletion follows anyway
+            codec = None
+        self._uploads[upload_id] = _Upload(local_path, command, src_path, length, digest, codec, to)
+
+        message = Message(
+            topic=Topic.FILE,
+            command=Command.UPLOAD_START,
+            params=dict(upload=upload_id, command=command.value, src_path=src_path, length=length, digest=digest)
+        )
+        if first:
+            self._send_first([message], to)
+        else:
+            self.send(message)
+
+    def handle_message_client_upload_status(self, message: Message):
+        """
+        A server is ready to receive the chunks of an upload, starting at the given offset, or has created the file
+        from a content it had already.
+        The chunks are sent to all servers from the offset of the first reply, a server that replies later with a lower
+        offset (e.g. it was restarted during an interrupted upload) is sent the chunks it misses on top. If the first
+        server had the content already, a server that replies later without it is sent the whole upload, and the other
+        way round, a server that has the content is left out of the chunks not sent yet
+        :param message:
+        :return:
+        """
+        upload_id = message.params["upload"]
+        upload = self._uploads.get(upload_id)
+        stored = upload is None
+        if stored:
+            upload = self._stored_uploads.get(upload_id)
+        if upload is None:
+            return
+
+        offset = message.params["offset"]
+        if upload.offset is not None:
+            if message.params["complete"]:
+                if not stored:
+                    # the server created the file from the content it had, the chunks not sent yet are not needed there
+                    for queued in self.outgoing_message_queue:
+                        if queued.topic == Topic.FILE and queued.params.get("upload") == upload_id:
+                            self._recipients[queued] = self._recipients.get(queued, set(self.servers)) - \
+                                                       {message.get_origin()}
+                return
+            if stored:
+                logging.info(f"Server {message.get_origin()} does not have the content of '{upload.local_path}', "
+                             f"uploading it")
+                messages = self._chunks(upload_id, offset, upload.length)
+                messages.append(self._commit(upload_id, upload))
+                self._send_first(messages, {message.get_origin()})
+            elif offset < upload.offset:
+                logging.info(f"Server {message.get_origin()} has only {offset} bytes of '{upload.local_path}', "
+                             f"sending it the missing {upload.offset - offset} bytes")
+                self._send_first(self._chunks(upload_id, offset, upload.offset), {message.get_origin()})
+            return
+        upload.offset = offset
+
+        if message.params["complete"]:
+            del self._uploads[upload_id]
+            self._stored_uploads[upload_id] = upload
+            while len(self._stored_uploads) > self.max_stored_uploads:
+                self._stored_uploads.popitem(last=False)
+            logging.info(f"Servers have the content of '{upload.local_path}' already, nothing to upload")
+            return
+
+        if offset:
+            logging.info(f"Resuming upload of '{upload.local_path}' at {offset} of {upload.length} bytes")
+
+        messages = self._chunks(upload_id, offset, upload.length)
+        messages.append(self._commit(upload_id, upload))
+        # the start of the upload kept later changes of the file back, so its chunks are sent before them
+        self._send_first(messages, upload.to)
+
+    def _chunks(self, upload_id: str, start: int, end: int) -> list[Message]:
+        """
+        :return: messages for the chunks of an upload between two offsets, their data is only read when they are sent
+        (see _prepare)
+        """
+        return [Message(topic=Topic.FILE, command=Command.UPLOAD_CHUNK, params=dict(upload=upload_id, offset=offset))
+                for offset in range(start, end, self.chunk_size)]
+
+    @staticmethod
+    def _commit(upload_id: str, upload: _Upload) -> Message:
+        return Message(topic=Topic.FILE, command=Command.UPLOAD_COMMIT, params=dict(
+            upload=upload_id,
+            command=upload.command.value,
+            src_path=upload.src_path,
+            length=upload.length,
+            digest=upload.digest
+        ))
+
+    def _prepare(self, message: Message) -> None:
+        if message.topic != Topic.FILE:
+            return
+
+        match message.command:
+            case Command.UPLOAD_CHUNK:
+                upload = self._uploads.get(message.params["upload"]) or self._stored_uploads[message.params["upload"]]
+                offset = message.params["offset"]
+                try:
+                    with open(upload.local_path, "rb") as file:
+                        file.seek(offset)
+                        data = file.read(min(self.chunk_size, upload.length - offset))
+                except FileNotFoundError:
+                    # the servers reject the commit, and the file's deletion follows anyway
+                    data = b""
+                message.params["data"] = data
+
+                if upload.codec is not None and data:
+                    compressed = upload.codec.compress(data)
+                    # parts of a file may not compress even if the samples did
+                    if len(compressed) < len(data):
+                        message.params.update(data=compressed, encoding=upload.codec.name, length=len(data))
+            case Command.UPLOAD_COMMIT:
+                self._uploads.pop(message.params["upload"], None)
+
+    def handle_message_client_delta_rejected(self, message: Message):
+        """
+        The server does not have the version of a file a delta was computed for, send the whole file instead
+        :param message:
+        :return:
+        """
+        logging.warning(f"Server {message.get_origin()} rejected the delta for '{message.params['src_path']}', "
+                        f"sending it the whole file")
+        self._resend(message.params["src_path"], message.get_origin())
+
+    def handle_message_client_upload_rejected(self, message: Message):
+        """
+        The chunks a server received don't add up to the file, e.g. because it was changed during the upload, upload
+        it again
+        :param message:
+        :return:
+        """
+        logging.warning(f"Server {message.get_origin()} rejected the upload of '{message.params['src_path']}', "
+                        f"sending it the whole file again")
+        self._resend(message.params["src_path"], message.get_origin())
+
+    def handle_message_client_content_rejected(self, message: Message):
+        """
+        A server could not decompress the content of a file, e.g. because it joined the group after the client chose
+        the codec, send it again uncompressed
+        :param message:
+        :return:
+        """
+        logging.warning(f"Server {message.get_origin()} rejected the content of '{message.params['src_path']}', "
+                        f"sending it again uncompressed")
+        self._resend(message.params["src_path"], message.get_origin(), compress=False)
+
+    def _resend(self, src_path: str, server: Address, compress: bool = True):
+        """
+        Send the whole current content of a file to a server that could not use the changes it was sent, the other
+        servers are not involved
+        """
+        handler = self.handlers[Path(src_path).parts[0]]
+        local_path = str(handler.folder.parent / src_path)
+
+        handler.run_in_order(self._read_resend, lambda params: self._send_resend(params, server, compress),
+                             handler, local_path, src_path, compress)
+
+    def _read_resend(self, handler: FolderEventHandler, local_path: str, src_path: str, compress: bool) -> dict | None:
+        """
+        Runs in the thread of the handler
+        :return: params of the file message, None if the file does not exist anymore
+        """
+        params = handler.content_params(local_path, allow_delta=False)
+        if params is None:
+            return None
+        params = dict(is_directory=False, src_path=src_path, **params)
+        if compress:
+            params = self._compress(params)
+        return params
+
+    def _send_resend(self, params: dict, server: Address, compress: bool):
+        if "upload" in params:
+            self.upload(Command.MODIFIED, params["src_path"], **params["upload"], to={server}, first=True,
+                        compress=compress)
+        else:
+            # the request that was rejected may still be in flight, so the full upload is sent before any later change
+            self._send_first([Message(
+                topic=Topic.FILE,
+                command=Command.MODIFIED,
+                params=params
+            )], {server})
+        # the file was read after the rejection was handled, nothing else sends the queued messages
+        self._send_queued()
@@ -0,0 +1,192 @@
+import asyncio
+import os
+from time import monotonic
+from typing import Callable
+
+from common.message import Command
+
+
+class _PendingChange:
+    """
+    Changes to one path that were not sent yet
+    """
+    __slots__ = ("path", "origin", "is_directory", "modified", "deleted")
+
+    def __init__(self, path: str, origin: str | None, is_directory: bool):
+        # current local path
+        self.path = path
+        # path under which the server knows the file, None if it was created after the last flush
+        self.origin = origin
+        self.is_directory = is_directory
+        self.modified = False
+        self.deleted = False
+
+
+class EventCoalescer:
+    """
+    Collects file system events until no event has occurred for quiet_period seconds (or for at most max_delay
+    seconds) and merges the events of each path, e.g. an editor saving a file through a temporary file:
+    created + modified -> created, created + deleted -> nothing, a chain of moves -> one move.
+
+    The merged changes are passed on in the order of their first event, as (command, is_directory, src_path,
+    dest_path). File contents are only read when a change is passed on.
+    Events may be added from any thread, the changes are passed on in the event loop.
+    """
+
+    def __init__(self, callback: Callable[[Command, bool, str, str | None], None], loop: asyncio.AbstractEventLoop,
+                 quiet_period: float = 0.5, max_delay: float = 5.0):
+        self.callback = callback
+        self.loop = loop
+        self.quiet_period = quiet_period
+        self.max_delay = max_delay
+
+        # pending changes by current path, in the order of their first event
+        self._pending: dict[str, _PendingChange] = {}
+        # directories that were moved since the last flush, old path -> new path
+        self._moved_directories: dict[str, str] = {}
+        self._first_event = 0.0
+        self._last_event = 0.0
+        self._timer: asyncio.TimerHandle | None = None
+
+    def add(self, command: Command, is_directory: bool, src_path: str, dest_path: str | None = None):
+        """
+        Add an event, thread-safe
+        :param command: CREATED, MODIFIED, DELETED or MOVED
+        :param is_directory:
+        :param src_path:
+        :param dest_path: new path of a moved file
+        :return:
+        """
+        self.loop.call_soon_threadsafe(self._add, command, is_directory, src_path, dest_path)
+
+    def _add(self, command: Command, is_directory: bool, src_path: str, dest_path: str | None):
+        now = monotonic()
+        if not self._pending:
+            self._first_event = now
+        self._last_event = now
+
+        match command:
+            case Command.CREATED:
+                self._created(src_path, is_directory)
+            case Command.MODIFIED:
+                self._modified(src_path, is_directory)
+            case Command.DELETED:
+                self._deleted(src_path, is_directory)
+            case Command.MOVED:
+                self._moved(src_path, dest_path, is_directory)
+            case _:
+                raise NotImplementedError(f"Unknown event {command}")
+
+        if self._timer is None:
+            self._timer = self.loop.call_later(self.quiet_period, self._check)
+
+    def _created(self, path: str, is_directory: bool):
+        change = self._pending.get(path)
+        if change is not None and change.deleted and change.origin == path and not is_directory:
+            # the file was replaced
+            change.deleted = False
+            change.modified = True
+            return
+        self._replace(path, _PendingChange(path, None, is_directory))
+
+    def _modified(self, path: str, is_directory: bool):
+        if is_directory:
+            # the changes inside a directory are reported on their own
+            return
+        change = self._pending.get(path)
+        if change is None or change.deleted:
+            change = _PendingChange(path, path, is_directory)
+            self._replace(path, change)
+        # a created file is sent with its content anyway
+        change.modified = change.origin is not None
+
+    def _deleted(self, path: str, is_directory: bool):
+        change = self._pending.get(path)
+        if change is not None and change.deleted:
+            return
+        if change is None:
+            change = _PendingChange(path, path, is_directory)
+            self._pending[path] = change
+        elif change.origin is None:
+            # the server never knew about it
+            del self._pending[path]
+            return
+        change.deleted = True
+        change.modified = False
+
+    def _moved(self, src_path: str, dest_path: str, is_directory: bool):
+        for old, new in self._moved_directories.items():
+            if src_path.startswith(old + os.sep) and dest_path == new + src_path[len(old):]:
+                # watchdog reports the contents of a moved directory as moved, too
+                return
+
+        change = self._pending.get(src_path)
+        target = self._pending.get(dest_path)
+        if (change is not None and change.deleted) or (target is not None and target.origin not in (None, dest_path)):
+            # these can't be merged, the server has to apply them first
+            self.flush()
+
+        change = self._pending.pop(src_path, None) or _PendingChange(src_path, src_path, is_directory)
+        change.path = dest_path
+        # a pending change of the target path is overwritten
+        self._pending.pop(dest_path, None)
+        self._pending[dest_path] = change
+
+        if is_directory:
+            self._moved_directories[src_path] = dest_path
+            # pending changes inside the directory follow it, after the move
+            prefix = src_path + os.sep
+            for path in [path for path in self._pending if path.startswith(prefix)]:
+                child = self._pending.pop(path)
+                child.path = dest_path + path[len(src_path):]
+                if child.origin is not None and child.origin.startswith(prefix):
+                    child.origin = dest_path + child.origin[len(src_path):]
+                self._pending[child.path] = child
+
+    def _replace(self, path: str, change: _PendingChange):
+        """
+        Make a change the pending change of a path. If there is one already, all pending changes are passed on first,
+        so the changes of different paths stay in order
+        """
+        if path in self._pending:
+            self.flush()
+        self._pending[path] = change
+
+    def _check(self):
+        self._timer = None
+        if not self._pending:
+            self._moved_directories.clear()
+            return
+
+        now = monotonic()
+        due = min(self._last_event + self.quiet_period, self._first_event + self.max_delay)
+        if now < due:
+            self._timer = self.loop.call_later(due - now, self._check)
+            return
+
+        self.flush()
+
+    def flush(self):
+        """
+        Pass on all pending changes right away
+        :return:
+        """
+        pending, self._pending = self._pending, {}
+        self._moved_directories.clear()
+        for change in pending.values():
+            self._flush_change(change)
+
+    def _flush_change(self, change: _PendingChange):
+        if change.origin is None:
+            if not change.deleted:
+                self.callback(Command.CREATED, change.is_directory, change.path, None)
+            return
+
+        if change.deleted:
+            self.callback(Command.DELETED, change.is_directory, change.origin, None)
+            return
+
+        if change.origin != change.path:
+            self.callback(Command.MOVED, change.is_directory, change.origin, change.path)
+        if change.modified:
+            self.callback(Command.MODIFIED, change.is_directory, change.path, None)
@@ -1,15 +1,50 @@
+import asyncio
 import logging
-from time import time
+import random
+from collections import OrderedDict
+from time import monotonic
+from typing import Callable
 
-from common.communication.r_broadcast import RBroadcast
+from common.communication.r_broadcast import RBroadcast, BroadcastError
+from common.communication.rtt import RttEstimator
 from common.message import Message, Topic, Command
 from common.types import Address
 
 
+def _ranges(ids: list[int]) -> list[list[int]]:
+    """
+    Compress message IDs into ranges of consecutive IDs
+    :param ids:
+    :return: list of [first, last] pairs
+    """
+    ranges = []
+    for message_id in sorted(set(ids)):
+        if ranges and ranges[-1][1] == message_id - 1:
+            ranges[-1][1] = message_id
+        else:
+            ranges.append([message_id, message_id])
+    return ranges
+
+
+class _PendingRequest:
+    """
+    A request that has not been acknowledged yet
+    """
+    __slots__ = ("to", "message", "attempts", "sent_at", "timer")
+
+    def __init__(self, to: set[Address], message: Message):
+        self.to = to
+        self.message = message
+        # number of times the request was sent
+        self.attempts = 0
+        self.sent_at = 0.0
+        self.timer: asyncio.TimerHandle | None = None
+
+
 class AckManager:
     """
     Reliably sends/broadcasts messages and (optionally) awaits acknowledgements.
-    An error is thrown if the acknowledgement is not received on time.
+    Requests are sent again if they are not acknowledged in time, an error is thrown once all retries are used up.
     """
 
     def __init__(self, deliver_callback, own_address: Address):
@@ -17,52 +52,141 @@ class AckManager:
         self.address = own_address
 
         self.r_broadcaster = RBroadcast(self.deliver, self.address)
+        self.loop = self.r_broadcaster.loop
 
-        # time in seconds after which a message must be acknowledged
-        self.ack_timeout = 10
+        # optional handler that is called with the ID of every request that was acknowledged
+        self.ack_callback: Callable[[int], None] | None = None
+        # optional handler that is called with the replies of further recipients to a request that was acknowledged by
+        # another recipient already, e.g. one server rejecting a request the others accepted
+        self.late_reply_callback: Callable[[Message], None] | None = None
+
+        # number of times a request is sent again before it is considered failed
+        self.max_retries = 5
+        # retransmission timeout used for peers whose round-trip time has not been measured yet
+        self.initial_rto = 1.0
+        # upper limit of the retransmission timeout, also after backing off
+        self.max_rto = 60.0
+        # timeouts are randomly extended by up to this fraction, so retransmissions of many requests spread out
+        self.jitter = 0.25
+        # round-trip time estimation of every peer
+        self._rtt: dict[Address, RttEstimator] = {}
+
+        # maximum number of requests that may be awaiting acknowledgement at the same time
+        self.window = 32
 
         self.message_id = 0
-        # dict storing the IDs of requests awaiting acknowledgement and the time they expire
-        self.awaiting_ack: dict[int, float] = dict()
+        # requests awaiting acknowledgement by message ID
+        self.awaiting_ack: dict[int, _PendingRequest] = dict()
+        # recipients of recently acknowledged requests that have not replied yet, by message ID
+        self._unreplied: OrderedDict[int, set[Address]] = OrderedDict()
+
+        # replies sent to recent requests, so a retransmitted request is answered again instead of being processed twice
+        self.reply_cache_size = 1024
+        self._replies: OrderedDict[tuple, Message | None] = OrderedDict()
+
+        # time in seconds for which plain acknowledgements are collected before they are sent as one message
+        self.ack_delay = 0.01
+        # IDs of the requests of every peer that were handled but not acknowledged yet
+        self._pending_acks: dict[Address, list[int]] = {}
 
     def run(self):
         """
-        Run the socket handler loop and check for timeouts
+        Handle all messages and timeouts that are due without blocking
         :return:
         """
+        self.r_broadcaster.run()
 
-        for message_id, timeout_at in self.awaiting_ack.items():
-            if timeout_at < time():
-                self.awaiting_ack.pop(message_id)
-                raise RuntimeError("Ack timed out")
+    def run_forever(self):
+        """
+        Handle messages and timeouts as they occur, until a handler raises an error
+        :return:
+        """
+        self.r_broadcaster.run_forever()
 
-        self.r_broadcaster.run()
+    def _estimator(self, peer: Address) -> RttEstimator:
+        estimator = self._rtt.get(peer)
+        if estimator is None:
+            estimator = self._rtt[peer] = RttEstimator(self.initial_rto, max_rto=self.max_rto)
+        return estimator
+
+    def _transmit(self, message_id: int):
+        """
+        Send a pending request and schedule its retransmission.
+        The timeout is the largest one of the recipients, doubled for every previous attempt.
+        """
+        request = self.awaiting_ack[message_id]
+
+        rto = max(self._estimator(peer).rto for peer in request.to)
+        timeout = min(self.max_rto, rto * 2 ** request.attempts) * (1 + random.uniform(0, self.jitter))
+
+        request.attempts += 1
+        request.sent_at = monotonic()
+        request.timer = self.loop.call_later(timeout, self._check_timeout, message_id)
+
+        try:
+            self.r_broadcaster.r_broadcast(request.to, request.message)
+        except (BroadcastError, OSError) as e:
+            # the request is sent again when the timeout expires
+            logging.warning(f"Sending request {message_id} failed (attempt {request.attempts}): {e}")
+
+    def _check_timeout(self, message_id: int):
+        request = self.awaiting_ack.get(message_id)
+        if request is None:
+            return
+
+        if request.attempts > self.max_retries:
+            self.awaiting_ack.pop(message_id)
+            raise RuntimeError(f"Ack timed out after {request.attempts} attempts")
+
+        logging.info(f"Request {message_id} was not acknowledged in time, sending it again")
+        self._transmit(message_id)
 
     def is_awaiting_ack(self) -> bool:
         return len(self.awaiting_ack) > 0
 
-    def r_broadcast(self, to: set[Address], message: Message, expect_ack: bool = False):
+    def credit(self) -> int:
+        """
+        :return: number of requests that can be sent before the window of unacknowledged requests is full
+        """
+        return max(0, self.window - len(self.awaiting_ack))
+
+    def r_broadcast(self, to: set[Address], message: Message, expect_ack: bool = False) -> int | None:
         """
         :param expect_ack:
         :param to:
         :param message:
-        :return:
+        :return: ID under which the acknowledgement is expected
         """
-        if expect_ack:
-            ack_meta = dict(
-                message_id=self.message_id
-            )
-            message.add_meta("ack_manager", ack_meta)
+        if not expect_ack:
+            self.r_broadcaster.r_broadcast(to, message)
+            return None
+
+        message_id = self.message_id
+        self.message_id += 1
 
-            self.awaiting_ack[self.message_id] = time() + self.ack_timeout
+        ack_meta = dict(
+            message_id=message_id
+        )
+        message.add_meta("ack_manager", ack_meta)
 
-            self.message_id += 1
+        self.awaiting_ack[message_id] = _PendingRequest(set(to), message)
+        self._transmit(message_id)
 
-        self.r_broadcaster.r_broadcast(to, message)
+        return message_id
+
+    @staticmethod
+    def request_key(message: Message) -> tuple:
+        """
+        :return: key that identifies a request across retransmissions
+        """
+        incarnation = message.meta["r_broadcast"]["message_id"][0]
+        return message.get_origin(), incarnation, message.meta["ack_manager"]["message_id"]
 
     def acknowledge_with_message(self, reply_message: Message, request_message: Message):
         """
-        Send a response containing an acknowledgement to a message that requested it
+        Send a response containing an acknowledgement to a message that requested it.
+        Plain acknowledgements are collected for a short time and sent together, pending acknowledgements are
+        included in any other reply.
 
         :param reply_message:
         :param request_message:
@@ -72,12 +196,48 @@ class AckManager:
         ack_for: Address = request_message.get_origin()
         for_message_id = request_message.meta["ack_manager"]["message_id"]
 
+        key = self.request_key(request_message)
+        if key in self._replies:
+            self._replies[key] = reply_message
+
+        if reply_message.command == Command.ACK:
+            pending = self._pending_acks.setdefault(ack_for, [])
+            if not pending:
+                self.loop.call_later(self.ack_delay, self._flush_acks, ack_for)
+            pending.append(for_message_id)
+            return
+
         ack_meta = dict(
             for_message_id=for_message_id
         )
+        pending = self._pending_acks.pop(ack_for, None)
+        if pending:
+            ack_meta["acked"] = _ranges(pending)
         reply_message.add_meta("ack_manager", ack_meta)
 
-        self.r_broadcast({ack_for}, reply_message)
+        try:
+            self.r_broadcast({ack_for}, reply_message)
+        except BroadcastError as e:
+            # the peer sends its requests again if it is still there
+            logging.warning(f"Could not acknowledge requests of {ack_for}: {e}")
+
+    def _flush_acks(self, peer: Address):
+        """
+        Send the collected acknowledgements for the requests of a peer as one message
+        """
+        pending = self._pending_acks.pop(peer, None)
+        if not pending:
+            return
+
+        ack_msg = Message(
+            topic=Topic.CLIENT,
+            command=Command.ACK,
+            meta=dict(ack_manager=dict(acked=_ranges(pending)))
+        )
+        try:
+            self.r_broadcast({peer}, ack_msg)
+        except BroadcastError as e:
+            logging.warning(f"Could not acknowledge requests of {peer}: {e}")
 
     def acknowledge(self, message: Message):
         """
@@ -93,25 +253,95 @@ class AckManager:
 
         self.acknowledge_with_message(ack_msg, message)
 
+    def _deliver_request(self, message: Message):
+        """
+        Forward a request to the handler, unless it is a retransmission of a request that was handled already.
+        In that case, the reply is sent again.
+        """
+        key = self.request_key(message)
+
+        if key in self._replies:
+            reply = self._replies[key]
+            if reply is not None:
+                logging.debug(f"Request {key} was handled before, sending the reply again")
+                self.acknowledge_with_message(reply, message)
+            return
+
+        self._replies[key] = None
+        while len(self._replies) > self.reply_cache_size:
+            self._replies.popitem(last=False)
+
+        self.deliver_callback(message)
+
+    def _complete(self, message_id: int, acker: Address):
+        """
+        Mark a request as acknowledged
+        """
+        request = self.awaiting_ack.pop(message_id)
+        request.timer.cancel()
+
+        # the round-trip time is only known if the request was sent once (Karn's algorithm)
+        if request.attempts == 1:
+            self._estimator(acker).update(monotonic() - request.sent_at)
+
+        if len(request.to) > 1:
+            self._unreplied[message_id] = request.to - {acker}
+            while len(self._unreplied) > self.reply_cache_size:
+                self._unreplied.popitem(last=False)
+
+        if self.ack_callback is not None:
+            self.ack_callback(message_id)
+
+    def give_up(self, peer: Address):
+        """
+        Stop waiting for a peer that has left: the requests that were only sent to it are considered acknowledged
+        :param peer:
+        :return:
+        """
+        for message_id, request in list(self.awaiting_ack.items()):
+            if request.to == {peer}:
+                logging.info(f"Giving up request {message_id}, {peer} has left")
+                self.awaiting_ack.pop(message_id)
+                request.timer.cancel()
+                if self.ack_callback is not None:
+                    self.ack_callback(message_id)
+
     def deliver(self, message: Message):
         """
         Forward the received message to the handler.
-        If the received message is an acknowledgement for a previous request, mark the request as acknowledged.
+        If the received message is an acknowledgement for previous requests, mark the requests as acknowledged.
         :param message:
         :return:
         """
-        try:
-            for_message_id = message.meta["ack_manager"]["for_message_id"]
-        except KeyError:
+        ack_meta = message.meta.get("ack_manager", {})
+
+        if "message_id" in ack_meta:
+            return self._deliver_request(message)
+
+        if not ack_meta.keys() & {"for_message_id", "acked"}:
             # The message is not an acknowledgement -> forward to handler
             logging.debug("Message does not contain acknowledgement, forwarding to handler")
             return self.deliver_callback(message)
 
-        # only forward the message if it has not been acknowledged before and if it is an actual message
-        if for_message_id in self.awaiting_ack.keys():
-            self.awaiting_ack.pop(for_message_id)
+        acker = message.get_origin()
 
-            if message.command != Command.ACK:
-                self.deliver_callback(message)
-        else:
-            logging.debug("Message is not in list of expected acknowledgements")
+        if "for_message_id" in ack_meta:
+            for_message_id = ack_meta["for_message_id"]
+            # only forward the message if it has not been acknowledged before and if it is an actual message
+            if for_message_id in self.awaiting_ack.keys():
+                if message.command != Command.ACK:
+                    self.deliver_callback(message)
+                self._complete(for_message_id, acker)
+            elif acker in self._unreplied.get(for_message_id, ()):
+                self._unreplied[for_message_id].discard(acker)
+                if message.command != Command.ACK and self.late_reply_callback is not None:
+                    self.late_reply_callback(message)
+            else:
+                logging.debug("Message is not in list of expected acknowledgements")
+
+        for first, last in ack_meta.get("acked", []):
+            # only requests that were sent to the acknowledging peer can be acknowledged by it
+            acked = [message_id for message_id, request in self.awaiting_ack.items()
+                     if first <= message_id <= last and acker in request.to]
+            for message_id in acked:
+                self._complete(message_id, acker)
@@ -0,0 +1,71 @@
+from time import monotonic
+
+from common.types import Address
+
+
+class CircuitOpenError(ConnectionError):
+    pass
+
+
+class _Circuit:
+    """
+    Connection failures of one peer
+    """
+    __slots__ = ("failures", "opened_at", "probing")
+
+    def __init__(self):
+        self.failures = 0
+        # time the circuit was opened, None while it is closed
+        self.opened_at: float | None = None
+        # whether a probe is under way
+        self.probing = False
+
+
+class CircuitBreaker:
+    """
+    Stops sending to peers that failed repeatedly, so they don't slow down every send.
+
+    After `failure_threshold` consecutive failures the circuit of a peer opens and sends fail right away. Once
+    `cooldown` seconds have passed, one send is let through as a probe: if it succeeds, the circuit closes again,
+    otherwise it stays open for another cooldown.
+    """
+
+    def __init__(self, failure_threshold: int = 3, cooldown: float = 5.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self._circuits: dict[Address, _Circuit] = {}
+
+    def is_open(self, peer: Address) -> bool:
+        """
+        :param peer:
+        :return: whether sends to the peer currently fail right away
+        """
+        circuit = self._circuits.get(peer)
+        if circuit is None or circuit.opened_at is None:
+            return False
+        return circuit.probing or monotonic() - circuit.opened_at < self.cooldown
+
+    def before_send(self, peer: Address):
+        """
+        :param peer:
+        :return:
+        :raises CircuitOpenError: if the circuit of the peer is open
+        """
+        if self.is_open(peer):
+            raise CircuitOpenError(f"Circuit to {peer} is open")
+
+        circuit = self._circuits.get(peer)
+        if circuit is not None and circuit.opened_at is not None:
+            # the cooldown has passed, this send is the probe
+            circuit.probing = True
+
+    def success(self, peer: Address):
+        self._circuits.pop(peer, None)
+
+    def failure(self, peer: Address):
+        circuit = self._circuits.setdefault(peer, _Circuit())
+        circuit.failures += 1
+        circuit.probing = False
+        if circuit.failures >= self.failure_threshold:
+            circuit.opened_at = monotonic()
@@ -0,0 +1,240 @@
+import logging
+import socket
+import threading
+from collections import deque
+from time import time
+
+import select
+
+from common.communication.circuit_breaker import CircuitBreaker, CircuitOpenError
+from common.communication.transport import transport_for
+from common.types import Address
+
+# maximum number of buffers that can be passed to a single sendmsg() call
+IOV_MAX = 1024
+
+
+class SendQueueFullError(ConnectionError):
+    pass
+
+
+class _SendQueue:
+    """
+    Data waiting to be sent to one peer
+    """
+    __slots__ = ("items", "size", "ready")
+
+    def __init__(self, lock: threading.Lock):
+        # (data, size) in the order in which it was queued
+        self.items: deque[tuple[bytes | list[bytes | memoryview], int]] = deque()
+        self.size = 0
+        # notified when data is queued
+        self.ready = threading.Condition(lock)
+
+
+class ConnectionPool:
+    """
+    Keeps one long-lived outgoing connection per peer, so consecutive messages to the same peer don't pay for a new
+    TCP handshake and teardown each.
+    Broken connections are re-established on the next send, idle ones are closed by evict_idle().
+    Peers that can't be reached repeatedly are skipped for a while (see CircuitBreaker).
+    Messages to the same peer may be sent from several threads, they are written one after the other.
+
+    queue() sends in the background instead: every peer has a queue of its own, which a thread sends in order. A peer
+    that is slow or unreachable only delays the messages to itself, and the caller (the event loop) never waits for
+    the network.
+    """
+
+    def __init__(self, max_idle: float = 60, connect_timeout: float = 2.0, send_timeout: float = 10.0,
+                 max_queued_bytes: int = 64 * 1024 * 1024):
+        # time in seconds after which an unused connection is closed
+        self.max_idle = max_idle
+        # time in seconds after which connecting to or sending to an unresponsive peer fails
+        self.connect_timeout = connect_timeout
+        self.send_timeout = send_timeout
+
+        self.circuit_breaker = CircuitBreaker()
+
+        self._connections: dict[Address, socket.socket] = {}
+        self._last_used: dict[Address, float] = {}
+        # held while a message is written to a peer, so messages don't interleave
+        self._locks: dict[Address, threading.RLock] = {}
+        self._locks_lock = threading.Lock()
+
+        # data beyond this size waiting for a peer is dropped, the peer is not keeping up
+        self.max_queued_bytes = max_queued_bytes
+        # the queue of a peer exists while its thread is running
+        self._queues: dict[Address, _SendQueue] = {}
+        self._queues_lock = threading.Lock()
+
+    def _lock(self, to: Address) -> threading.RLock:
+        with self._locks_lock:
+            lock = self._locks.get(to)
+            if lock is None:
+                lock = self._locks[to] = threading.RLock()
+            return lock
+
+    def send(self, to: Address, data: bytes | list[bytes | memoryview]):
+        """
+        Send data to a peer, reusing the open connection if there is one
+
+        :param to:
+        :param data: blob or list of segments that are sent without joining them
+        :return:
+        :raises CircuitOpenError: if the peer failed repeatedly and is skipped
+        """
+        with self._lock(to):
+            self._send(to, data)
+
+    def queue(self, to: Address, data: bytes | list[bytes | memoryview]):
+        """
+        Send data to a peer in the background, after all data that was queued for it before.
+        Failures are logged, the data is not sent again.
+
+        :param to:
+        :param data: blob or list of segments, they must not be modified afterwards
+        :return:
+        :raises CircuitOpenError: if the peer failed repeatedly and is skipped
+        :raises SendQueueFullError: if too much data is waiting to be sent to the peer already
+        """
+        # once the cooldown has passed, the next send is the probe, made by the thread of the peer like any other send
+        if self.circuit_breaker.is_open(to):
+            raise CircuitOpenError(f"Circuit to {to} is open")
+
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            size = memoryview(data).nbytes
+        else:
+            size = sum(memoryview(segment).nbytes for segment in data)
+
+        with self._queues_lock:
+            queue = self._queues.get(to)
+            if queue is None:
+                queue = self._queues[to] = _SendQueue(self._queues_lock)
+                threading.Thread(target=self._send_queued, args=(to, queue), name=f"send-{to}", daemon=True).start()
+            elif queue.size + size > self.max_queued_bytes:
+                raise SendQueueFullError(f"{queue.size} bytes are waiting to be sent to {to} already")
+            queue.items.append((data, size))
+            queue.size += size
+            queue.ready.notify()
+
+    def _send_queued(self, to: Address, queue: _SendQueue):
+        while True:
+            with self._queues_lock:
+                while not queue.items:
+                    if not queue.ready.wait(self.max_idle) and not queue.items:
+                        # a new thread is started once something is queued again
+                        del self._queues[to]
+                        return
+                data, size = queue.items.popleft()
+
+            try:
+                self.send(to, data)
+            except CircuitOpenError:
+                logging.debug(f"Skipped a message to {to}, which failed repeatedly")
+            except OSError as e:
+                logging.warning(f"Could not send to {to}: {e}")
+            except Exception:
+                # the thread must keep sending the queue
+                logging.exception(f"Could not send to {to}")
+            finally:
+                with self._queues_lock:
+                    queue.size -= size
+
+    def _send(self, to: Address, data: bytes | list[bytes | memoryview]):
+        sock = self._connections.get(to)
+
+        if sock is not None and not self._is_stale(sock):
+            try:
+                self._sendall(sock, data)
+                self.circuit_breaker.success(to)
+                self._last_used[to] = time()
+                return
+            except OSError:
+                logging.debug(f"Connection to {to} broke, reconnecting")
+        if sock is not None:
+            self.close(to)
+
+        self.circuit_breaker.before_send(to)
+        try:
+            sock = self._connect(to)
+            self._sendall(sock, data)
+        except OSError:
+            # a partially sent message can't be continued, the connection is unusable
+            self.close(to)
+            self.circuit_breaker.failure(to)
+            raise
+        self.circuit_breaker.success(to)
+        self._last_used[to] = time()
+
+    def is_available(self, to: Address) -> bool:
+        """
+        :param to:
+        :return: False if sending to the peer would fail right away
+        """
+        return not self.circuit_breaker.is_open(to)
+
+    @staticmethod
+    def _sendall(sock: socket.socket, data: bytes | list[bytes | memoryview]):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            return sock.sendall(data)
+
+        # gather-write the segments; the list may be shared with other threads, so it is not modified
+        views = [memoryview(segment).cast("B") for segment in data]
+        first = 0
+        while first < len(views):
+            sent = sock.sendmsg(views[first:first + IOV_MAX])
+            while first < len(views) and sent >= len(views[first]):
+                sent -= len(views[first])
+                first += 1
+            if sent:
+                views[first] = views[first][sent:]
+
+    def _connect(self, to: Address) -> socket.socket:
+        sock = transport_for(to).connect(to, self.connect_timeout)
+        sock.settimeout(self.send_timeout)
+
+        logging.debug(f"New connection to {to}")
+        self._connections[to] = sock
+        return sock
+
+    @staticmethod
+    def _is_stale(sock: socket.socket) -> bool:
+        """
+        Outgoing connections never receive data, so if one becomes readable the peer has closed (or reset) it
+        """
+        # unlike select(), poll() works for file descriptors beyond FD_SETSIZE (1024)
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        if not poller.poll(0):
+            return False
+        try:
+            return not sock.recv(1, socket.MSG_PEEK)
+        except OSError:
+            return True
+
+    def close(self, to: Address):
+        with self._lock(to):
+            sock = self._connections.pop(to, None)
+            self._last_used.pop(to, None)
+        if sock is not None:
+            sock.close()
+            logging.debug(f"Connection to {to} closed.")
+
+    def close_all(self):
+        for to in list(self._connections.keys()):
+            self.close(to)
+
+    def evict_idle(self):
+        """
+        Close all connections that have not been used for max_idle seconds
+        :return:
+        """
+        now = time()
+        for to, last_used in list(self._last_used.items()):
+            lock = self._lock(to)
+            # a connection that is in use is not idle
+            if now - last_used > self.max_idle and lock.acquire(blocking=False):
+                try:
+                    self.close(to)
+                finally:
+                    lock.release()
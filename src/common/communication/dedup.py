@@ -0,0 +1,115 @@
+from common.types import Address
+
+
+class _Window:
+    """
+    Received message counters of one sender incarnation.
+    All counters up to high_water_mark were received except the missing ones, the bitmap marks the counters received
+    above it (bit i stands for high_water_mark + 1 + i).
+    """
+    __slots__ = ("high_water_mark", "bitmap", "missing")
+
+    def __init__(self):
+        self.high_water_mark = -1
+        self.bitmap = 0
+        # counters that were never received when the window slid over them, oldest first
+        self.missing: dict[int, None] = {}
+
+
+class DuplicateFilter:
+    """
+    Detects messages that were received before, in constant time and with constant memory per sender.
+
+    Message IDs are (incarnation, counter) tuples as created by RBroadcast. A sender's counter is shared by all its
+    broadcasts, so a recipient usually sees gaps. If a counter arrives that is more than `window` ahead of the
+    high-water mark, the mark is moved forward and older counters that were never received are remembered as missing,
+    so they are still accepted once, e.g. when they are repaired. Only the newest `max_missing` of them are remembered
+    per incarnation, older ones are treated as received. Only the newest `max_incarnations` incarnations of every sender are remembered, messages of older ones are
+    considered duplicates.
+    """
+
+    def __init__(self, window: int = 4096, max_missing: int = 4096, max_incarnations: int = 2):
+        self.window = window
+        self.max_missing = max_missing
+        self.max_incarnations = max_incarnations
+
+        self._senders: dict[Address, dict[int, _Window]] = {}
+
+    def received(self, sender: Address, message_id: tuple[int, int]) -> bool:
+        """
+        Check if a message was received before, without marking it
+        :param sender:
+        :param message_id:
+        :return:
+        """
+        incarnation, counter = message_id
+        incarnations = self._senders.get(sender, {})
+        window = incarnations.get(incarnation)
+        if window is None:
+            return len(incarnations) >= self.max_incarnations and incarnation < min(incarnations)
+        offset = counter - window.high_water_mark - 1
+        if offset < 0:
+            return counter not in window.missing
+        return bool((window.bitmap >> offset) & 1)
+
+    def mark(self, sender: Address, message_id: tuple[int, int]) -> bool:
+        """
+        Mark a message as received
+        :param sender:
+        :param message_id:
+        :return: True if the message is new, False if it was received before
+        """
+        incarnation, counter = message_id
+
+        incarnations = self._senders.setdefault(sender, {})
+        window = incarnations.get(incarnation)
+        if window is None:
+            if len(incarnations) >= self.max_incarnations and incarnation < min(incarnations):
+                # belongs to an instance of the sender that has been replaced already
+                return False
+            window = incarnations[incarnation] = _Window()
+            # forget the oldest incarnations
+            for old in sorted(incarnations)[:-self.max_incarnations]:
+                del incarnations[old]
+
+        offset = counter - window.high_water_mark - 1
+        if offset < 0:
+            if counter not in window.missing:
+                return False
+            del window.missing[counter]
+            return True
+        if (window.bitmap >> offset) & 1:
+            return False
+
+        if offset >= self.window:
+            # slide the window so the counter is its last slot
+            shift = offset - self.window + 1
+            self._remember_missing(window, shift)
+            window.bitmap >>= shift
+            window.high_water_mark += shift
+            offset -= shift
+
+        window.bitmap |= 1 << offset
+
+        # move the high-water mark over all counters that are now contiguous
+        contiguous = (~window.bitmap & (window.bitmap + 1)).bit_length() - 1
+        window.bitmap >>= contiguous
+        window.high_water_mark += contiguous
+
+        return True
+
+    def _remember_missing(self, window: _Window, shift: int) -> None:
+        """
+        Remember the counters that were not received among the `shift` slots the window slides over
+        :param window:
+        :param shift:
+        :return:
+        """
+        # only the newest slots can be remembered anyway
+        for i in range(max(0, shift - self.max_missing), shift):
+            if not (window.bitmap >> i) & 1:
+                window.missing[window.high_water_mark + 1 + i] = None
+
+        # forget the oldest missing counters
+        for _ in range(len(window.missing) - self.max_missing):
+            del window.missing[next(iter(window.missing))]
@@ -0,0 +1,92 @@
+import math
+from collections import deque
+from time import monotonic
+
+from common.types import Address
+
+
+class _History:
+    """
+    Arrival times of the heartbeats of one peer
+    """
+    __slots__ = ("last", "intervals")
+
+    def __init__(self, last: float, max_samples: int):
+        self.last = last
+        self.intervals: deque[float] = deque(maxlen=max_samples)
+
+
+class FailureDetector:
+    """
+    Phi accrual failure detector (Hayashibara et al.).
+
+    Instead of a fixed timeout, the detector learns the distribution of the intervals between the heartbeats of each
+    peer and computes phi, the suspicion that the peer has failed: phi = 1 means a 10% chance that a heartbeat this
+    late is still coming, phi = 2 a 1% chance and so on. A peer is suspected once phi exceeds the threshold.
+    """
+
+    def __init__(self, threshold: float = 8.0, max_samples: int = 100, min_std_deviation: float = 0.2,
+                 acceptable_pause: float = 1.0, first_interval: float = 1.0):
+        """
+        :param threshold: phi above which a peer is suspected
+        :param max_samples: number of heartbeat intervals that are remembered per peer
+        :param min_std_deviation: lower limit of the standard deviation, so very regular heartbeats don't make the
+            detector overly sensitive
+        :param acceptable_pause: time in seconds by which heartbeats may be delayed, e.g. by a busy event loop
+        :param first_interval: expected heartbeat interval of peers that have not sent a second heartbeat yet
+        """
+        self.threshold = threshold
+        self.max_samples = max_samples
+        self.min_std_deviation = min_std_deviation
+        self.acceptable_pause = acceptable_pause
+        self.first_interval = first_interval
+
+        self._peers: dict[Address, _History] = {}
+
+    def heartbeat(self, peer: Address, now: float | None = None):
+        """
+        Record the arrival of a heartbeat
+        :param peer:
+        :param now:
+        :return:
+        """
+        now = monotonic() if now is None else now
+        history = self._peers.get(peer)
+        if history is None:
+            history = self._peers[peer] = _History(now, self.max_samples)
+            # assume regular heartbeats until they were measured
+            history.intervals.append(self.first_interval)
+        else:
+            history.intervals.append(now - history.last)
+            history.last = now
+
+    def phi(self, peer: Address, now: float | None = None) -> float:
+        """
+        :param peer:
+        :param now:
+        :return: suspicion level of a peer, 0 for peers that never sent a heartbeat
+        """
+        history = self._peers.get(peer)
+        if history is None:
+            return 0.0
+        now = monotonic() if now is None else now
+
+        intervals = history.intervals
+        mean = sum(intervals) / len(intervals)
+        variance = sum((interval - mean) ** 2 for interval in intervals) / len(intervals)
+        std_deviation = max(math.sqrt(variance), self.min_std_deviation)
+
+        # logistic approximation of the cumulative normal distribution
+        y = (now - history.last - mean - self.acceptable_pause) / std_deviation
+        # beyond +-10 standard deviations phi is 0 or far above any sensible threshold, and exp() would overflow
+        y = min(max(y, -10.0), 10.0)
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if y > 0:
+            return -math.log10(e / (1 + e))
+        return -math.log10(1 - 1 / (1 + e))
+
+    def is_available(self, peer: Address, now: float | None = None) -> bool:
+        return self.phi(peer, now) < self.threshold
+
+    def remove(self, peer: Address):
+        self._peers.pop(peer, None)
@@ -0,0 +1,131 @@
+r"""
+Length-prefixed framing of packed messages on stream connections.
+
++------------------------+---------------------+
+|    8 bytes (big end.)  |   length bytes      |
++------------------------+---------------------+
+|    length of payload   |   payload           |
++------------------------+---------------------+
+"""
+import socket
+import struct
+
+HEADER = struct.Struct("!Q")
+
+# the largest messages are file contents and deltas of up to 4 MiB and repairs of multicast datagrams, a peer that
+# announces more is broken or malicious and must not make the receiver allocate it
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+class FramingError(Exception):
+    pass
+
+
+def frame(payload: bytes) -> bytes:
+    """
+    Prepend the length header to a payload
+    :param payload:
+    :return: frame that can be written to the connection
+    """
+    return HEADER.pack(len(payload)) + payload
+
+
+def frame_segments(segments: list[bytes | memoryview]) -> list[bytes | memoryview]:
+    """
+    Prepend the length header to a payload consisting of multiple segments, without joining them
+    :param segments:
+    :return: segments of the frame
+    """
+    length = sum(memoryview(segment).nbytes for segment in segments)
+    return [HEADER.pack(length), *segments]
+
+
+class FrameReader:
+    """
+    Reassembles the frames arriving on one connection.
+
+    Data is read with recv_into() into a preallocated bytearray, so reading a large payload takes linear time.
+    Frames that don't fit into the read buffer get a buffer of their own, which is handed out once it is complete.
+    """
+
+    def __init__(self, read_size: int = 256 * 1024, max_frame_size: int = MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+
+        self._buffer = bytearray(read_size)
+        # the unprocessed data is self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = 0
+
+        # a frame too large for the read buffer and the number of bytes of it that were received so far
+        self._large_frame: bytearray | None = None
+        self._large_filled = 0
+
+    def read_from(self, sock: socket.socket) -> tuple[list[bytes | bytearray], bool]:
+        """
+        Read everything that is available on a non-blocking socket
+        :param sock:
+        :return: the payloads of all frames that were completed, whether the peer closed the connection
+        """
+        frames = []
+
+        while True:
+            try:
+                if self._large_frame is not None:
+                    view = memoryview(self._large_frame)[self._large_filled:]
+                    n = sock.recv_into(view)
+                    self._large_filled += n
+                else:
+                    if self._end == len(self._buffer):
+                        self._compact()
+                    n = sock.recv_into(memoryview(self._buffer)[self._end:])
+                    self._end += n
+            except BlockingIOError:
+                return frames, False
+            except ConnectionResetError:
+                n = 0
+
+            if n == 0:
+                # peer closed the connection
+                return frames, True
+
+            self._collect(frames)
+
+    def _collect(self, frames: list):
+        if self._large_frame is not None:
+            if self._large_filled == len(self._large_frame):
+                frames.append(self._large_frame)
+                self._large_frame = None
+            return
+
+        while self._end - self._start >= HEADER.size:
+            length, = HEADER.unpack_from(self._buffer, self._start)
+            if length > self.max_frame_size:
+                raise FramingError(f"Frame of {length} bytes exceeds the limit of {self.max_frame_size} bytes")
+
+            payload_start = self._start + HEADER.size
+            available = self._end - payload_start
+
+            if available >= length:
+                frames.append(bytes(memoryview(self._buffer)[payload_start:payload_start + length]))
+                self._start = payload_start + length
+            elif length > len(self._buffer) - HEADER.size:
+                # the frame can never fit into the read buffer, continue reading directly into a buffer of its own
+                self._large_frame = bytearray(length)
+                self._large_frame[:available] = self._buffer[payload_start:self._end]
+                self._large_filled = available
+                self._start = self._end = 0
+                return
+            else:
+                break
+
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def _compact(self):
+        """
+        Move the unprocessed data to the front of the read buffer
+        """
+        remaining = self._end - self._start
+        self._buffer[:remaining] = self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = remaining
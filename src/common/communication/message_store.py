@@ -0,0 +1,31 @@
+from collections import OrderedDict
+from typing import Hashable
+
+from common.message import Message
+
+
+class MessageStore:
+    """
+    Keeps the most recently received messages, so they can be sent again to peers that missed them.
+    The oldest messages are dropped once the number of messages or their total size exceeds the limits.
+    """
+
+    def __init__(self, max_messages: int = 1024, max_bytes: int = 64 * 1024 * 1024):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+
+        self._messages: OrderedDict[Hashable, Message] = OrderedDict()
+        self._size = 0
+
+    def add(self, key: Hashable, message: Message):
+        if key in self._messages:
+            return
+        self._messages[key] = message
+        self._size += len(message.raw)
+
+        while self._messages and (len(self._messages) > self.max_messages or self._size > self.max_bytes):
+            _, dropped = self._messages.popitem(last=False)
+            self._size -= len(dropped.raw)
+
+    def get(self, key: Hashable) -> Message | None:
+        return self._messages.get(key)
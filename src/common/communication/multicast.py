@@ -0,0 +1,342 @@
+r"""
+IP multicast transport for broadcasts within a server group that shares a network segment.
+
+Every message is sent to the group once, split into datagrams. The datagrams of each sender are numbered
+consecutively, so receivers can detect gaps. Missing datagrams are requested with a NACK over the unicast connection
+to the sender, which sends them again over the same connection (or reports them as lost if they are no longer kept).
+
++--------+-------------+-------------+--------------+--------------+----------------+-----------+
+| 1 byte | 8 bytes     | 8 bytes     | 2 bytes      | 2 bytes      | address        |           |
++--------+-------------+-------------+--------------+--------------+----------------+-----------+
+| kind   | incarnation | sequence nr | fragment idx | fragment cnt | sender address | fragment  |
++--------+-------------+-------------+--------------+--------------+----------------+-----------+
+
+- kind:     DATA for a fragment of a message, SESSION to announce the last sequence number that was sent
+            (so the loss of the last datagrams of a burst is detected, too)
+- address:  unicast address of the sender, encoded as in the message header
+"""
+import logging
+import socket
+import struct
+import time
+from collections import OrderedDict
+from typing import Callable
+
+from common import message_header
+from common.communication.sendreceive import SendReceive
+from common.message import Message, Topic, Command
+from common.types import Address
+
+KIND_DATA = 0
+KIND_SESSION = 1
+
+_DATAGRAM = struct.Struct("!BQQHH")
+
+# largest UDP payload of an IPv4 datagram
+MAX_DATAGRAM_SIZE = 65507
+
+
+class _Stream:
+    """
+    Datagrams received from one sender incarnation
+    """
+    __slots__ = ("incarnation", "next", "highest", "fragments", "check_scheduled", "attempts")
+
+    def __init__(self, incarnation: int, first: int):
+        self.incarnation = incarnation
+        # sequence number of the next datagram to deliver
+        self.next = first
+        # highest sequence number the sender is known to have sent
+        self.highest = first - 1
+        # received datagrams that can't be delivered yet, by sequence number: (fragment index, fragment count, data)
+        # None marks datagrams that are lost for good and are skipped
+        self.fragments: dict[int, tuple[int, int, memoryview] | None] = {}
+        self.check_scheduled = False
+        # number of NACKs sent without any missing datagram arriving
+        self.attempts = 0
+
+
+class MulticastChannel:
+    """
+    Sends messages to all members of a multicast group at once and delivers the messages sent by the other members
+    in the order in which they were sent.
+
+    For a test on a single host, use the loopback interface (interface="127.0.0.1"): any number of local processes
+    can join the same group and port.
+    """
+
+    def __init__(self, deliver_callback: Callable[[Message], None], sender: SendReceive, group: Address,
+                 interface: str = "0.0.0.0", ttl: int = 1, fragment_size: int = 8192,
+                 max_retained_bytes: int = 64 * 1024 * 1024):
+        self.deliver_callback = deliver_callback
+        self.sender = sender
+        self.loop = sender.loop
+        self.group = group
+
+        # largest fragment of a message per datagram, datagrams larger than the MTU are fragmented by IP, and a single
+        # lost IP fragment loses the whole datagram
+        self.fragment_size = fragment_size
+        # time in seconds after which gaps are requested, it gives reordered datagrams a chance to arrive
+        self.nack_delay = 0.05
+        # number of NACKs after which missing datagrams are given up if none of them arrives
+        self.max_nack_attempts = 5
+        # time in seconds after the last datagram of a burst at which the last sequence number is announced
+        self.session_delay = 0.2
+
+        self._incarnation = int(time.time())
+        self._sequence = 0
+        self._session_scheduled = False
+
+        # datagrams that were sent recently and may be requested again: sequence number -> datagram
+        self.max_retained_bytes = max_retained_bytes
+        # largest total size of the datagrams sent again in one repair, it has to stay well below the frame size limit
+        self.max_repair_size = 16 * 1024 * 1024
+        self._retained: OrderedDict[int, bytes] = OrderedDict()
+        self._retained_bytes = 0
+
+        self._streams: dict[Address, _Stream] = {}
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        # all members of the group on this host bind the same port
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # large messages arrive as bursts of datagrams
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.socket.bind(("", group[1]))
+
+        membership = socket.inet_aton(group[0]) + socket.inet_aton(interface)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        # other members may run on this host
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+
+        self.socket.setblocking(False)
+        self.loop.add_reader(self.socket, self._read)
+
+    def close(self):
+        self.loop.remove_reader(self.socket)
+        self.socket.close()
+
+    def _header(self, kind: int, sequence: int, index: int = 0, count: int = 0) -> bytearray:
+        header = bytearray(_DATAGRAM.pack(kind, self._incarnation, sequence, index, count))
+        message_header.encode_address(header, self.sender.address)
+        return header
+
+    def send(self, message: Message):
+        """
+        Send a message to all members of the group
+        :param message:
+        :return:
+        :raises OSError: if the datagrams could not be sent
+        :raises ValueError: if the message has more fragments than a datagram can number
+        """
+        self._send_payload(memoryview(b''.join(self.sender.encode_unframed(message))))
+
+    def send_unchanged(self, message: Message):
+        """
+        Forward a received message to all members of the group, exactly as it was received
+        :param message:
+        :return:
+        :raises OSError: if the datagrams could not be sent
+        :raises ValueError: if the message has more fragments than a datagram can number
+        """
+        self._send_payload(memoryview(message.raw).cast("B"))
+
+    def _send_payload(self, payload: memoryview):
+        fragments = [payload[start:start + self.fragment_size]
+                     for start in range(0, len(payload), self.fragment_size)] or [payload]
+        if len(fragments) > 0xFFFF:
+            raise ValueError(f"Message of {len(payload)} bytes is too large to be multicast")
+
+        for index, fragment in enumerate(fragments):
+            datagram = bytes(self._header(KIND_DATA, self._sequence, index, len(fragments))) + fragment
+            self._retain(self._sequence, datagram)
+            self._sequence += 1
+            try:
+                self.socket.sendto(datagram, self.group)
+            except BlockingIOError:
+                # the send buffer is full, receivers request the datagram once they notice the gap
+                pass
+
+        if not self._session_scheduled:
+            self._session_scheduled = True
+            self.loop.call_later(self.session_delay, self._announce_session)
+
+    def _retain(self, sequence: int, datagram: bytes):
+        self._retained[sequence] = datagram
+        self._retained_bytes += len(datagram)
+        while self._retained_bytes > self.max_retained_bytes:
+            _, dropped = self._retained.popitem(last=False)
+            self._retained_bytes -= len(dropped)
+
+    def _announce_session(self):
+        self._session_scheduled = False
+        try:
+            self.socket.sendto(self._header(KIND_SESSION, self._sequence - 1), self.group)
+        except OSError as e:
+            logging.warning(f"Could not announce multicast session: {e}")
+
+    def _read(self):
+        while True:
+            try:
+                datagram = self.socket.recv(MAX_DATAGRAM_SIZE)
+            except BlockingIOError:
+                return
+            self.receive_datagram(datagram)
+
+    def receive_datagram(self, datagram: bytes | memoryview):
+        """
+        Handle a datagram that was received over multicast or sent again over unicast
+        :param datagram:
+        :return:
+        """
+        view = memoryview(datagram).cast("B")
+        try:
+            kind, incarnation, sequence, index, count = _DATAGRAM.unpack_from(view, 0)
+            origin, position = message_header.decode_address(view, _DATAGRAM.size)
+        except (struct.error, IndexError, message_header.HeaderError) as e:
+            logging.warning(f"Dropping malformed multicast datagram: {e}")
+            return
+
+        if origin == self.sender.address:
+            return
+
+        stream = self._streams.get(origin)
+        if stream is None or incarnation > stream.incarnation:
+            if kind == KIND_SESSION:
+                # nothing to request before the first message of the sender was seen
+                return
+            # messages sent before this node joined are not requested
+            stream = self._streams[origin] = _Stream(incarnation, sequence - index)
+        elif incarnation < stream.incarnation:
+            return
+
+        stream.highest = max(stream.highest, sequence)
+        if kind == KIND_DATA and sequence >= stream.next and sequence not in stream.fragments:
+            stream.fragments[sequence] = (index, count, view[position:])
+            stream.attempts = 0
+            self._deliver(stream)
+
+        if stream.next <= stream.highest and not stream.check_scheduled:
+            stream.check_scheduled = True
+            self.loop.call_later(self.nack_delay, self._request_missing, origin, stream)
+
+    def _deliver(self, stream: _Stream):
+        """
+        Deliver all complete messages at the start of the stream
+        """
+        fragments = stream.fragments
+        while stream.next in fragments:
+            first = fragments[stream.next]
+            if first is None or first[0] != 0:
+                # lost, or part of a message whose first fragment was lost
+                del fragments[stream.next]
+                stream.next += 1
+                continue
+
+            count = first[1]
+            sequences = range(stream.next, stream.next + count)
+            if not all(sequence in fragments for sequence in sequences):
+                return
+            parts = [fragments.pop(sequence) for sequence in sequences]
+            stream.next += count
+            if any(part is None for part in parts):
+                continue
+
+            blob = parts[0][2] if count == 1 else b''.join(part[2] for part in parts)
+            self.deliver_callback(message_header.decode(blob))
+
+    def _missing(self, stream: _Stream) -> list[list[int]]:
+        ranges = []
+        for sequence in range(stream.next, stream.highest + 1):
+            if sequence in stream.fragments:
+                continue
+            if ranges and ranges[-1][1] == sequence - 1:
+                ranges[-1][1] = sequence
+            else:
+                ranges.append([sequence, sequence])
+        return ranges
+
+    def _request_missing(self, origin: Address, stream: _Stream):
+        stream.check_scheduled = False
+        if self._streams.get(origin) is not stream:
+            # the sender has restarted in the meantime
+            return
+
+        missing = self._missing(stream)
+        if not missing:
+            return
+
+        if stream.attempts >= self.max_nack_attempts:
+            logging.warning(f"Giving up multicast datagrams {missing} from {origin}")
+            self._skip(stream, missing)
+            return
+
+        stream.attempts += 1
+        logging.debug(f"Requesting multicast datagrams {missing} from {origin}")
+        nack = Message(Topic.BROADCAST, Command.NACK, params=dict(incarnation=stream.incarnation, ranges=missing))
+        try:
+            self.sender.send(origin, nack)
+        except OSError as e:
+            logging.warning(f"Could not request missing multicast datagrams from {origin}: {e}")
+
+        # ask again with a longer delay if the datagrams don't arrive
+        stream.check_scheduled = True
+        self.loop.call_later(self.nack_delay * 2 ** stream.attempts, self._request_missing, origin, stream)
+
+    def _skip(self, stream: _Stream, ranges: list[list[int]]):
+        for first, last in ranges:
+            for sequence in range(max(first, stream.next), last + 1):
+                stream.fragments.setdefault(sequence, None)
+        self._deliver(stream)
+
+    def handle_nack(self, message: Message):
+        """
+        Send requested datagrams again to the member that missed them
+        :param message:
+        :return:
+        """
+        peer = message.get_origin()
+        if message.params["incarnation"] != self._incarnation:
+            return
+
+        datagrams = []
+        size = 0
+        lost = []
+        for first, last in message.params["ranges"]:
+            for sequence in range(first, last + 1):
+                datagram = self._retained.get(sequence)
+                if datagram is not None:
+                    if size + len(datagram) > self.max_repair_size:
+                        # the member requests the rest again once these have arrived
+                        continue
+                    datagrams.append(datagram)
+                    size += len(datagram)
+                elif lost and lost[-1][1] == sequence - 1:
+                    lost[-1][1] = sequence
+                else:
+                    lost.append([sequence, sequence])
+
+        repair = Message(Topic.BROADCAST, Command.REPAIR,
+                         params=dict(incarnation=self._incarnation, datagrams=datagrams, lost=lost))
+        try:
+            self.sender.send(peer, repair)
+        except OSError as e:
+            logging.warning(f"Could not send missing multicast datagrams to {peer}: {e}")
+
+    def handle_repair(self, message: Message):
+        """
+        Receive datagrams that were sent again on request
+        :param message:
+        :return:
+        """
+        for datagram in message.params["datagrams"]:
+            self.receive_datagram(datagram)
+
+        stream = self._streams.get(message.get_origin())
+        if message.params["lost"] and stream is not None and stream.incarnation == message.params["incarnation"]:
+            logging.warning(f"Multicast datagrams {message.params['lost']} from {message.get_origin()} are no longer "
+                            f"available")
+            self._skip(stream, message.params["lost"])
@@ -1,24 +1,83 @@
+import asyncio
 import logging
 import time
+from enum import Enum
+from typing import Callable
 
+from common.communication.circuit_breaker import CircuitOpenError
+from common.communication.dedup import DuplicateFilter
+from common.communication.failure_detector import FailureDetector
+from common.communication.framing import frame_segments
+from common.communication.message_store import MessageStore
+from common.communication.multicast import MulticastChannel
 from common.communication.sendreceive import SendReceive
-from common.message import Message
+from common.message import Message, Topic, Command
 from common.types import Address
 
 
+class BroadcastError(RuntimeError):
+    pass
+
+
+class Dissemination(Enum):
+    # every recipient forwards each new message to all other recipients
+    FLOOD = "flood"
+    # recipients only announce the IDs of new messages to the others, which request a message if they haven't
+    # received it shortly after the announcement
+    DIGEST = "digest"
+
+
 class RBroadcast:
     """
     Provides reliable broadcast.
     Represents the group communication middleware layer of group communication (see fig. 3.1)
     """
 
-    def __init__(self, deliver_callback, own_address: Address):
+    def __init__(self, deliver_callback, own_address: Address, dissemination: Dissemination = Dissemination.FLOOD):
         self._deliver_callback = deliver_callback
         self.address = own_address
 
         self.sender = SendReceive(self.r_deliver, self.address)
+        self.loop = self.sender.loop
+
+        # IDs of the messages that were received from each sender
+        self._received = DuplicateFilter()
 
-        self._msgs_received_from_sender: dict[Address, list[tuple[int, int]]] = {}
+        # how received messages are passed on to the other recipients
+        self.dissemination = dissemination
+        # time in seconds for which announcements are collected before they are sent
+        self.digest_interval = 0.05
+        # time in seconds after which an announced message that has not arrived is requested
+        self.request_delay = 0.5
+        # received messages that were announced to others
+        self._store = MessageStore()
+        # announcements that have not been sent yet, by peer
+        self._pending_digests: dict[Address, list] = {}
+        # announced messages that have not been received yet and the peers that announced them
+        self._wanted: dict[tuple[Address, tuple[int, int]], list[Address]] = {}
+
+        # time in seconds for which outgoing messages to the same recipients are collected and sent as one batch
+        # (0 disables batching)
+        self.batch_window = 0
+        # a batch is sent right away once it reaches this size, larger messages are never batched
+        self.batch_max_bytes = 256 * 1024
+        # encoded messages waiting to be sent, by recipients
+        self._batches: dict[frozenset[Address], list[bytes]] = {}
+        self._batch_sizes: dict[frozenset[Address], int] = {}
+        # timers that send the batches once the window has passed
+        self._batch_timers: dict[frozenset[Address], asyncio.TimerHandle] = {}
+
+        # peers that exchange heartbeats with this node, peers suspected to have failed are skipped when sending
+        self._monitored: set[Address] = set()
+        self.suspected: set[Address] = set()
+        self.failure_detector = FailureDetector()
+        # time in seconds between two heartbeats
+        self.heartbeat_interval = 1.0
+        # optional handler that is called with a monitored peer and whether it is available, when that changes
+        self.membership_callback: Callable[[Address, bool], None] | None = None
+
+        # optional multicast transport to the monitored peers, see enable_multicast()
+        self.multicast: MulticastChannel | None = None
 
         self._message_counter = 0
 
@@ -28,6 +87,18 @@ class RBroadcast:
     def run(self):
         self.sender.run()
 
+    def run_forever(self):
+        self.sender.run_forever()
+
+    def enable_multicast(self, group: Address, interface: str = "0.0.0.0"):
+        """
+        Send broadcasts to several monitored peers once, to a multicast group all of them have joined
+        :param group: multicast address and port
+        :param interface: address of the local interface to use, 127.0.0.1 to test with processes on this host
+        :return:
+        """
+        self.multicast = MulticastChannel(self._multicast_deliver, self.sender, group, interface)
+
     def _generate_message_id(self) -> tuple[int, int]:
         message_id = (self._unique_identifier, self._message_counter)
 
@@ -48,26 +119,139 @@ class RBroadcast:
 
         message.add_meta("r_broadcast", rb_meta)
 
+        if self._can_multicast(to):
+            # don't overtake messages that are still waiting in a batch
+            for pending in list(self._batches.keys()):
+                if pending & to:
+                    self._flush_batch(pending)
+            try:
+                return self.multicast.send(message)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Multicast failed, sending to each recipient instead: {e}")
+
+        if self.batch_window > 0:
+            return self._add_to_batch(frozenset(to), message)
+
         if self.broadcast(to, message) == 0:
-            raise RuntimeError("Broadcast failed: No messages were delivered")
+            raise BroadcastError("Broadcast failed: The message could not be queued for any recipient")
+
+    def _can_multicast(self, to: set[Address]) -> bool:
+        # only the monitored peers are known to have joined the group, and a single recipient is cheaper to reach
+        # directly
+        if self.multicast is None:
+            return False
+        others = set(to) - {self.address}
+        return len(others) > 1 and others <= self._monitored - self.suspected
+
+    def _add_to_batch(self, to: frozenset[Address], message: Message):
+        """
+        Queue a message to be sent together with other messages to the same recipients.
+        Messages to each recipient are still sent in the order in which they were broadcast.
+        """
+        segments = self.sender.encode_unframed(message)
+        size = sum(memoryview(segment).nbytes for segment in segments)
+
+        # batches to other recipients that overlap with these are sent first, so no message overtakes another
+        for pending in list(self._batches.keys()):
+            if pending != to and pending & to:
+                self._flush_batch(pending)
+
+        if size >= self.batch_max_bytes:
+            self._flush_batch(to)
+            if self._fan_out(set(to), frame_segments(segments)) == 0:
+                raise BroadcastError("Broadcast failed: The message could not be queued for any recipient")
+            return
+
+        encoded = b''.join(segments)
+
+        if to not in self._batches:
+            self._batches[to] = []
+            self._batch_sizes[to] = 0
+            self._batch_timers[to] = self.loop.call_later(self.batch_window, self._flush_batch, to)
+        self._batches[to].append(encoded)
+        self._batch_sizes[to] += size
+
+        if self._batch_sizes[to] >= self.batch_max_bytes:
+            self._flush_batch(to)
+
+    def _flush_batch(self, to: frozenset[Address]):
+        messages = self._batches.pop(to, None)
+        self._batch_sizes.pop(to, None)
+        timer = self._batch_timers.pop(to, None)
+        if timer is not None:
+            # the batch is sent before its window has passed
+            timer.cancel()
+        if not messages:
+            return
+
+        batch = Message(Topic.BROADCAST, Command.BATCH, params=dict(messages=messages))
+        if self.broadcast(set(to), batch) == 0:
+            raise BroadcastError("Broadcast failed: The message could not be queued for any recipient")
 
     def broadcast(self, to: set[Address], message: Message) -> int:
         """
-        Broadcast a message to a group
+        Broadcast a message to a group.
+        The message is sent to all recipients at once in the background, see SendReceive.send_encoded(). Sends that
+        fail later are only logged, whether a recipient got the message is known from its acknowledgement (see
+        AckManager).
         :param to:
         :param message:
-        :return: number of successfully sent messages
+        :return: number of recipients the message was queued for
+        """
+        # the message is only encoded once, no matter how many recipients there are
+        return self._fan_out(to, self.sender.encode(message))
+
+    def relay(self, to: set[Address], message: Message):
         """
-        delivered = 0
-        for recipient in to:
+        Forward a received message to a group, exactly as it was received
+        :param to:
+        :param message:
+        :return:
+        """
+        if self._can_multicast(to):
             try:
-                self.sender.send(recipient, message)
-                delivered += 1
-            except ConnectionRefusedError:
-                logging.warning(f"Broadcast partially failed: Connection refused by {recipient}")
-        return delivered
+                return self.multicast.send_unchanged(message)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Multicast failed, relaying to each recipient instead: {e}")
+
+        self._fan_out(to, self.sender.encode_unchanged(message))
+
+    def _recipients(self, to: set[Address]) -> list[Address]:
+        # don't wait for peers that are most likely down, unless there is nobody else to send to
+        if self.suspected:
+            to = (set(to) - self.suspected) or to
+        # peers whose circuit is open would fail right away, nothing is queued for them
+        return [recipient for recipient in to if self.sender.connections.is_available(recipient)]
+
+    def _fan_out(self, to: set[Address], data: list[bytes | memoryview]) -> int:
+        return sum(self._send(recipient, data) for recipient in self._recipients(to))
+
+    def _send(self, recipient: Address, data: list[bytes | memoryview]) -> bool:
+        """
+        :param recipient:
+        :param data: encoded message
+        :return: whether the message was queued
+        """
+        try:
+            self.sender.send_encoded(recipient, data)
+            return True
+        except CircuitOpenError:
+            logging.debug(f"Broadcast partially failed: Skipped {recipient}, which failed repeatedly")
+            return False
+        except OSError as e:
+            logging.warning(f"Broadcast partially failed: Could not send to {recipient}: {e}")
+            return False
+
+    def _multicast_deliver(self, message: Message):
+        # every member of the group receives multicast messages, also those that are not addressed to it
+        to = [tuple(addr) for addr in message.meta["r_broadcast"]["to"]]
+        if self.address in to:
+            self.r_deliver(message, multicast=True)
+
+    def r_deliver(self, message: Message, multicast: bool = False):
+        if message.topic == Topic.BROADCAST:
+            return self._handle_control_message(message)
 
-    def r_deliver(self, message: Message):
         rb_meta = message.meta["r_broadcast"]
         sender = tuple(rb_meta["sender"])
         message_id = rb_meta["message_id"]
@@ -78,18 +262,153 @@ class RBroadcast:
             return
 
         # if the message was already received, there is also nothing to do
-        if sender in self._msgs_received_from_sender.keys() and message_id in self._msgs_received_from_sender[sender]:
+        # otherwise, it is marked as received here, then forwarded to others and delivered
+        message_id = tuple(message_id)
+        if not self._received.mark(sender, message_id):
             return
+        self._wanted.pop((sender, message_id), None)
 
-        # if the message is unknown, mark it as received, forward it to others and deliver it:
-
-        # mark as received
-        if sender not in self._msgs_received_from_sender.keys(): self._msgs_received_from_sender[sender] = []
-        self._msgs_received_from_sender[sender].append(message_id)
-
-        others = to.copy().remove(self.address)
+        others = to - {self.address, sender}
         if others:
-            self.broadcast(others, message)
+            if self.dissemination == Dissemination.DIGEST or multicast:
+                # a multicast message has most likely reached all other recipients as well, and lost datagrams are
+                # repaired by the multicast channel. Only if the sender fails before it could repair them, the others
+                # need to get the message from here
+                self._announce(others, sender, message_id, message)
+            else:
+                self.relay(others, message)
 
         # deliver
         self._deliver_callback(message)
+
+    def _announce(self, to: set[Address], sender: Address, message_id: tuple[int, int], message: Message):
+        """
+        Let other recipients know that this node has received a message, so they can request it if they missed it
+        """
+        self._store.add((sender, message_id), message)
+
+        for peer in to:
+            digests = self._pending_digests.setdefault(peer, [])
+            if not digests:
+                self.loop.call_later(self.digest_interval, self._send_digests, peer)
+            digests.append([sender, *message_id])
+
+    def _send_digests(self, peer: Address):
+        digests = self._pending_digests.pop(peer, None)
+        if digests:
+            self.broadcast({peer}, Message(Topic.BROADCAST, Command.IHAVE, params=dict(ids=digests)))
+
+    def monitor(self, peers: set[Address]):
+        """
+        Exchange heartbeats with a group of peers and detect when they fail
+        :param peers:
+        :return:
+        """
+        peers = set(peers) - {self.address}
+        start = not self._monitored and peers
+
+        for peer in self._monitored - peers:
+            self.failure_detector.remove(peer)
+            self.suspected.discard(peer)
+        for peer in peers - self._monitored:
+            # the peer is expected to send its first heartbeat within the usual interval
+            self.failure_detector.heartbeat(peer)
+        self._monitored = peers
+
+        if start:
+            self.loop.call_soon(self._heartbeat)
+
+    def _heartbeat(self):
+        """
+        Send a heartbeat to all monitored peers and check which of them have failed
+        """
+        if not self._monitored:
+            return
+
+        data = self.sender.encode(Message(Topic.BROADCAST, Command.HEARTBEAT))
+        for peer in self._monitored:
+            # only queued, a peer that doesn't respond must not delay the heartbeats to the others or the check below
+            try:
+                self.sender.send_encoded(peer, data)
+            except OSError:
+                # failures are detected by the missing heartbeats of the peer
+                pass
+
+        for peer in self._monitored - self.suspected:
+            if not self.failure_detector.is_available(peer):
+                logging.warning(f"Peer {peer} is suspected to have failed "
+                                f"(phi = {self.failure_detector.phi(peer):.1f})")
+                self.suspected.add(peer)
+                if self.membership_callback is not None:
+                    self.membership_callback(peer, False)
+
+        self.loop.call_later(self.heartbeat_interval, self._heartbeat)
+
+    def _handle_heartbeat(self, peer: Address):
+        if peer not in self._monitored:
+            return
+
+        self.failure_detector.heartbeat(peer)
+        if peer in self.suspected:
+            logging.info(f"Peer {peer} is available again")
+            self.suspected.discard(peer)
+            if self.membership_callback is not None:
+                self.membership_callback(peer, True)
+
+    def _handle_control_message(self, message: Message):
+        if message.command == Command.HEARTBEAT:
+            return self._handle_heartbeat(message.get_origin())
+
+        if message.command in (Command.NACK, Command.REPAIR):
+            if self.multicast is None:
+                return
+            if message.command == Command.NACK:
+                return self.multicast.handle_nack(message)
+            return self.multicast.handle_repair(message)
+
+        if message.command == Command.BATCH:
+            # deliver the messages of the batch one after the other, as if they had been received individually
+            for encoded in message.params["messages"]:
+                self.sender.receive(encoded)
+            return
+
+        peer = message.get_origin()
+        ids = [(tuple(sender), (incarnation, counter)) for sender, incarnation, counter in message.params["ids"]]
+
+        match message.command:
+            case Command.IHAVE:
+                for key in ids:
+                    if self._received.received(*key):
+                        continue
+                    if key in self._wanted:
+                        self._wanted[key].append(peer)
+                    else:
+                        self._wanted[key] = [peer]
+                        self.loop.call_later(self.request_delay, self._request, key)
+            case Command.IWANT:
+                for key in ids:
+                    stored = self._store.get(key)
+                    if stored is not None:
+                        self.relay({peer}, stored)
+            case _:
+                raise NotImplementedError(f"Command {message.topic.name}.{message.command.name} is not implemented")
+
+    def _request(self, key: tuple[Address, tuple[int, int]]):
+        """
+        Request an announced message from one of the peers that announced it, if it still has not arrived
+        """
+        announcers = self._wanted.get(key)
+        if announcers is None:
+            return
+        if not announcers:
+            self._wanted.pop(key)
+            logging.warning(f"Message {key[1]} from {key[0]} was announced, but could not be retrieved")
+            return
+
+        peer = announcers.pop(0)
+        logging.info(f"Requesting missed message {key[1]} from {key[0]} at {peer}")
+        sender, message_id = key
+        self.broadcast({peer}, Message(Topic.BROADCAST, Command.IWANT, params=dict(ids=[[sender, *message_id]])))
+
+        # ask the next peer if this one doesn't answer either
+        self.loop.call_later(self.request_delay, self._request, key)
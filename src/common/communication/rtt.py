@@ -0,0 +1,33 @@
+class RttEstimator:
+    """
+    Estimates the retransmission timeout for one peer from measured round-trip times.
+    The smoothed round-trip time and its variation are updated as in TCP (RFC 6298).
+    """
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self, initial_rto: float = 1.0, min_rto: float = 1.0, max_rto: float = 60.0):
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+
+        self.srtt: float | None = None
+        self.rttvar: float | None = None
+        self.rto = initial_rto
+
+    def update(self, rtt: float):
+        """
+        Add a round-trip time measurement.
+        Only measure requests that were not retransmitted, their acknowledgement can't be matched to a transmission
+        :param rtt: measured round-trip time in seconds
+        :return:
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+
+        self.rto = min(self.max_rto, max(self.min_rto, self.srtt + self.K * self.rttvar))
@@ -1,35 +1,83 @@
+import asyncio
 import logging
 import socket
 
-import select
-
+from common.communication.connection_pool import ConnectionPool
+from common.communication.framing import frame_segments, FrameReader, FramingError
+from common.communication.transport import transport_for
+from common import message_header
 from common.message import Message
-from common.packer import pack, unpack
 from common.types import Address
 
 
 class SendReceive:
     """
     Represents the OS layer of group communication (see fig. 3.1)
+
+    Sockets and timers are driven by an asyncio event loop, which wakes up as soon as a socket becomes readable or a
+    timer is due instead of polling.
     """
 
+    # interval in seconds in which idle outgoing connections are closed
+    eviction_interval = 10
+
     def __init__(self, deliver_callback, addr: Address):
         self.address = addr
         self.deliver_callback = deliver_callback
 
+        # the event loop is shared by all middleware layers stacked on top of this one
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_exception_handler(self._handle_error)
+        self._error: BaseException | None = None
+
         # Create a server socket to listen for incoming connections
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind(addr)
-        self.server_socket.listen(5)
+        # a TCP socket, or a Unix domain socket for a unix:<path> address
+        self.server_socket = transport_for(addr).listen(addr)
 
         # Set the server socket to non-blocking mode
         self.server_socket.setblocking(False)
+        self.loop.add_reader(self.server_socket, self._accept)
+
+        # reassembles the frames received on each accepted connection
+        self._readers: dict[socket.socket, FrameReader] = {}
 
-        # Keep track of active sockets
-        self.sockets = [self.server_socket]
+        # outgoing connections are kept open and reused for further messages
+        self.connections = ConnectionPool()
+        self.loop.call_later(self.eviction_interval, self._evict_idle)
 
     def run(self):
-        self.handle_sockets()
+        """
+        Handle everything that is ready right now without blocking
+        :return:
+        """
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+        self._raise_error()
+
+    def run_forever(self):
+        """
+        Handle sockets and timers until a callback raises an error
+        :return:
+        """
+        self.loop.run_forever()
+        self._raise_error()
+
+    def _handle_error(self, loop: asyncio.AbstractEventLoop, context: dict):
+        # errors raised by the handlers must not be swallowed by the event loop, stop it and raise them in the caller
+        exception = context.get("exception")
+        if exception is None:
+            return loop.default_exception_handler(context)
+        self._error = exception
+        loop.stop()
+
+    def _raise_error(self):
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _evict_idle(self):
+        self.connections.evict_idle()
+        self.loop.call_later(self.eviction_interval, self._evict_idle)
 
     def send(self, to: Address, message: Message):
         """
@@ -38,66 +86,109 @@ class SendReceive:
         :param to:
         :param message: Metadata inserted by the middleware to provide reliable communication
         :return:
+        :raises OSError: if the message can't be queued, see send_encoded()
+        """
+        self.send_encoded(to, self.encode(message))
+        logging.debug(f"Sent message {message}")
+
+    def encode(self, message: Message) -> list[bytes | memoryview]:
+        """
+        Turn a message into a frame that can be sent to any number of recipients using send_encoded().
+        Large binary values (file contents) are referenced by the frame segments, not copied.
+
+        :param message:
+        :return:
         """
+        return frame_segments(self.encode_unframed(message))
 
+    def encode_unframed(self, message: Message) -> list[bytes | memoryview]:
+        """
+        Encode a message without the frame header, e.g. to send it as part of another message
+        :param message:
+        :return:
+        """
         sendreceive_meta = dict(
             origin=self.address
         )
 
         message.add_meta("sendreceive", sendreceive_meta)
-        msg_dict = message.to_dict()
-        packed_msg = pack(msg_dict)
-
-        # create a new socket
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            # connect to the target
-            sock.connect(to)
-            logging.debug(f"New connection to {to}")
-            # send the whole message
-            sock.sendall(packed_msg)
-            logging.debug(f"Sent message {message}")
-            # automatically close the socket
-            logging.debug(f"Connection to {to} closed.")
+
+        return message_header.encode(message)
+
+    @staticmethod
+    def encode_unchanged(message: Message) -> list[bytes | memoryview]:
+        """
+        Turn a received message back into a frame, without changing or re-encoding it
+        :param message:
+        :return:
+        """
+        return frame_segments([message.raw])
+
+    def send_encoded(self, to: Address, data: list[bytes | memoryview]):
+        """
+        Send a frame created by encode().
+        The frame is sent in the background (see ConnectionPool.queue()), so this never waits for the network: two
+        nodes that send to each other at the same time would otherwise each wait for the other to read. Frames to the
+        same recipient arrive in the order in which they were sent.
+
+        :param to:
+        :param data:
+        :return:
+        :raises SendQueueFullError: if the recipient does not keep up with the frames sent to it
+        """
+        self.connections.queue(to, data)
 
     def receive(self, data):
-        msg_dict = unpack(data)
-        message = Message.from_dict(msg_dict)
+        # binary values stay views into the received frame
+        message = message_header.decode(data)
 
-        logging.debug(f"Received message: {message.to_dict()}")
+        logging.debug(f"Received message: {message.topic.name}.{message.command.name}")
+        # a peer that was restarted is sent to again right away instead of after the cooldown of its circuit, e.g. to
+        # answer its request to join
+        self.connections.circuit_breaker.success(message.get_origin())
         self.deliver_callback(message)
 
-    def handle_sockets(self):
-        readable, _, _ = select.select(self.sockets, [], [], 0)
-
-        for sock in readable:
-            if sock == self.server_socket:
-                # Handle a new incoming connection
+    @staticmethod
+    def _peer_name(sock: socket.socket):
+        try:
+            return sock.getpeername()
+        except OSError:
+            # the connection was reset
+            return None
+
+    def _close_socket(self, sock: socket.socket):
+        self.loop.remove_reader(sock)
+        self._readers.pop(sock, None)
+        sock.close()
+
+    def _accept(self):
+        # Handle new incoming connections
+        while True:
+            try:
                 client_socket, addr = self.server_socket.accept()
-
-                logging.debug(f"New connection from {addr}")
-                # Set the client socket to non-blocking mode
-                client_socket.setblocking(False)
-                self.sockets.append(client_socket)
-            else:
-                # Handle data from a connected client
-
-                # accumulate all data here
-                data = b""
-
-                while True:
-                    # receive as many chunks of 1024 bytes as necessary
-                    chunk = sock.recv(1024)
-
-                    # if the chunk is empty, the message is complete
-                    if not chunk:
-                        # Remove the socket if the connection is closed
-                        logging.debug(f"Connection from {sock.getpeername()} closed.")
-                        self.sockets.remove(sock)
-                        sock.close()
-                        break
-
-                    data += chunk
-
-                if data:
-                    logging.debug(f"Received data: {data}")
-                    self.receive(data)
+            except BlockingIOError:
+                return
+
+            logging.debug(f"New connection from {addr}")
+            # Set the client socket to non-blocking mode
+            client_socket.setblocking(False)
+            self._readers[client_socket] = FrameReader()
+            self.loop.add_reader(client_socket, self._read, client_socket)
+
+    def _read(self, sock: socket.socket):
+        # Handle data from a connected client
+        # the connection stays open, so it may carry any number of messages
+        try:
+            messages, closed = self._readers[sock].read_from(sock)
+        except FramingError as e:
+            logging.warning(f"Dropping connection from {self._peer_name(sock)}: {e}")
+            self._close_socket(sock)
+            return
+
+        if closed:
+            # Remove the socket if the connection is closed
+            logging.debug(f"Connection from {self._peer_name(sock)} closed.")
+            self._close_socket(sock)
+
+        for packed_msg in messages:
+            self.receive(packed_msg)
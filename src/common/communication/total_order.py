@@ -0,0 +1,161 @@
+import logging
+from typing import Callable
+
+from common.communication.ack_manager import AckManager
+from common.communication.r_broadcast import BroadcastError
+from common.message import Message, Topic, Command
+from common.types import Address
+
+
+class TotalOrder:
+    """
+    Delivers the requests that clients send to the whole server group in the same order on every server.
+
+    The first available server of the group is the sequencer. It assigns consecutive sequence numbers to the requests
+    in the order in which it receives them, and broadcasts them in batches (REPLICATION.ORDER). Every server holds back
+    the requests it receives until their sequence number is next.
+    Requests that are only sent to a single server (e.g. knocking) don't need to be ordered and are delivered right
+    away.
+
+    Requests are identified by AckManager.request_key(), which stays the same when a request is sent again.
+    """
+
+    def __init__(self, deliver_callback: Callable[[Message], None], comm: AckManager):
+        self.deliver_callback = deliver_callback
+        self.comm = comm
+        self.address = comm.address
+
+        self.servers: list[Address] = [self.address]
+
+        # time in seconds for which the sequencer collects requests before it sends their order
+        self.batch_interval = 0.005
+        # an order is sent right away once it contains this many requests
+        self.max_batch = 256
+
+        # sequence number of the next request to deliver, None until the first order was received
+        self.next_sequence: int | None = None
+        # sequence number the sequencer assigns to the next request
+        self._next_assigned = 0
+        # requests that were received but not delivered yet, by key
+        self._held: dict[tuple, Message] = {}
+        # keys and recipients of the requests that were ordered but not delivered yet, by sequence number
+        self._order: dict[int, tuple[tuple, set[Address]]] = {}
+        # requests the sequencer received that are not part of an order yet
+        self._batch: list[tuple[tuple, set[Address]]] = []
+        # whether this server is the sequencer
+        self._sequencing = True
+
+    @property
+    def sequencer(self) -> Address:
+        suspected = self.comm.r_broadcaster.suspected
+        return next((server for server in self.servers if server not in suspected), self.servers[0])
+
+    def set_servers(self, servers: list[Address]):
+        """
+        Update the server group, all servers must list the servers in the same order
+        :param servers:
+        :return:
+        """
+        self.servers = [tuple(server) for server in servers]
+        # a joining server does not list itself yet, the others add it to the end of their lists
+        if self.address not in self.servers:
+            self.servers.append(self.address)
+        self.membership_changed()
+
+    def membership_changed(self):
+        """
+        Take over as sequencer if the previous one has failed
+        :return:
+        """
+        sequencing = self.sequencer == self.address
+        if sequencing == self._sequencing:
+            return
+        self._sequencing = sequencing
+        if not sequencing:
+            return
+
+        # continue after the last sequence number the previous sequencer is known to have assigned
+        self._next_assigned = max([self.next_sequence or 0, *(sequence + 1 for sequence in self._order)])
+
+        ordered = {key for key, _ in self._order.values()}
+        unordered = [key for key in self._held if key not in ordered]
+        logging.info(f"Taking over as sequencer, ordering {len(unordered)} held back requests")
+        for key in unordered:
+            self._add_to_batch(key, self._held[key])
+        self._flush_batch()
+
+    def _is_ordered(self, message: Message) -> bool:
+        """
+        :return: whether a message is a client request that all servers have to deliver in the same order
+        """
+        if message.get_origin() in self.servers or "message_id" not in message.meta.get("ack_manager", {}):
+            return False
+        to = {tuple(addr) for addr in message.meta["r_broadcast"]["to"]}
+        return self.sequencer in to and len(to & set(self.servers)) > 1
+
+    def deliver(self, message: Message):
+        if message.topic == Topic.REPLICATION and message.command == Command.ORDER:
+            return self._apply_order(message.params["first"], message.params["entries"])
+
+        if not self._is_ordered(message):
+            return self.deliver_callback(message)
+
+        key = AckManager.request_key(message)
+        self._held[key] = message
+        if self._sequencing:
+            self._add_to_batch(key, message)
+        self._deliver_held()
+
+    def _add_to_batch(self, key: tuple, message: Message):
+        if not self._batch:
+            self.comm.loop.call_later(self.batch_interval, self._flush_batch)
+        self._batch.append((key, {tuple(addr) for addr in message.meta["r_broadcast"]["to"]}))
+
+        if len(self._batch) >= self.max_batch:
+            self._flush_batch()
+
+    def _flush_batch(self):
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+
+        first = self._next_assigned
+        self._next_assigned += len(batch)
+        entries = [[origin, incarnation, message_id, list(to)] for (origin, incarnation, message_id), to in batch]
+
+        others = set(self.servers) - {self.address}
+        if others:
+            order = Message(Topic.REPLICATION, Command.ORDER, params=dict(first=first, entries=entries))
+            try:
+                self.comm.r_broadcast(others, order)
+            except BroadcastError as e:
+                logging.warning(f"Could not send the order of requests {first}-{first + len(batch) - 1}: {e}")
+
+        self._apply_order(first, entries)
+
+    def _apply_order(self, first: int, entries: list):
+        if self.next_sequence is None:
+            self.next_sequence = first
+
+        for i, (origin, incarnation, message_id, to) in enumerate(entries):
+            sequence = first + i
+            if sequence >= self.next_sequence:
+                self._order[sequence] = ((tuple(origin), incarnation, message_id), {tuple(addr) for addr in to})
+        self._deliver_held()
+
+    def _deliver_held(self):
+        """
+        Deliver the held back requests as long as the next one in the order has arrived
+        """
+        while self.next_sequence in self._order:
+            key, to = self._order[self.next_sequence]
+            # requests that were not sent to this server are skipped
+            if self.address in to and key not in self._held:
+                # wait for the request, reliable broadcast makes sure it arrives
+                return
+
+            del self._order[self.next_sequence]
+            self.next_sequence += 1
+            message = self._held.pop(key, None)
+            if message is not None:
+                self.deliver_callback(message)
@@ -0,0 +1,112 @@
+"""
+Stream transports the nodes communicate over, selected by the address.
+
+A TCP address is (host, port). A Unix domain socket address is ("unix:<path>", 0), for nodes on the same host: local
+messages then skip the TCP/IP stack. Both kinds are tuples, so they are used the same way everywhere else.
+"""
+import os
+import socket
+import stat
+
+from common.types import Address
+
+UNIX_SCHEME = "unix:"
+
+
+def parse_address(text: str) -> Address:
+    """
+    Parse an address given as host:port or unix:<path>
+    :param text:
+    :return:
+    """
+    if text.startswith(UNIX_SCHEME):
+        return text, 0
+    host, port = text.rsplit(":", 1)
+    return host, int(port)
+
+
+class Transport:
+    """
+    Creates the sockets of one kind of address
+    """
+
+    def listen(self, address: Address, backlog: int = 5) -> socket.socket:
+        """
+        Create a socket that accepts connections at an address
+        :param address:
+        :param backlog:
+        :return:
+        """
+        raise NotImplementedError
+
+    def connect(self, address: Address, timeout: float) -> socket.socket:
+        """
+        Connect to a listening node
+        :param address:
+        :param timeout: time in seconds after which connecting fails
+        :return:
+        """
+        raise NotImplementedError
+
+
+class TcpTransport(Transport):
+
+    def listen(self, address: Address, backlog: int = 5) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # connections are long-lived, so a restarted node would otherwise find its port blocked by TIME_WAIT
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+        sock.listen(backlog)
+        return sock
+
+    def connect(self, address: Address, timeout: float) -> socket.socket:
+        # create_connection() also resolves host names and tries IPv6 addresses
+        sock = socket.create_connection(address, timeout=timeout)
+        # messages are written in one go, there is nothing to gain from Nagle's algorithm
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+
+class UnixTransport(Transport):
+
+    def listen(self, address: Address, backlog: int = 5) -> socket.socket:
+        path = self.path(address)
+        # the socket file of a node that was not shut down cleanly would block the path
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(backlog)
+        return sock
+
+    def connect(self, address: Address, timeout: float) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self.path(address))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    @staticmethod
+    def path(address: Address) -> str:
+        return address[0][len(UNIX_SCHEME):]
+
+
+TCP = TcpTransport()
+UNIX = UnixTransport()
+
+
+def transport_for(address: Address) -> Transport:
+    """
+    :param address:
+    :return: the transport that reaches the address
+    """
+    if address[0].startswith(UNIX_SCHEME):
+        return UNIX
+    return TCP
@@ -0,0 +1,173 @@
+"""
+Compression of file contents.
+
+The client compresses the content of a file (or each chunk of it) once, the servers relay it in compressed form and
+only decompress it when they write the file. The codec is chosen per file from the ones all nodes support, content that
+does not compress (e.g. images, archives or encrypted files) is recognized by compressing a few samples of it and is
+sent as it is.
+"""
+import lzma
+import zlib
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    # optional, much faster than zlib at a similar ratio
+    zstandard = None
+
+# size of each of the samples taken from the start, middle and end of a file
+SAMPLE_SIZE = 4096
+# content whose samples don't shrink below this fraction of their size is sent uncompressed
+MAX_SAMPLE_RATIO = 0.9
+
+
+class Codec:
+    name: str
+
+    def compress(self, data) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data, max_length: int) -> bytes:
+        """
+        :param data:
+        :param max_length: the data is rejected if it decompresses to more than this many bytes
+        :return:
+        :raises ValueError: if the data is corrupted or too long
+        """
+        raise NotImplementedError
+
+
+class ZlibCodec(Codec):
+    name = "zlib"
+
+    def __init__(self, level: int = 6):
+        self.level = level
+
+    def compress(self, data) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data, max_length: int) -> bytes:
+        try:
+            result = zlib.decompressobj().decompress(data, max_length + 1)
+        except zlib.error as e:
+            raise ValueError(f"Corrupted zlib data: {e}") from e
+        if len(result) > max_length:
+            raise ValueError(f"Data decompresses to more than {max_length} bytes")
+        return result
+
+
+class LzmaCodec(Codec):
+    """
+    Best ratio, but slow, for slow links
+    """
+    name = "lzma"
+
+    def __init__(self, preset: int = 6):
+        self.preset = preset
+
+    def compress(self, data) -> bytes:
+        return lzma.compress(data, preset=self.preset)
+
+    def decompress(self, data, max_length: int) -> bytes:
+        try:
+            result = lzma.LZMADecompressor().decompress(data, max_length + 1)
+        except lzma.LZMAError as e:
+            raise ValueError(f"Corrupted lzma data: {e}") from e
+        if len(result) > max_length:
+            raise ValueError(f"Data decompresses to more than {max_length} bytes")
+        return result
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+
+    def __init__(self, level: int = 3):
+        self.level = level
+
+    def compress(self, data) -> bytes:
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data, max_length: int) -> bytes:
+        try:
+            if zstandard.frame_content_size(data) > max_length:
+                raise ValueError(f"Data decompresses to more than {max_length} bytes")
+            result = zstandard.ZstdDecompressor().decompress(data, max_output_size=max_length + 1)
+        except zstandard.ZstdError as e:
+            raise ValueError(f"Corrupted zstd data: {e}") from e
+        if len(result) > max_length:
+            raise ValueError(f"Data decompresses to more than {max_length} bytes")
+        return result
+
+
+# codecs this node supports, by name
+CODECS: dict[str, Codec] = {codec.name: codec for codec in [ZlibCodec(), LzmaCodec()]}
+if zstandard is not None:
+    CODECS[ZstdCodec.name] = ZstdCodec()
+
+# codecs that are chosen automatically, the first one all nodes support is used
+PREFERENCE = ["zstd", "zlib"]
+
+
+def samples(data) -> list:
+    """
+    :param data: content of a file
+    :return: parts of the content to judge how well it compresses
+    """
+    data = memoryview(data).cast("B")
+    if len(data) <= 3 * SAMPLE_SIZE:
+        return [data]
+    middle = (len(data) - SAMPLE_SIZE) // 2
+    return [data[:SAMPLE_SIZE], data[middle:middle + SAMPLE_SIZE], data[-SAMPLE_SIZE:]]
+
+
+def file_samples(path: Path, length: int) -> list[bytes]:
+    """
+    Like samples(), but only the samples are read from the file
+    """
+    with open(path, "rb") as file:
+        if length <= 3 * SAMPLE_SIZE:
+            return [file.read()]
+        result = []
+        for offset in (0, (length - SAMPLE_SIZE) // 2, length - SAMPLE_SIZE):
+            file.seek(offset)
+            result.append(file.read(SAMPLE_SIZE))
+        return result
+
+
+def choose_codec(content_samples: list, supported: set[str], preferred: str = "auto") -> Codec | None:
+    """
+    Choose how to compress a file
+    :param content_samples: samples of the content
+    :param supported: names of the codecs all nodes support
+    :param preferred: name of a codec, "auto" to choose the fastest one, or "none"
+    :return: None if the content should not be compressed
+    """
+    if preferred == "auto":
+        name = next((name for name in PREFERENCE if name in supported and name in CODECS), None)
+    else:
+        name = preferred if preferred in supported and preferred in CODECS else None
+    if name is None:
+        return None
+
+    sample = b''.join(content_samples)
+    if not sample or len(zlib.compress(sample, 1)) > len(sample) * MAX_SAMPLE_RATIO:
+        return None
+    return CODECS[name]
+
+
+def decompress(encoding: str, data, length: int) -> bytes:
+    """
+    :param encoding: name of the codec the data was compressed with
+    :param data:
+    :param length: length of the uncompressed data
+    :return:
+    :raises ValueError: if the codec is unknown, or the data is corrupted or not of the expected length
+    """
+    codec = CODECS.get(encoding)
+    if codec is None:
+        raise ValueError(f"Unsupported encoding '{encoding}'")
+    result = codec.decompress(data, length)
+    if len(result) != length:
+        raise ValueError(f"Data decompresses to {len(result)} instead of {length} bytes")
+    return result
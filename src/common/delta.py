@@ -0,0 +1,300 @@
+"""
+Block-level deltas between two versions of a file (rsync algorithm).
+
+The old version is described by a signature: a weak rolling checksum (Adler-32) and a strong hash of each block.
+The new version is then described by a list of operations, each one either [first block, number of blocks] to copy
+from the old version or a bytes-like literal to insert.
+"""
+import hashlib
+import math
+import os
+import shutil
+import tempfile
+import zlib
+from pathlib import Path
+
+_MOD_ADLER = 65521
+
+# maximum number of bytes the rolling checksum is moved over while searching for shifted blocks in one delta,
+# it is computed byte by byte, so the search is limited
+MAX_SEARCH = 1024 * 1024
+
+
+def strong_hash(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def file_digest(path: Path, chunk_size: int = 1024 * 1024) -> bytes:
+    """
+    :param path:
+    :param chunk_size:
+    :return: hash of the whole file, as used by Signature.digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def block_size_for(length: int) -> int:
+    """
+    Blocks of about sqrt(length) bytes balance the size of the signature and of the delta
+    """
+    size = 1 << max(0, math.isqrt(length) - 1).bit_length()
+    return min(max(size, 2048), 1024 * 1024)
+
+
+class Signature:
+    """
+    Block checksums of one version of a file
+    """
+    __slots__ = ("block_size", "length", "digest", "strong", "weak")
+
+    def __init__(self, block_size: int, length: int, digest: bytes, strong: dict[bytes, int], weak: set[int]):
+        self.block_size = block_size
+        self.length = length
+        # hash of the whole file, to check that a delta is applied to the right version
+        self.digest = digest
+        # index of the first block with each strong hash
+        self.strong = strong
+        self.weak = weak
+
+    @classmethod
+    def of(cls, data: bytes | memoryview, block_size: int | None = None) -> "Signature":
+        data = memoryview(data).cast("B")
+        if block_size is None:
+            block_size = block_size_for(len(data))
+
+        strong = {}
+        weak = set()
+        for index, start in enumerate(range(0, len(data), block_size)):
+            block = data[start:start + block_size]
+            strong.setdefault(strong_hash(block), index)
+            weak.add(zlib.adler32(block))
+        return cls(block_size, len(data), strong_hash(data), strong, weak)
+
+    @classmethod
+    def of_file(cls, path: Path, block_size: int | None = None) -> "Signature":
+        """
+        Compute the signature of a file, reading one block at a time
+        """
+        if block_size is None:
+            block_size = block_size_for(os.path.getsize(path))
+
+        digest = hashlib.blake2b(digest_size=16)
+        strong = {}
+        weak = set()
+        length = 0
+        with open(path, "rb") as file:
+            while block := file.read(block_size):
+                digest.update(block)
+                strong.setdefault(strong_hash(block), length // block_size)
+                weak.add(zlib.adler32(block))
+                length += len(block)
+        return cls(block_size, length, digest.digest(), strong, weak)
+
+
+def delta(signature: Signature, data: bytes | memoryview) -> tuple[list, int]:
+    """
+    Describe new data by the blocks of the old version it contains
+    :param signature: signature of the old version
+    :param data: new version
+    :return: operations and number of literal bytes among them
+    """
+    data = memoryview(data).cast("B")
+    size = signature.block_size
+    end = len(data)
+
+    ops = []
+    literal_bytes = 0
+    literal_start = 0
+    search_budget = MAX_SEARCH
+
+    def copy(position: int, block: int, length: int):
+        nonlocal literal_bytes, literal_start
+        if position > literal_start:
+            ops.append(data[literal_start:position])
+            literal_bytes += position - literal_start
+        if ops and isinstance(ops[-1], list) and sum(ops[-1]) == block:
+            ops[-1][1] += 1
+        else:
+            ops.append([block, 1])
+        literal_start = position + length
+
+    position = 0
+    while position < end:
+        length = min(size, end - position)
+        window = data[position:position + length]
+        block = signature.strong.get(strong_hash(window))
+        if block is not None and min(size, signature.length - block * size) == length:
+            copy(position, block, length)
+            position += length
+            continue
+
+        if length < size or search_budget <= 0:
+            position += length
+            continue
+
+        # roll the weak checksum over the following bytes until a block of the old version starts
+        checksum = zlib.adler32(window)
+        a, b = checksum & 0xFFFF, checksum >> 16
+        last = min(end - size, position + search_budget)
+        found = None
+        for start in range(position + 1, last + 1):
+            out, new = data[start - 1], data[start + size - 1]
+            a = (a - out + new) % _MOD_ADLER
+            b = (b - size * out - 1 + a) % _MOD_ADLER
+            if (b << 16 | a) in signature.weak:
+                block = signature.strong.get(strong_hash(data[start:start + size]))
+                if block is not None:
+                    found = start
+                    break
+        search_budget -= (found or last) - position
+
+        if found is None:
+            # no block starts before last
+            position = last + 1
+            continue
+        copy(found, block, size)
+        position = found + size
+
+    if end > literal_start:
+        ops.append(data[literal_start:end])
+        literal_bytes += end - literal_start
+
+    return ops, literal_bytes
+
+
+def file_delta(signature: Signature, path: Path, max_literal: int) -> tuple[list | None, Signature]:
+    """
+    Describe a file by the blocks of the old version it contains, reading one block at a time.
+    Only blocks at the same offsets are compared, which finds appended and overwritten data, but not shifted blocks.
+    :param signature: signature of the old version
+    :param path: new version
+    :param max_literal: the delta is dropped once it contains more new data than this
+    :return: operations (None if dropped) and the signature of the new version
+    """
+    size = signature.block_size
+    digest = hashlib.blake2b(digest_size=16)
+    strong = {}
+    weak = set()
+    length = 0
+
+    ops = []
+    literal_bytes = 0
+    with open(path, "rb") as file:
+        while block := file.read(size):
+            index = length // size
+            block_hash = strong_hash(block)
+            digest.update(block)
+            strong.setdefault(block_hash, index)
+            weak.add(zlib.adler32(block))
+            length += len(block)
+
+            if ops is None:
+                continue
+            if signature.strong.get(block_hash) == index and min(size, signature.length - index * size) == len(block):
+                if ops and isinstance(ops[-1], list):
+                    ops[-1][1] += 1
+                else:
+                    ops.append([index, 1])
+                continue
+
+            literal_bytes += len(block)
+            if literal_bytes > max_literal:
+                ops = None
+            elif ops and isinstance(ops[-1], bytearray):
+                ops[-1] += block
+            else:
+                ops.append(bytearray(block))
+
+    return ops, Signature(size, length, digest.digest(), strong, weak)
+
+
+def patch(path: Path, block_size: int, ops: list, length: int, digest: bytes | None = None,
+          allow_in_place: bool = True) -> None:
+    """
+    Rebuild a file from its old version and a delta.
+    If all copied blocks stay where they are (e.g. data was appended or overwritten), only the literals are written
+    into the file, otherwise the new version is written to a temporary file that replaces the old one.
+    :param path:
+    :param block_size:
+    :param ops: operations created by delta()
+    :param length: length of the new version
+    :param digest: hash of the new version (see file_digest), the file is left unchanged if the result doesn't match
+    :param allow_in_place: False to always replace the file, e.g. if it is a hard link to a content that must not change
+    :return:
+    :raises ValueError: if the delta does not fit the old version
+    """
+    old_length = os.path.getsize(path)
+    in_place = allow_in_place
+    offset = 0
+    for op in ops:
+        if isinstance(op, list):
+            first, count = op
+            in_place = in_place and first * block_size == offset
+            offset += min(count * block_size, old_length - first * block_size)
+        else:
+            offset += len(op)
+    if offset != length:
+        raise ValueError(f"Delta describes {offset} bytes instead of {length}")
+
+    if in_place:
+        if digest is not None:
+            # the literals overwrite the old version, so the result is checked before anything is written
+            hasher = hashlib.blake2b(digest_size=16)
+            with open(path, "rb") as file:
+                _rebuild(file, block_size, ops, hasher.update)
+            if hasher.digest() != digest:
+                raise ValueError("Patched file does not match the hash of the new version")
+
+        with open(path, "r+b") as file:
+            offset = 0
+            for op in ops:
+                if isinstance(op, list):
+                    first, count = op
+                    offset += min(count * block_size, old_length - first * block_size)
+                else:
+                    file.seek(offset)
+                    file.write(op)
+                    offset += len(op)
+            file.truncate(length)
+        return
+
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as old, tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as new:
+        def write(data):
+            hasher.update(data)
+            new.write(data)
+
+        try:
+            _rebuild(old, block_size, ops, write)
+            if digest is not None and hasher.digest() != digest:
+                raise ValueError("Patched file does not match the hash of the new version")
+        except BaseException:
+            os.unlink(new.name)
+            raise
+    shutil.copymode(path, new.name)
+    os.replace(new.name, path)
+
+
+def _rebuild(old, block_size: int, ops: list, write) -> None:
+    """
+    Pass the new version of a file to write() piece by piece
+    :param old: the old version, opened for reading
+    :param block_size:
+    :param ops: operations created by delta()
+    :param write:
+    :return:
+    """
+    for op in ops:
+        if isinstance(op, list):
+            first, count = op
+            old.seek(first * block_size)
+            remaining = count * block_size
+            while remaining and (chunk := old.read(min(remaining, 1024 * 1024))):
+                write(chunk)
+                remaining -= len(chunk)
+        else:
+            write(op)
@@ -1,42 +1,73 @@
 from enum import Enum
 
+from common.packer import unpack
 from common.types import Address
 
 
-class Topic(Enum):
-    FILE = "file"
-    CLIENT = "client"
-    REPLICATION = "replication"
+class _Coded(Enum):
+    """
+    An enum whose members have a numeric code in addition to their value, the code identifies them in the message
+    header (see common.message_header). Codes must never change, new members get a new code.
+    """
 
+    def __new__(cls, value: str, code: int):
+        member = object.__new__(cls)
+        member._value_ = value
+        member.code = code
+        return member
 
-class Command(Enum):
+
+class Topic(_Coded):
+    FILE = "file", 0
+    CLIENT = "client", 1
+    REPLICATION = "replication", 2
+    # control messages of the broadcast layer, they are not delivered to the application
+    BROADCAST = "broadcast", 3
+
+
+class Command(_Coded):
     # FILE commands
-    WATCHED = "watch"
-    CREATED = "create"
-    DELETED = "delete"
-    MODIFIED = "modify"
-    MOVED = "move"
-    EXAMPLE = "example"
+    WATCHED = "watch", 0
+    CREATED = "create", 1
+    DELETED = "delete", 2
+    MODIFIED = "modify", 3
+    MOVED = "move", 4
+    EXAMPLE = "example", 5
+    UPLOAD_START = "upload_start", 24
+    UPLOAD_CHUNK = "upload_chunk", 25
+    UPLOAD_COMMIT = "upload_commit", 26
 
     # CLIENT commands
-    KNOCK = "knock"
-    AUTH = "auth"
-    AUTH_SUCCESS = "auth_success"
-
-    ACK = "ack"
-    ERROR = "error"
-    SET_SERVERS = "set_servers"
-    ADD_SERVER = "add_server"
+    KNOCK = "knock", 6
+    AUTH = "auth", 7
+    AUTH_SUCCESS = "auth_success", 8
+    ACK = "ack", 9
+    ERROR = "error", 10
+    SET_SERVERS = "set_servers", 11
+    ADD_SERVER = "add_server", 12
+    REMOVE_SERVER = "remove_server", 19
+    DELTA_REJECTED = "delta_rejected", 23
+    UPLOAD_STATUS = "upload_status", 27
+    UPLOAD_REJECTED = "upload_rejected", 28
+    CONTENT_REJECTED = "content_rejected", 29
 
     # REPLICATION commands
-    CONNECT = "connect"
-    INITIALIZE = "initialize"
+    CONNECT = "connect", 13
+    INITIALIZE = "initialize", 14
+    ORDER = "order", 22
+
+    # BROADCAST commands
+    IHAVE = "ihave", 15
+    IWANT = "iwant", 16
+    BATCH = "batch", 17
+    HEARTBEAT = "heartbeat", 18
+    NACK = "nack", 20
+    REPAIR = "repair", 21
 
 
 class Message:
     topic: Topic
     command: Command
-    params: dict
     meta: dict[dict]
 
     def __init__(self, topic: Topic, command: Command, params: dict = None, meta: dict = None) -> None:
@@ -49,6 +80,23 @@ class Message:
         self.params = params
         self.meta = meta
 
+        # packed params of a received message, they are only decoded when they are accessed
+        self._packed_params = None
+        # the encoded message as it was received, so it can be forwarded without encoding it again
+        self.raw = None
+
+    @property
+    def params(self) -> dict:
+        if self._packed_params is not None:
+            self._params = unpack(self._packed_params, zero_copy=True)
+            self._packed_params = None
+        return self._params
+
+    @params.setter
+    def params(self, params: dict) -> None:
+        self._params = params
+        self._packed_params = None
+
     def add_meta(self, middleware_name: str, meta: dict) -> None:
         self.meta[middleware_name] = meta
 
@@ -66,6 +114,22 @@ class Message:
     def get_origin(self) -> Address:
         return tuple(self.meta["sendreceive"]["origin"])
 
+    @classmethod
+    def from_packed(cls, topic: Topic, command: Command, packed_params, meta: dict, raw=None):
+        """
+        Create a received message whose params are decoded on first access
+        :param topic:
+        :param command:
+        :param packed_params: packed params dict
+        :param meta:
+        :param raw: the encoded message
+        :return:
+        """
+        message = cls(topic, command, meta=meta)
+        message._packed_params = packed_params
+        message.raw = raw
+        return message
+
     @classmethod
     def from_dict(cls, msg_dict: dict):
         topic = Topic(msg_dict["topic"])
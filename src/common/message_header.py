@@ -0,0 +1,231 @@
+r"""
+Compact wire format of a Message.
+
+The topic, the command and the metadata of the middleware layers are stored in a binary header with fixed-width
+fields, the params follow as a packed body. The header can be decoded without touching the body.
+
++---------+-------+---------+-------+-----------------------------------------------------------------+--------------+
+| 1 byte  | 1 b.  | 1 byte  | 1 b.  | optional sections, in this order, present if flag set            |              |
++---------+-------+---------+-------+-----------------------------------------------------------------+--------------+
+| version | topic | command | flags | origin | r_broadcast | ack id | ack for | acked | extra meta     | packed params|
++---------+-------+---------+-------+-----------------------------------------------------------------+--------------+
+
+- origin:       address (sendreceive origin)
+- r_broadcast:  sender address, 8 byte incarnation, 8 byte counter, 2 byte count, recipient addresses
+- ack id:       8 byte message ID of a request that expects an acknowledgement
+- ack for:      8 byte message ID of the request that is acknowledged
+- acked:        2 byte count, ranges of acknowledged message IDs (8 byte first and last ID of each range)
+- extra meta:   4 byte length, packed dict of all metadata that does not fit into the sections above
+
+An address is a 1 byte kind (4: IPv4, 6: IPv6, 0: host name) followed by the address (4 or 16 bytes, or a 1 byte
+length and the UTF-8 encoded name of at most 255 bytes) and a 2 byte port.
+"""
+import socket
+import struct
+import typing as t
+
+from common.message import Message, Topic, Command
+from common.packer import pack_segments, unpack
+from common.types import Address
+
+VERSION = 1
+
+# topics and commands are identified by their explicit codes, see common.message
+TOPICS = {topic.code: topic for topic in Topic}
+COMMANDS = {command.code: command for command in Command}
+
+FLAG_ORIGIN = 0b00001
+FLAG_R_BROADCAST = 0b00010
+FLAG_ACK_ID = 0b00100
+FLAG_ACK_FOR = 0b01000
+FLAG_EXTRA = 0b10000
+FLAG_ACKED = 0b100000
+
+MAX_NAME_LENGTH = 255
+
+_FIXED = struct.Struct("!BBBB")
+_R_BROADCAST = struct.Struct("!QQH")
+_ID = struct.Struct("!Q")
+_COUNT = struct.Struct("!H")
+_RANGE = struct.Struct("!QQ")
+_LENGTH = struct.Struct("!I")
+_PORT = struct.Struct("!H")
+
+_KIND_NAME = 0
+_KIND_IPV4 = 4
+_KIND_IPV6 = 6
+
+
+class HeaderError(Exception):
+    pass
+
+
+def encode(message: Message) -> t.List[t.Union[bytes, memoryview]]:
+    """
+    Encode a message into segments, the first one is the header
+    :param message:
+    :return:
+    """
+    header = bytearray(4)
+    flags = 0
+    extra = {}
+
+    for name, meta in message.meta.items():
+        if name == "sendreceive" and meta.keys() == {"origin"}:
+            flags |= FLAG_ORIGIN
+        elif name == "r_broadcast" and meta.keys() == {"sender", "message_id", "to"}:
+            flags |= FLAG_R_BROADCAST
+        elif name == "ack_manager" and meta and meta.keys() <= {"message_id", "for_message_id", "acked"}:
+            if "message_id" in meta:
+                flags |= FLAG_ACK_ID
+            if "for_message_id" in meta:
+                flags |= FLAG_ACK_FOR
+            if "acked" in meta:
+                flags |= FLAG_ACKED
+        else:
+            extra[name] = meta
+
+    if flags & FLAG_ORIGIN:
+        encode_address(header, message.meta["sendreceive"]["origin"])
+    if flags & FLAG_R_BROADCAST:
+        rb_meta = message.meta["r_broadcast"]
+        encode_address(header, rb_meta["sender"])
+        incarnation, counter = rb_meta["message_id"]
+        header += _R_BROADCAST.pack(incarnation, counter, len(rb_meta["to"]))
+        for recipient in rb_meta["to"]:
+            encode_address(header, recipient)
+    if flags & FLAG_ACK_ID:
+        header += _ID.pack(message.meta["ack_manager"]["message_id"])
+    if flags & FLAG_ACK_FOR:
+        header += _ID.pack(message.meta["ack_manager"]["for_message_id"])
+    if flags & FLAG_ACKED:
+        acked = message.meta["ack_manager"]["acked"]
+        header += _COUNT.pack(len(acked))
+        for first, last in acked:
+            header += _RANGE.pack(first, last)
+    if extra:
+        flags |= FLAG_EXTRA
+        packed_extra = b''.join(pack_segments(extra))
+        header += _LENGTH.pack(len(packed_extra))
+        header += packed_extra
+
+    _FIXED.pack_into(header, 0, VERSION, message.topic.code, message.command.code, flags)
+
+    return [bytes(header), *pack_segments(message.params)]
+
+
+def decode_header(blob: t.Union[bytes, bytearray, memoryview]) -> t.Tuple[Topic, Command, dict, int]:
+    """
+    Decode the header of an encoded message
+    :param blob:
+    :return: topic, command, metadata, offset of the packed params
+    """
+    view = memoryview(blob).cast("B")
+    try:
+        version, topic_code, command_code, flags = _FIXED.unpack_from(view, 0)
+        if version != VERSION:
+            raise HeaderError(f"Unsupported header version {version}")
+        if topic_code not in TOPICS or command_code not in COMMANDS:
+            raise HeaderError(f"Unknown topic {topic_code} or command {command_code}")
+        topic = TOPICS[topic_code]
+        command = COMMANDS[command_code]
+
+        position = _FIXED.size
+        meta = {}
+
+        if flags & FLAG_ORIGIN:
+            origin, position = decode_address(view, position)
+            meta["sendreceive"] = dict(origin=origin)
+        if flags & FLAG_R_BROADCAST:
+            sender, position = decode_address(view, position)
+            incarnation, counter, n_recipients = _R_BROADCAST.unpack_from(view, position)
+            position += _R_BROADCAST.size
+            to = []
+            for _ in range(n_recipients):
+                recipient, position = decode_address(view, position)
+                to.append(recipient)
+            meta["r_broadcast"] = dict(sender=sender, message_id=(incarnation, counter), to=to)
+        if flags & FLAG_ACK_ID:
+            message_id, = _ID.unpack_from(view, position)
+            position += _ID.size
+            meta.setdefault("ack_manager", {})["message_id"] = message_id
+        if flags & FLAG_ACK_FOR:
+            for_message_id, = _ID.unpack_from(view, position)
+            position += _ID.size
+            meta.setdefault("ack_manager", {})["for_message_id"] = for_message_id
+        if flags & FLAG_ACKED:
+            n_ranges, = _COUNT.unpack_from(view, position)
+            position += _COUNT.size
+            acked = []
+            for _ in range(n_ranges):
+                acked.append(list(_RANGE.unpack_from(view, position)))
+                position += _RANGE.size
+            meta.setdefault("ack_manager", {})["acked"] = acked
+        if flags & FLAG_EXTRA:
+            length, = _LENGTH.unpack_from(view, position)
+            position += _LENGTH.size
+            meta.update(unpack(view[position:position + length]))
+            position += length
+    except (struct.error, IndexError) as e:
+        raise HeaderError(f"Truncated message header: {e}") from None
+
+    return topic, command, meta, position
+
+
+def decode(blob: t.Union[bytes, bytearray, memoryview]) -> Message:
+    """
+    Decode a message. Only the header is decoded right away, the params are decoded when they are first accessed
+    (binary params are memoryview slices of the blob).
+    The blob is kept as the raw message, so it can be forwarded unchanged.
+    :param blob:
+    :return:
+    """
+    topic, command, meta, body_offset = decode_header(blob)
+    return Message.from_packed(topic, command, memoryview(blob)[body_offset:], meta, raw=blob)
+
+
+def encode_address(header: bytearray, address: Address) -> None:
+    """
+    Append an address to a header
+    :param header:
+    :param address:
+    :return:
+    :raises HeaderError: if the host name or the path of a Unix domain socket is longer than MAX_NAME_LENGTH bytes
+    """
+    host, port = address
+    try:
+        header.append(_KIND_IPV4)
+        header += socket.inet_pton(socket.AF_INET, host)
+    except OSError:
+        header.pop()
+        try:
+            header.append(_KIND_IPV6)
+            header += socket.inet_pton(socket.AF_INET6, host)
+        except OSError:
+            header.pop()
+            name = host.encode()
+            if len(name) > MAX_NAME_LENGTH:
+                raise HeaderError(f"Address {host!r} is longer than {MAX_NAME_LENGTH} bytes")
+            header.append(_KIND_NAME)
+            header.append(len(name))
+            header += name
+    header += _PORT.pack(port)
+
+
+def decode_address(view: memoryview, position: int) -> t.Tuple[Address, int]:
+    kind = view[position]
+    position += 1
+    if kind == _KIND_IPV4:
+        host = socket.inet_ntop(socket.AF_INET, view[position:position + 4])
+        position += 4
+    elif kind == _KIND_IPV6:
+        host = socket.inet_ntop(socket.AF_INET6, view[position:position + 16])
+        position += 16
+    elif kind == _KIND_NAME:
+        length = view[position]
+        host = str(view[position + 1:position + 1 + length], "utf-8")
+        position += 1 + length
+    else:
+        raise HeaderError(f"Unknown address kind {kind}")
+    port, = _PORT.unpack_from(view, position)
+    return (host, port), position + _PORT.size
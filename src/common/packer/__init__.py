@@ -3,5 +3,6 @@
 r"""
 
 """
-from ._packer import pack, unpack
+from ._packer import pack, pack_into, pack_segments, unpack
+from ._unpacker import Unpacker
 from .exceptions import *
@@ -14,8 +14,6 @@ import io
 import struct
 import typing as t
 
-import math
-
 from .exceptions import *
 
 PACKED = t.Tuple[int, bytes]
@@ -35,18 +33,39 @@ class Identifier(enum.IntEnum):
 # mains
 
 
-def pack(o: t.Any):
-    identifier = TYPE2IDENTIFIER[type(o)]
-    packer = IDENTIFIER2PACKER.get(identifier)
-    if packer is None:
-        raise PackerError(f"Unknown Type {type(o).__name__}")
-    size, packed = packer(o)
-    return _pack_head(identifier, size) + packed
+def pack(o: t.Any) -> bytes:
+    parts: t.List[t.Union[bytes, memoryview]] = []
+    _encode(o, parts.append)
+    return b''.join(parts)
+
+
+def pack_segments(o: t.Any) -> t.List[t.Union[bytes, memoryview]]:
+    """
+    Pack an object into a list of segments that can be passed to socket.sendmsg() or writelines().
+    Small values are collected in shared segments, large binary values are referenced without being copied.
+    """
+    writer = _SegmentWriter()
+    _encode(o, writer.write)
+    return writer.segments()
+
+
+def pack_into(o: t.Any, write: t.Callable[[t.Union[bytes, memoryview]], t.Any]) -> None:
+    """
+    Pack an object by passing its parts to write() one after the other, e.g. the write method of a file.
+    Binary values are passed on without being copied.
+    """
+    _encode(o, write)
 
 
-def unpack(stream: t.Union[bytes, t.BinaryIO]):
-    if isinstance(stream, bytes):
-        stream = io.BytesIO(stream)
+def unpack(stream: t.Union[bytes, bytearray, memoryview, t.BinaryIO], zero_copy: bool = False):
+    """
+    :param stream: blob or binary stream
+    :param zero_copy: return binary values of a blob as memoryview slices of it instead of copying them
+    """
+    if isinstance(stream, (bytes, bytearray, memoryview)):
+        if zero_copy or not isinstance(stream, bytes):
+            stream = memoryview(stream).cast("B")
+        return _decode(stream, 0, zero_copy)[0]
     identifier, size = _unpack_head(stream)
     unpacker = IDENTIFIER2UNPACKER.get(identifier)
     if unpacker is None:
@@ -54,17 +73,137 @@ def unpack(stream: t.Union[bytes, t.BinaryIO]):
     return unpacker(size, stream)
 
 
+# fast path
+# pack/unpack of in-memory blobs, with the same output as the generic packers/unpackers below
+
+
+_NULL = int(Identifier.NULL)
+_BINARY = int(Identifier.BINARY)
+_STRING = int(Identifier.STRING)
+_BOOLEAN = int(Identifier.BOOLEAN)
+_INTEGER = int(Identifier.INTEGER)
+_NUMBER = int(Identifier.NUMBER)
+_MAPPING = int(Identifier.MAPPING)
+_ITERABLE = int(Identifier.ITERABLE)
+
+# head bytes of all values whose size fits into the head byte
+_SMALL_HEADS = [[bytes(((identifier << 5) | 0b00010000 | size,)) for size in range(16)] for identifier in range(8)]
+
+_FLOAT = struct.Struct("!f")
+
+
+def _encode(o: t.Any, write: t.Callable) -> None:
+    kind = type(o)
+    if kind is dict:
+        write(_pack_head(_MAPPING, len(o)))
+        for key, value in o.items():
+            _encode(key, write)
+            _encode(value, write)
+    elif kind is str:
+        b = o.encode()
+        write(_pack_head(_STRING, len(b)))
+        if b:
+            write(b)
+    elif kind is int:
+        if o == 0:
+            write(_SMALL_HEADS[_INTEGER][0])
+            return
+        number = -o if o < 0 else o
+        n_bytes = (number.bit_length() + 7) >> 3
+        write(_pack_head(_INTEGER, (n_bytes << 1) | (o < 0)))
+        write(number.to_bytes(n_bytes, 'big'))
+    elif kind is list or kind is tuple:
+        write(_pack_head(_ITERABLE, len(o)))
+        for element in o:
+            _encode(element, write)
+    elif kind is bool:
+        write(_SMALL_HEADS[_BOOLEAN][1 if o else 0])
+    elif o is None:
+        write(_SMALL_HEADS[_NULL][0])
+    elif kind is bytes or kind is bytearray or kind is memoryview:
+        size = o.nbytes if kind is memoryview else len(o)
+        write(_pack_head(_BINARY, size))
+        if size:
+            write(o)
+    elif kind is float:
+        write(_SMALL_HEADS[_NUMBER][_FLOAT.size])
+        write(_FLOAT.pack(o))
+    else:
+        raise PackerError(f"Unknown Type {kind.__name__}")
+
+
+def _decode(blob: t.Union[bytes, memoryview], position: int, zero_copy: bool) -> t.Tuple[t.Any, int]:
+    """
+    Decode the value starting at the given position
+    :return: value, position after the value
+    """
+    try:
+        head = blob[position]
+    except IndexError:
+        raise UnexpectedEOFError() from None
+    position += 1
+    identifier = head >> 5
+
+    if head & 0b00010000:
+        size = head & 0b00001111
+    else:
+        end = position + (head & 0b00001111)
+        if end > len(blob):
+            raise UnexpectedEOFError("unexpected EOF")
+        size = int.from_bytes(blob[position:end], 'big')
+        position = end
+
+    if identifier == _MAPPING:
+        obj = {}
+        for _ in range(size):
+            key, position = _decode(blob, position, zero_copy)
+            obj[key], position = _decode(blob, position, zero_copy)
+        return obj, position
+    elif identifier == _ITERABLE:
+        obj = []
+        for _ in range(size):
+            element, position = _decode(blob, position, zero_copy)
+            obj.append(element)
+        return obj, position
+    elif identifier == _INTEGER:
+        if size == 0:
+            return 0, position
+        end = position + (size >> 1)
+        if end > len(blob):
+            raise UnexpectedEOFError("unexpected EOF")
+        number = int.from_bytes(blob[position:end], 'big')
+        return (-number if size & 0b1 else number), end
+
+    end = position + size
+    if end > len(blob) and identifier in (_STRING, _BINARY, _NUMBER):
+        raise UnexpectedEOFError("unexpected EOF")
+
+    if identifier == _STRING:
+        return str(blob[position:end], "utf-8"), end
+    elif identifier == _BINARY:
+        value = blob[position:end]
+        return (value if zero_copy else bytes(value)), end
+    elif identifier == _BOOLEAN:
+        if size > 1:
+            raise PackerError("Bad Boolean value")
+        return size == 1, position
+    elif identifier == _NULL:
+        if size != 0:
+            raise PackerError("Bad null value")
+        return None, position
+    else:
+        return _FLOAT.unpack(blob[position:end])[0], end
+
+
 # helper
 
 
 def _pack_head(identifier: Identifier, size: int) -> bytes:
     if size < 16:
-        return int.to_bytes((identifier << 5) | 0b00010000 | size, 1, byteorder='big', signed=False)
+        return _SMALL_HEADS[identifier][size]
     else:
-        n_bytes = math.ceil(math.log(size) / math.log(256))
-        size_bytes = int.to_bytes(size, n_bytes, byteorder='big', signed=False)
-        head = int.to_bytes((identifier << 5) | len(size_bytes), 1, byteorder='big', signed=False)
-        return head + size_bytes
+        n_bytes = (size.bit_length() + 7) >> 3
+        return bytes(((identifier << 5) | n_bytes,)) + size.to_bytes(n_bytes, 'big')
 
 
 def _unpack_head(stream: io.BytesIO) -> t.Tuple[Identifier, int]:
@@ -84,6 +223,33 @@ def _unpack_head(stream: io.BytesIO) -> t.Tuple[Identifier, int]:
         return Identifier(identifier), size
 
 
+class _SegmentWriter:
+    """
+    Collects packed parts. Consecutive small parts are joined into one segment, large parts become a segment of their
+    own without being copied.
+    """
+    LARGE = 4096
+
+    def __init__(self):
+        self._segments: t.List[t.Union[bytes, memoryview]] = []
+        self._small: t.List[bytes] = []
+
+    def write(self, part: t.Union[bytes, memoryview]) -> None:
+        if len(part) < self.LARGE:
+            self._small.append(part)
+            return
+        if self._small:
+            self._segments.append(b''.join(self._small))
+            self._small.clear()
+        self._segments.append(part)
+
+    def segments(self) -> t.List[t.Union[bytes, memoryview]]:
+        if self._small:
+            self._segments.append(b''.join(self._small))
+            self._small.clear()
+        return self._segments
+
+
 def _read_n(stream: t.BinaryIO, size: int) -> bytes:
     blob = stream.read(size)
     if len(blob) != size:
@@ -104,11 +270,13 @@ def _unpack_null(size: int, _: t.BinaryIO) -> None:
     return None
 
 
-def _pack_binary(b: bytes) -> PACKED:
+def _pack_binary(b: t.Union[bytes, bytearray, memoryview]) -> PACKED:
+    if isinstance(b, memoryview):
+        return b.nbytes, b
     return len(b), b
 
 
-def _unpack_binary(size: int, stream: io.BytesIO) -> bytes:
+def _unpack_binary(size: int, stream: io.BytesIO) -> t.Union[bytes, memoryview]:
     return _read_n(stream=stream, size=size)
 
 
@@ -118,7 +286,7 @@ def _pack_string(s: str) -> PACKED:
 
 
 def _unpack_string(size: int, stream: io.BytesIO) -> str:
-    return _read_n(stream=stream, size=size).decode()
+    return str(_read_n(stream=stream, size=size), "utf-8")
 
 
 def _pack_boolean(b: bool) -> PACKED:
@@ -139,7 +307,7 @@ def _pack_integer(i: int) -> PACKED:
         return 0, b''
     signed = i < 0
     i = abs(i)
-    n_bytes = max(1, math.ceil(math.log(i) / math.log(256)))
+    n_bytes = (i.bit_length() + 7) >> 3
     number = int.to_bytes(i, n_bytes, byteorder='big', signed=False)
     return (n_bytes << 1) | signed, number
 
@@ -164,12 +332,10 @@ def _unpack_number(size: int, stream: io.BytesIO) -> float:
 
 def _pack_mapping(m: dict) -> PACKED:
     parts: t.List[bytes] = []
-    size = 0
     for key, value in m.items():
-        size += 1
-        parts.append(pack(key))
-        parts.append(pack(value))
-    return size, b''.join(parts)
+        _encode(key, parts.append)
+        _encode(value, parts.append)
+    return len(m), b''.join(parts)
 
 
 def _unpack_mapping(size: int, stream: io.BytesIO) -> dict:
@@ -183,11 +349,9 @@ def _unpack_mapping(size: int, stream: io.BytesIO) -> dict:
 
 def _pack_iterable(i) -> PACKED:
     parts: t.List[bytes] = []
-    size = 0
     for element in i:
-        size += 1
-        parts.append(pack(element))
-    return size, b''.join(parts)
+        _encode(element, parts.append)
+    return len(i), b''.join(parts)
 
 
 def _unpack_iterable(size: int, stream: io.BytesIO) -> list:
@@ -200,6 +364,8 @@ def _unpack_iterable(size: int, stream: io.BytesIO) -> list:
 TYPE2IDENTIFIER = {
     type(None): Identifier.NULL,
     bytes: Identifier.BINARY,
+    bytearray: Identifier.BINARY,
+    memoryview: Identifier.BINARY,
     str: Identifier.STRING,
     bool: Identifier.BOOLEAN,
     int: Identifier.INTEGER,
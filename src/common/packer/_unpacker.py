@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+# -*- coding=utf-8 -*-
+r"""
+Incremental decoder for data that arrives in pieces, e.g. from a non-blocking socket.
+
+    unpacker = Unpacker()
+    unpacker.feed(chunk)
+    for value in unpacker:
+        ...
+
+Containers are built up while their elements arrive, so only the bytes of the value that is currently incomplete
+are buffered. Large strings and binary values are collected in a buffer of their own.
+"""
+import collections
+import typing as t
+
+from common.communication.framing import MAX_FRAME_SIZE
+from ._packer import Identifier, _FLOAT
+from .exceptions import *
+
+_NULL = int(Identifier.NULL)
+_BINARY = int(Identifier.BINARY)
+_STRING = int(Identifier.STRING)
+_BOOLEAN = int(Identifier.BOOLEAN)
+_INTEGER = int(Identifier.INTEGER)
+_NUMBER = int(Identifier.NUMBER)
+_MAPPING = int(Identifier.MAPPING)
+_ITERABLE = int(Identifier.ITERABLE)
+
+
+class _Container:
+    __slots__ = ("value", "remaining", "key", "has_key")
+
+    def __init__(self, value: t.Union[dict, list], remaining: int):
+        self.value = value
+        self.remaining = remaining
+        self.key = None
+        self.has_key = False
+
+
+class Unpacker:
+    # incomplete strings/binary values larger than this are moved out of the input buffer
+    LARGE = 64 * 1024
+
+    def __init__(self, max_buffer_size: int = MAX_FRAME_SIZE):
+        """
+        :param max_buffer_size: maximum number of bytes of incomplete data, larger values raise a BufferFullError
+            before any memory is allocated for them. Defaults to the largest frame that is accepted from a peer.
+        """
+        self.max_buffer_size = max_buffer_size
+
+        self._buffer = bytearray()
+        self._position = 0
+
+        # containers that are not complete yet, innermost last
+        self._stack: t.List[_Container] = []
+        # large string/binary value that is being received: identifier, buffer, number of bytes received
+        self._pending: t.Optional[t.List] = None
+
+        self._values: t.Deque[t.Any] = collections.deque()
+
+    def feed(self, data: t.Union[bytes, bytearray, memoryview]) -> None:
+        """
+        Add received data and decode everything that is complete
+        :param data:
+        :return:
+        """
+        data = memoryview(data).cast("B")
+
+        if self._pending is not None:
+            data = self._fill_pending(data)
+            if self._pending is not None:
+                return
+
+        if len(self._buffer) - self._position + len(data) > self.max_buffer_size:
+            raise BufferFullError(f"More than {self.max_buffer_size} bytes of incomplete data")
+
+        self._buffer += data
+        self._parse()
+
+        del self._buffer[:self._position]
+        self._position = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> t.Any:
+        """
+        :return: the next value that was decoded completely
+        """
+        try:
+            return self._values.popleft()
+        except IndexError:
+            raise StopIteration from None
+
+    def _fill_pending(self, data: memoryview) -> memoryview:
+        """
+        Copy data into the pending large value
+        :return: data that does not belong to the value
+        """
+        identifier, value, filled = self._pending
+        n = min(len(data), len(value) - filled)
+        value[filled:filled + n] = data[:n]
+        filled += n
+
+        if filled < len(value):
+            self._pending[2] = filled
+            return data[n:]
+
+        self._pending = None
+        self._complete(value.decode() if identifier == _STRING else bytes(value))
+        return data[n:]
+
+    def _parse(self) -> None:
+        buf = self._buffer
+        while self._position < len(buf):
+            position = self._position
+
+            head = buf[position]
+            position += 1
+            identifier = head >> 5
+            if head & 0b00010000:
+                size = head & 0b00001111
+            else:
+                end = position + (head & 0b00001111)
+                if end > len(buf):
+                    return
+                size = int.from_bytes(buf[position:end], 'big')
+                position = end
+
+            if identifier == _MAPPING or identifier == _ITERABLE:
+                self._position = position
+                container = {} if identifier == _MAPPING else []
+                if size == 0:
+                    self._complete(container)
+                else:
+                    self._stack.append(_Container(container, size))
+                continue
+
+            if identifier == _INTEGER:
+                length = size >> 1
+            elif identifier in (_STRING, _BINARY, _NUMBER):
+                length = size
+            else:
+                length = 0
+
+            end = position + length
+            if end > len(buf):
+                if identifier in (_STRING, _BINARY) and length > self.LARGE:
+                    self._start_pending(identifier, length, position)
+                return
+
+            self._position = end
+            self._complete(self._decode_scalar(identifier, size, buf[position:end]))
+
+    def _start_pending(self, identifier: int, length: int, position: int) -> None:
+        if length > self.max_buffer_size:
+            raise BufferFullError(f"Value of {length} bytes exceeds the limit of {self.max_buffer_size} bytes")
+        value = bytearray(length)
+        available = len(self._buffer) - position
+        value[:available] = self._buffer[position:]
+        self._pending = [identifier, value, available]
+        self._position = len(self._buffer)
+
+    @staticmethod
+    def _decode_scalar(identifier: int, size: int, payload: bytearray) -> t.Any:
+        if identifier == _STRING:
+            return payload.decode()
+        elif identifier == _BINARY:
+            return bytes(payload)
+        elif identifier == _INTEGER:
+            if size == 0:
+                return 0
+            number = int.from_bytes(payload, 'big')
+            return -number if size & 0b1 else number
+        elif identifier == _BOOLEAN:
+            if size > 1:
+                raise PackerError("Bad Boolean value")
+            return size == 1
+        elif identifier == _NULL:
+            if size != 0:
+                raise PackerError("Bad null value")
+            return None
+        else:
+            return _FLOAT.unpack(payload)[0]
+
+    def _complete(self, value: t.Any) -> None:
+        """
+        Attach a complete value to the innermost open container, or output it if it is a top-level value
+        """
+        while self._stack:
+            container = self._stack[-1]
+            if isinstance(container.value, dict):
+                if not container.has_key:
+                    container.key = value
+                    container.has_key = True
+                    return
+                container.value[container.key] = value
+                container.has_key = False
+            else:
+                container.value.append(value)
+
+            container.remaining -= 1
+            if container.remaining:
+                return
+
+            # the container is complete itself
+            self._stack.pop()
+            value = container.value
+
+        self._values.append(value)
@@ -4,7 +4,7 @@ r"""
 
 """
 
-__all__ = ['PackerError', 'EmptyBlobError', 'UnexpectedEOFError']
+__all__ = ['PackerError', 'EmptyBlobError', 'UnexpectedEOFError', 'BufferFullError']
 
 
 class PackerError(Exception):
@@ -17,3 +17,7 @@ class EmptyBlobError(PackerError):
 
 class UnexpectedEOFError(PackerError):
     pass
+
+
+class BufferFullError(PackerError):
+    pass
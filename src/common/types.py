@@ -1,2 +1,2 @@
-# Address: IP/domain, port
+# Address: IP/domain, port (or "unix:<path>", 0 for a Unix domain socket, see common.communication.transport)
 type Address = tuple[str, int]
@@ -5,11 +5,14 @@ import argparse
 import logging
 
 from client import FileServiceClient as Client
+from common.communication.transport import parse_address
 from common.paths import parse_path
 
 argument_parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-argument_parser.add_argument('--server', type=str, help="Server address (host:port)",
+argument_parser.add_argument('--server', type=str, help="Server address (host:port or unix:<path>)",
                              default="localhost:50000")
+argument_parser.add_argument('--address', type=str, help="Own address (host:port or unix:<path>)",
+                             default="localhost:51000")
 
 argument_parser.add_argument('--user', type=str, help="Automatically authenticate using this user",
                              default="anonymous")
@@ -18,29 +21,36 @@ argument_parser.add_argument('--passwd', type=str, help="Automatically authentic
 
 argument_parser.add_argument('--watch', type=str, help="Watch folders", nargs='*', default=[])
 
+argument_parser.add_argument('--batch-window', type=float, default=0,
+                             help="Collect outgoing messages for this many seconds and send them as one batch")
+argument_parser.add_argument('--window', type=int, default=32,
+                             help="Maximum number of requests that are sent before their acknowledgement arrives")
+argument_parser.add_argument('--compression', type=str, default="auto",
+                             choices=["auto", "none", "zlib", "lzma", "zstd"],
+                             help="Codec to compress file contents with (auto: the fastest one the servers support, zstd "
+                                  "needs the zstandard package), contents that don't compress are always sent as they "
+                                  "are")
+
 args = vars(argument_parser.parse_args())
 
 
 def main():
-    server: str = args.get('server')
+    server = parse_address(args.get('server'))
     user = args.get('user')
     passwd = args.get('passwd')
 
-    host, port = server.split(":")
-    port = int(port)
-
-    client = Client()
+    client = Client(parse_address(args.get('address')))
+    client.comm.r_broadcaster.batch_window = args.get("batch_window")
+    client.comm.window = args.get("window")
+    client.compression = args.get("compression")
 
-    client.connect((host, port))
+    client.connect(server)
     client.auth(user, passwd)
 
     for watch_dir in args.get("watch"):
         client.add_watched_folder(parse_path(watch_dir))
 
-    from time import sleep
-    while True:
-        client.run()
-        sleep(.1)
+    client.run_forever()
 
 
 if __name__ == '__main__':
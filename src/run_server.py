@@ -5,40 +5,51 @@ import argparse
 import logging
 from common.paths import parse_path
 
+from common.communication.r_broadcast import Dissemination
+from common.communication.transport import parse_address
 from server import FileServiceServer as Server, FileServiceBackupServer as BackupServer
 
 parser = argparse.ArgumentParser(description='Run an instance of the file server')
-parser.add_argument("--address", help="Own address (host:port)", default="localhost:50000")
+parser.add_argument("--address", help="Own address (host:port or unix:<path>)", default="localhost:50000")
 parser.add_argument("--storage-dir", help="Path to folder that stores the uploaded files", required=True)
-parser.add_argument("--join", help="Join an existing server group at the given address (host:port)")
+parser.add_argument("--join",
+                    help="Join an existing server group at the given address (host:port or unix:<path>)")
+parser.add_argument("--dissemination", choices=[mode.value for mode in Dissemination], default="flood",
+                    help="How servers pass on broadcasts: forward every message to all others (flood) or only "
+                         "announce message IDs and send messages on request (digest)")
+parser.add_argument("--batch-window", type=float, default=0,
+                    help="Collect outgoing messages to the same recipients for this many seconds and send them as "
+                         "one batch (0: no batching)")
+parser.add_argument("--multicast", help="Send broadcasts to the other servers once, to this multicast group "
+                                        "(group:port), all servers of the group must use the same one")
+parser.add_argument("--multicast-interface", default="0.0.0.0",
+                    help="Address of the interface used for multicast (127.0.0.1 to run all servers on this host)")
 
 if __name__ == '__main__':
     args = vars(parser.parse_args())
     logging.basicConfig(level=logging.INFO)
 
     storage_dir = parse_path(args.get("storage_dir"))
-    host, port = args.get('address').split(':')
-    port = int(port)
-
-    own_addr = (host, port)
+    own_addr = parse_address(args.get('address'))
 
     if args.get("join"):
         # add new server to group
-        lead_host, lead_port = args.get('join').split(':')
-        lead_port = int(lead_port)
-        leader = (lead_host, lead_port)
+        leader = parse_address(args.get('join'))
 
         logging.info(f"Starting backup server at {own_addr}")
         server = BackupServer(own_addr, storage_dir)
-
-        server.connect(leader)
     else:
         # start first server and create group
         logging.info(f"Starting new server at {own_addr}")
         server = Server(own_addr, storage_dir)
 
-    from time import sleep
+    server.comm.r_broadcaster.dissemination = Dissemination(args.get("dissemination"))
+    server.comm.r_broadcaster.batch_window = args.get("batch_window")
+    if args.get("multicast"):
+        group_host, group_port = args.get("multicast").split(':')
+        server.comm.r_broadcaster.enable_multicast((group_host, int(group_port)), args.get("multicast_interface"))
+
+    if args.get("join"):
+        server.connect(leader)
 
-    while True:
-        server.run()
-        sleep(.1)
+    server.run_forever()
@@ -1,6 +1,9 @@
 import logging
 
 from common.communication.ack_manager import AckManager
+from common.communication.r_broadcast import BroadcastError
+from common.communication.total_order import TotalOrder
+from common.compression import CODECS, decompress
 from common.message import Message, Topic, Command
 from common.types import Address
 from common.users import check_auth, AccessType
@@ -20,6 +23,9 @@ class BaseServer:
 
         self.comm = AckManager(self.route, address)
 
+        # codecs all servers of the group support, the clients only compress file contents with these
+        self.codecs: set[str] = set(CODECS)
+
         # the first server has no server group or clients to connect to
         self._state = ServerState.RUNNING
         self.address = address
@@ -36,6 +42,9 @@ class BaseServer:
     def run(self):
         self.comm.run()
 
+    def run_forever(self):
+        self.comm.run_forever()
+
     def route(self, message: Message):
         match message.topic:
             case Topic.CLIENT:
@@ -53,7 +62,8 @@ class BaseServer:
             topic=Topic.CLIENT,
             command=Command.SET_SERVERS,
             params=dict(
-                servers=self.servers
+                servers=self.servers,
+                codecs=sorted(self.codecs)
             )
         )
         self.comm.acknowledge_with_message(reply, message)
@@ -84,6 +94,16 @@ class BaseServer:
 
 class ActiveReplServer(BaseServer):
 
+    def __init__(self, address: Address):
+        super().__init__(address)
+
+        # client requests are handled in the same order on all servers of the group
+        self.ordering = TotalOrder(self.route, self.comm)
+        self.comm.deliver_callback = self.ordering.deliver
+
+        # servers of the group that stop sending heartbeats are skipped until they are back
+        self.comm.r_broadcaster.membership_callback = self.handle_membership_change
+
     def route(self, message: Message):
         match message.topic:
             case Topic.REPLICATION:
@@ -110,6 +130,7 @@ class ActiveReplServer(BaseServer):
             command=Command.INITIALIZE,
             params=dict(
                 servers=self.servers,
+                codecs=sorted(self.codecs),
                 # packer has trouble unpacking the dict
                 # so here the items are arranged in a list and re-ordered by the receiving end
                 clients=[(addr, auth_status.value) for addr, auth_status in self.clients.items()]
@@ -122,10 +143,79 @@ class ActiveReplServer(BaseServer):
         new_server = tuple(message.params['server'])
         logging.info(f"Attaching new server {new_server} to group")
         self.servers.append(new_server)
+        self.codecs &= set(message.params['codecs'])
+        self.update_group()
+
+    def update_group(self):
+        """
+        Apply a change of the server list to the middleware
+        :return:
+        """
+        self.comm.r_broadcaster.monitor(set(self.servers))
+        self.ordering.set_servers(self.servers)
+
+    def handle_membership_change(self, server: Address, available: bool):
+        """
+        Let the clients know that a server of the group has failed or is available again
+        :param server:
+        :param available:
+        :return:
+        """
+        # the next server takes over if the sequencer has failed
+        self.ordering.membership_changed()
+
+        message = Message(
+            topic=Topic.CLIENT,
+            command=Command.ADD_SERVER if available else Command.REMOVE_SERVER,
+            params=dict(
+                server=server,
+                codecs=sorted(self.codecs)
+            )
+        )
+
+        for client in self.clients:
+            try:
+                self.comm.r_broadcast({client}, message)
+            except BroadcastError:
+                logging.warning(f"Could not inform client {client} about server {server}")
 
 
+import asyncio
+import os
+import shutil
+from collections import deque
 from os.path import commonpath
 from pathlib import Path
+from typing import Callable
+
+import secrets
+
+from common.delta import file_digest, patch, strong_hash
+from server.content_store import ContentStore
+
+
+class _Staging:
+    """
+    Received part of an upload that was not committed yet
+    """
+    __slots__ = ("src_path", "received", "ranges", "undecodable")
+
+    def __init__(self, src_path: Path):
+        self.src_path = src_path
+        # number of bytes at the start of the file that were received without gaps
+        self.received = 0
+        # chunks that were received after a gap, start -> end
+        self.ranges: dict[int, int] = {}
+        # whether a chunk could not be decompressed, the commit is rejected then
+        self.undecodable = False
+
+    def add(self, start: int, end: int):
+        if start > self.received:
+            self.ranges[start] = max(end, self.ranges.get(start, end))
+            return
+        self.received = max(self.received, end)
+        while self.received in self.ranges:
+            self.received = max(self.received, self.ranges.pop(self.received))
 
 
 class FileServiceServer(ActiveReplServer):
@@ -141,6 +231,70 @@ class FileServiceServer(ActiveReplServer):
 
         self.files = storage_dir
 
+        # hashes of the stored files, to check that a delta is applied to the version it was computed for
+        self._digests: dict[Path, bytes] = {}
+
+        # staging files of the uploads that were not committed yet, named by upload ID
+        self.uploads_dir = storage_dir / ".uploads"
+        # uploads that were not committed yet, by upload ID
+        self._uploads: dict[str, _Staging] = {}
+
+        # contents of the stored files by hash, to create files with known contents without uploading them
+        self.content = ContentStore(storage_dir / ".content")
+        self._index_digests()
+
+        # files are hashed and patched in a worker thread (see _run_blocking), the messages delivered meanwhile are
+        # held back
+        self._blocking: asyncio.Future | None = None
+        self._held: deque[Message] = deque()
+        self.ordering.deliver_callback = self._deliver
+
+    def _index_digests(self):
+        """
+        Find the hashes of the stored files that share a content with the content store, e.g. after a restart, so the
+        content is released when the files are replaced or deleted
+        """
+        linked = self.content.linked()
+        if not linked:
+            return
+        for directory, directories, files in os.walk(self.files):
+            if Path(directory) == self.files:
+                directories[:] = [name for name in directories
+                                  if self.files / name not in (self.uploads_dir, self.content.directory)]
+            for name in files:
+                path = (Path(directory) / name).absolute()
+                stat = path.lstat()
+                digest = linked.get((stat.st_dev, stat.st_ino))
+                if digest is not None:
+                    self._digests[path] = digest
+
+    def _deliver(self, message: Message):
+        if self._blocking is not None:
+            self._held.append(message)
+            return
+        self.route(message)
+
+    def _run_blocking(self, callback: Callable[[asyncio.Future], None], function: Callable, *args):
+        """
+        Run a function that reads or writes whole files in a worker thread instead of the event loop, and pass its
+        future to a callback in the event loop.
+        Messages that are delivered in the meantime are only handled afterwards, so all servers still handle the
+        requests in the same order.
+        :param callback:
+        :param function:
+        :param args: arguments of the function
+        :return:
+        """
+        self._blocking = self.comm.loop.run_in_executor(None, function, *args)
+        self._blocking.add_done_callback(lambda future: self._continue(callback, future))
+
+    def _continue(self, callback: Callable[[asyncio.Future], None], future: asyncio.Future):
+        self._blocking = None
+        callback(future)
+        # a held message may have to wait for a worker thread again
+        while self._held and self._blocking is None:
+            self.route(self._held.popleft())
+
     def route(self, message: Message):
         match message.topic:
             case Topic.FILE:
@@ -157,6 +311,12 @@ class FileServiceServer(ActiveReplServer):
                         return self.handle_message_file_modified(message)
                     case Command.MOVED:
                         return self.handle_message_file_moved(message)
+                    case Command.UPLOAD_START:
+                        return self.handle_message_file_upload_start(message)
+                    case Command.UPLOAD_CHUNK:
+                        return self.handle_message_file_upload_chunk(message)
+                    case Command.UPLOAD_COMMIT:
+                        return self.handle_message_file_upload_commit(message)
         super().route(message)
 
     def _local_path(self, path: str) -> Path:
@@ -165,8 +325,48 @@ class FileServiceServer(ActiveReplServer):
         real = (self.files / path).absolute()
         if commonpath([str(self.files), real]) != str(self.files):
             raise PermissionError("Bad path")
+        if commonpath([str(self.uploads_dir), real]) == str(self.uploads_dir) or \
+                commonpath([str(self.content.directory), real]) == str(self.content.directory):
+            raise PermissionError("Bad path")
         return real
 
+    @staticmethod
+    def _content(params: dict):
+        """
+        :param params: params of a message with file content
+        :return: the uncompressed content
+        """
+        content = params['content']
+        if content is not None and 'encoding' in params:
+            content = decompress(params['encoding'], content, params['length'])
+        return content
+
+    def _write_content(self, path: Path, content) -> None:
+        """
+        Replace the content of a file. It is written to a new file, so other files sharing the old one through the
+        content store are not changed
+        """
+        temporary = path.with_name(f".{path.name}.{secrets.token_hex(4)}")
+        with open(temporary, 'xb') as file:
+            try:
+                file.write(content)
+            except BaseException:
+                temporary.unlink()
+                raise
+        if path.exists():
+            shutil.copymode(path, temporary)
+        os.replace(temporary, path)
+
+    def _stored(self, path: Path, digest: bytes) -> None:
+        """
+        Record the content of a file that was written
+        """
+        previous = self._digests.get(path)
+        self._digests[path] = digest
+        if previous is not None and previous != digest:
+            self.content.release(previous)
+        self.content.add(path, digest)
+
     def _enforce_authorization(self, message: Message, min_required_auth: AccessType = AccessType.AUTHORIZED) -> bool:
         client = tuple(message.meta["sendreceive"]["origin"])
 
@@ -211,12 +411,15 @@ class FileServiceServer(ActiveReplServer):
             src_path.mkdir()
             logging.info(f"Directory created: {message.params['src_path']}")
         else:
-            src_path.touch()
-
-            content = message.params['content']
+            try:
+                content = self._content(message.params)
+            except ValueError as e:
+                return self._reject_content(message, e)
             if content is not None:
-                with open(src_path, 'wb') as file:
-                    file.write(content)
+                self._write_content(src_path, content)
+                self._stored(src_path, strong_hash(content))
+            else:
+                src_path.touch()
 
             logging.info(f"File created: {message.params['src_path']} (length: {len(content)})")
 
@@ -230,28 +433,250 @@ class FileServiceServer(ActiveReplServer):
 
         if is_directory:
             logging.info(f"Directory modified: {message.params['src_path']}")
+        elif 'delta' in message.params:
+            return self._apply_delta(message, src_path)
         else:
-            content = message.params['content']
+            try:
+                content = self._content(message.params)
+            except ValueError as e:
+                return self._reject_content(message, e)
 
             if content is not None:
-                with open(src_path, 'wb') as file:
-                    file.write(content)
+                self._write_content(src_path, content)
+                self._stored(src_path, strong_hash(content))
 
             logging.info(f"File modified: {message.params['src_path']} (length of new content: {len(content)})")
 
         self.comm.acknowledge(message)
 
+    def _reject_content(self, message: Message, error: ValueError):
+        """
+        Let the client know that the content of a file could not be decoded, e.g. because it was compressed with a codec
+        this server does not support, so it sends the file again uncompressed
+        """
+        logging.warning(f"Rejecting the content of {message.params['src_path']}: {error}")
+        reply = Message(topic=Topic.CLIENT, command=Command.CONTENT_REJECTED,
+                        params=dict(src_path=message.params['src_path']))
+        self.comm.acknowledge_with_message(reply, message)
+
+    def _apply_delta(self, message: Message, src_path: Path):
+        """
+        Rebuild a file from the stored version and the changed blocks, then acknowledge the request.
+        The delta is rejected if the stored version is not the one it was computed for, the changed blocks can't be
+        decompressed, or it does not rebuild the new version. The file is not changed then.
+        The file is hashed and patched in a worker thread.
+        """
+        if not src_path.is_file():
+            return self._reject_delta(message)
+        digest = self._digests.get(src_path)
+        if digest is None:
+            return self._run_blocking(lambda future: self._patch(message, src_path, future.result()),
+                                      file_digest, src_path)
+        self._patch(message, src_path, digest)
+
+    def _patch(self, message: Message, src_path: Path, digest: bytes):
+        self._digests[src_path] = digest
+        if digest != message.params['delta']['base']:
+            return self._reject_delta(message)
+
+        # the old content is only kept if other files share it, otherwise the file may be patched in place
+        in_place = self.content.detach(src_path, digest)
+        self._run_blocking(lambda future: self._patched(message, src_path, digest, future),
+                           self._rebuild, src_path, message.params['delta'], in_place)
+
+    @staticmethod
+    def _rebuild(src_path: Path, delta: dict, in_place: bool):
+        """
+        Runs in a worker thread
+        :raises ValueError: if the changed blocks can't be decompressed or don't rebuild the new version
+        """
+        ops = delta['ops']
+        if 'encoding' in delta:
+            lengths = iter(delta['lengths'])
+            ops = [op if isinstance(op, list) else decompress(delta['encoding'], op, next(lengths)) for op in ops]
+        patch(src_path, delta['block_size'], ops, delta['length'], delta['digest'], allow_in_place=in_place)
+
+    def _patched(self, message: Message, src_path: Path, digest: bytes, future: asyncio.Future):
+        delta = message.params['delta']
+        try:
+            future.result()
+        except ValueError as e:
+            logging.warning(f"Could not apply delta to {src_path}: {e}")
+            self.content.add(src_path, digest)
+            return self._reject_delta(message)
+        self._stored(src_path, delta['digest'])
+
+        literal = sum(len(op) for op in delta['ops'] if not isinstance(op, list))
+        logging.info(f"File modified: {message.params['src_path']} (length of new content: {delta['length']}, "
+                     f"{literal} bytes of it sent)")
+        self.comm.acknowledge(message)
+
+    def _reject_delta(self, message: Message):
+        """
+        Let the client know that the delta could not be applied, so it sends the whole file
+        """
+        logging.warning(f"Rejecting the delta for {message.params['src_path']}")
+        reply = Message(topic=Topic.CLIENT, command=Command.DELTA_REJECTED,
+                        params=dict(src_path=message.params['src_path']))
+        self.comm.acknowledge_with_message(reply, message)
+
+    def _move_digests(self, src_path: Path, dest_path: Path | None):
+        """
+        Keep the stored hashes in line with moved or deleted (dest_path None) files and directories
+        """
+        released = []
+        if dest_path is not None and dest_path in self._digests:
+            # a moved file replaces the file at its new path
+            released.append(self._digests.pop(dest_path))
+        for path in [path for path in self._digests if path == src_path or src_path in path.parents]:
+            digest = self._digests.pop(path)
+            if dest_path is not None:
+                self._digests[dest_path / path.relative_to(src_path)] = digest
+            else:
+                released.append(digest)
+        for digest in released:
+            self.content.release(digest)
+
     def handle_message_file_moved(self, message: Message):
         if not self._enforce_authorization(message): return
 
         src_path = self._local_path(message.params['src_path'])
         dest_path = self._local_path(message.params['dest_path'])
         src_path.rename(dest_path)
+        self._move_digests(src_path, dest_path)
 
         logging.info(f"File moved: {message.params['src_path']} -> {message.params['dest_path']}")
 
         self.comm.acknowledge(message)
 
+    def _staging_path(self, upload: str) -> Path:
+        """Maps an upload ID to the file its chunks are written to
+        """
+        if len(upload) != 32 or not all(c in "0123456789abcdef" for c in upload):
+            raise PermissionError("Bad upload ID")
+        return self.uploads_dir / upload
+
+    def handle_message_file_upload_start(self, message: Message):
+        if not self._enforce_authorization(message): return
+
+        src_path = self._local_path(message.params['src_path'])
+        upload = message.params['upload']
+        staging_path = self._staging_path(upload)
+
+        # a new upload of a file replaces the unfinished previous one
+        for previous in [previous for previous, staging in self._uploads.items()
+                         if staging.src_path == src_path and previous != upload]:
+            del self._uploads[previous]
+            self._staging_path(previous).unlink(missing_ok=True)
+
+        # the servers collect the contents they keep independently, so each one reports whether it has the content and
+        # the client sends the chunks to the ones that do not
+        digest = message.params['digest']
+        if self.content.materialize(digest, src_path):
+            self._stored(src_path, digest)
+            if self._uploads.pop(upload, None) is not None:
+                staging_path.unlink(missing_ok=True)
+
+            action = "created" if message.params['command'] == Command.CREATED.value else "modified"
+            logging.info(f"File {action}: {message.params['src_path']} (length: {message.params['length']}, "
+                         f"content was stored already)")
+            reply = Message(topic=Topic.CLIENT, command=Command.UPLOAD_STATUS,
+                            params=dict(upload=upload, offset=message.params['length'], complete=True))
+            return self.comm.acknowledge_with_message(reply, message)
+
+        staging = self._uploads.get(upload)
+        if staging is None:
+            # which chunks a staging file left over from before a restart contains is unknown
+            staging = self._uploads[upload] = _Staging(src_path)
+            staging_path.unlink(missing_ok=True)
+        self.uploads_dir.mkdir(exist_ok=True)
+        offset = staging.received
+
+        if offset:
+            logging.info(f"Resuming upload of {message.params['src_path']} at {offset} of "
+                         f"{message.params['length']} bytes")
+        else:
+            logging.info(f"Starting upload of {message.params['src_path']} ({message.params['length']} bytes)")
+
+        reply = Message(topic=Topic.CLIENT, command=Command.UPLOAD_STATUS,
+                        params=dict(upload=upload, offset=offset, complete=False))
+        self.comm.acknowledge_with_message(reply, message)
+
+    def handle_message_file_upload_chunk(self, message: Message):
+        if not self._enforce_authorization(message): return
+
+        upload = message.params['upload']
+        staging = self._uploads.get(upload)
+        if staging is None:
+            logging.warning(f"Dropping chunk of unknown upload {upload}")
+            return self.comm.acknowledge(message)
+
+        # chunks sent without waiting for each other may arrive in any order
+        offset = message.params['offset']
+        data = message.params['data']
+        if 'encoding' in message.params:
+            try:
+                data = decompress(message.params['encoding'], data, message.params['length'])
+            except ValueError as e:
+                logging.warning(f"Dropping chunk of upload {upload}: {e}")
+                staging.undecodable = True
+                return self.comm.acknowledge(message)
+        fd = os.open(self._staging_path(upload), os.O_WRONLY | os.O_CREAT, 0o666)
+        try:
+            os.pwrite(fd, data, offset)
+        finally:
+            os.close(fd)
+        staging.add(offset, offset + len(data))
+
+        self.comm.acknowledge(message)
+
+    def handle_message_file_upload_commit(self, message: Message):
+        if not self._enforce_authorization(message): return
+
+        src_path = self._local_path(message.params['src_path'])
+        upload = message.params['upload']
+        staging = self._staging_path(upload)
+        length = message.params['length']
+
+        received = self._uploads.pop(upload, None)
+        if received is None and self._digests.get(src_path) == message.params['digest']:
+            # this server had the content when the upload started, other servers did not
+            logging.debug(f"Upload of {message.params['src_path']} was committed, the content was stored already")
+            return self.comm.acknowledge(message)
+        if received is not None and received.undecodable:
+            staging.unlink(missing_ok=True)
+            return self._reject_content(message, ValueError("Chunks could not be decompressed"))
+        if received is None or received.received != length:
+            return self._reject_upload(message)
+        # the staging file is hashed in a worker thread
+        self._run_blocking(lambda future: self._commit_upload(message, src_path, staging, future.result()),
+                           file_digest, staging)
+
+    def _commit_upload(self, message: Message, src_path: Path, staging: Path, digest: bytes):
+        if digest != message.params['digest']:
+            return self._reject_upload(message)
+
+        if src_path.exists():
+            shutil.copymode(src_path, staging)
+        os.replace(staging, src_path)
+        self._stored(src_path, message.params['digest'])
+
+        action = "created" if message.params['command'] == Command.CREATED.value else "modified"
+        logging.info(f"File {action}: {message.params['src_path']} (length: {message.params['length']}, uploaded in "
+                     f"chunks)")
+
+        self.comm.acknowledge(message)
+
+    def _reject_upload(self, message: Message):
+        """
+        Let the client know that the chunks of an upload don't add up to the file, so it uploads the file again
+        """
+        logging.warning(f"Upload of {message.params['src_path']} is incomplete or corrupted, discarding it")
+        self._staging_path(message.params['upload']).unlink(missing_ok=True)
+        reply = Message(topic=Topic.CLIENT, command=Command.UPLOAD_REJECTED,
+                        params=dict(upload=message.params['upload'], src_path=message.params['src_path']))
+        self.comm.acknowledge_with_message(reply, message)
+
     def handle_message_file_deleted(self, message: Message):
         if not self._enforce_authorization(message): return
 
@@ -261,6 +686,7 @@ class FileServiceServer(ActiveReplServer):
             src_path.rmdir()
         else:
             src_path.unlink()
+        self._move_digests(src_path, None)
 
         logging.info(f"{'Directory' if is_directory else 'File'} deleted: {message.params['src_path']}")
 
@@ -272,7 +698,6 @@ class FileServiceBackupServer(FileServiceServer):
         super().__init__(own_address, storage_dir)
 
         self.state = ServerState.STARTED
-        self.comm.deliver_callback = self.route
 
     def connect(self, leader: Address):
         if self.state != ServerState.STARTED:
@@ -298,7 +723,8 @@ class FileServiceBackupServer(FileServiceServer):
             topic=Topic.CLIENT,
             command=Command.ADD_SERVER,
             params=dict(
-                server=self.address
+                server=self.address,
+                codecs=sorted(self.codecs)
             )
         )
 
@@ -329,9 +755,11 @@ class FileServiceBackupServer(FileServiceServer):
 
         self.servers = [tuple(server) for server in message.params['servers']]
         self.clients = {tuple(addr): AccessType(access_type) for addr, access_type in message.params['clients']}
+        self.codecs &= set(message.params['codecs'])
 
         logging.info(
             f"Initialized with the following connections:\n\tServers: {self.servers}\n\tClients: {self.clients}")
+        self.update_group()
 
         self.state = ServerState.JOINING
         self.introduce()
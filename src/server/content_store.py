@@ -0,0 +1,133 @@
+import logging
+import os
+from collections import OrderedDict
+from pathlib import Path
+
+
+class ContentStore:
+    """
+    File contents by hash (as computed by common.delta.file_digest), so a file whose content the server already has
+    (a copy, a file that was deleted and created again, a reverted file) can be created without transferring it.
+
+    Every content is a hard link to a stored file with that content, so it takes no extra space as long as the file
+    exists. Once no stored file has a content anymore, it is kept as an orphan until the orphans exceed
+    max_orphaned_bytes, the oldest are removed first. Files linked to the store must not be written in place, they
+    have to be replaced (or detached first).
+    """
+
+    def __init__(self, directory: Path, max_orphaned_bytes: int = 1024 * 1024 * 1024):
+        self.directory = directory
+        self.directory.mkdir(exist_ok=True)
+        self.max_orphaned_bytes = max_orphaned_bytes
+
+        # contents that no stored file has anymore, oldest first: hash (hex) -> size
+        self._orphans: OrderedDict[str, int] = OrderedDict()
+        self._orphaned_bytes = 0
+
+        entries = [(entry.name, entry.stat()) for entry in os.scandir(self.directory)]
+        for name, stat in sorted(entries, key=lambda entry: entry[1].st_ctime):
+            if stat.st_nlink == 1:
+                self._add_orphan(name, stat.st_size)
+        self._collect()
+
+    def _path(self, digest: bytes) -> Path:
+        return self.directory / digest.hex()
+
+    def linked(self) -> dict[tuple[int, int], bytes]:
+        """
+        :return: hashes of the contents stored files have, by device and inode of the files
+        """
+        result = {}
+        for entry in os.scandir(self.directory):
+            try:
+                digest = bytes.fromhex(entry.name)
+            except ValueError:
+                # an interrupted add()
+                continue
+            stat = entry.stat()
+            if stat.st_nlink > 1:
+                result[(stat.st_dev, stat.st_ino)] = digest
+        return result
+
+    def add(self, path: Path, digest: bytes):
+        """
+        Keep the content of a stored file
+        :param path:
+        :param digest: hash of the content
+        :return:
+        """
+        content_path = self._path(digest)
+        if content_path.exists() and content_path.samefile(path):
+            return
+
+        temporary = content_path.with_suffix(".new")
+        try:
+            os.link(path, temporary)
+            # a content that is kept already is linked to the new file instead, so an orphan is released
+            os.replace(temporary, content_path)
+        except OSError as e:
+            logging.warning(f"Could not add {path} to the content store: {e}")
+            return
+        self._remove_orphan(digest.hex())
+
+    def materialize(self, digest: bytes, path: Path) -> bool:
+        """
+        Create or replace a file with a content from the store
+        :param digest:
+        :param path:
+        :return: False if the content is not in the store
+        """
+        content_path = self._path(digest)
+        if not content_path.is_file():
+            return False
+        self._remove_orphan(digest.hex())
+        if path.exists() and path.samefile(content_path):
+            return True
+
+        temporary = path.with_name(f".{path.name}.{digest.hex()[:8]}")
+        os.link(content_path, temporary)
+        os.replace(temporary, path)
+        return True
+
+    def detach(self, path: Path, digest: bytes) -> bool:
+        """
+        Stop keeping the content of a file that is about to be written in place
+        :param path:
+        :param digest: hash of the current content
+        :return: whether the file can be written in place, False if other stored files share it
+        """
+        links = path.stat().st_nlink
+        content_path = self._path(digest)
+        if links == 2 and content_path.exists() and content_path.samefile(path):
+            content_path.unlink()
+            return True
+        return links == 1
+
+    def release(self, digest: bytes):
+        """
+        A stored file with a content was deleted or replaced
+        :param digest:
+        :return:
+        """
+        try:
+            stat = self._path(digest).stat()
+        except FileNotFoundError:
+            return
+        if stat.st_nlink == 1 and digest.hex() not in self._orphans:
+            self._add_orphan(digest.hex(), stat.st_size)
+            self._collect()
+
+    def _add_orphan(self, name: str, size: int):
+        self._orphans[name] = size
+        self._orphaned_bytes += size
+
+    def _remove_orphan(self, name: str):
+        size = self._orphans.pop(name, None)
+        if size is not None:
+            self._orphaned_bytes -= size
+
+    def _collect(self):
+        while self._orphaned_bytes > self.max_orphaned_bytes:
+            name, size = self._orphans.popitem(last=False)
+            self._orphaned_bytes -= size
+            (self.directory / name).unlink(missing_ok=True)
@@ -0,0 +1,7 @@
+r"""
+Unit tests.
+
+Run from the src directory:
+
+    python -m unittest
+"""
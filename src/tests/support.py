@@ -0,0 +1,44 @@
+r"""
+Setup shared by the unit tests.
+"""
+import asyncio
+import tempfile
+import unittest
+from pathlib import Path
+
+from common.communication.sendreceive import SendReceive
+from common.communication.transport import TcpTransport
+from common.types import Address
+
+
+class TestCase(unittest.TestCase):
+    """
+    Creates resources that are released again when the test is done
+    """
+
+    def temporary_directory(self) -> Path:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        return Path(directory.name)
+
+    def event_loop(self) -> asyncio.AbstractEventLoop:
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        return loop
+
+    def listener(self) -> Address:
+        """
+        :return: address of a peer that accepts connections but never reads from them
+        """
+        peer = TcpTransport().listen(("127.0.0.1", 0))
+        self.addCleanup(peer.close)
+        return peer.getsockname()
+
+    def close_on_cleanup(self, node: SendReceive) -> None:
+        """
+        Close the event loop and the server socket of a node when the test is done
+        :param node:
+        :return:
+        """
+        self.addCleanup(node.loop.close)
+        self.addCleanup(node.server_socket.close)
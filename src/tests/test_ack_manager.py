@@ -0,0 +1,54 @@
+import unittest
+
+from common.communication.ack_manager import AckManager
+from common.message import Message, Topic, Command
+from tests import support
+
+
+class LateReplyTest(support.TestCase):
+
+    def setUp(self):
+        self.peers = [self.listener() for _ in range(2)]
+
+        self.delivered = []
+        self.late = []
+        self.acked = []
+        self.manager = AckManager(self.delivered.append, ("127.0.0.1", 0))
+        self.close_on_cleanup(self.manager.r_broadcaster.sender)
+        self.manager.late_reply_callback = self.late.append
+        self.manager.ack_callback = self.acked.append
+
+    def _reply(self, origin, command: Command, message_id: int) -> Message:
+        return Message(Topic.CLIENT, command, meta=dict(
+            sendreceive=dict(origin=origin),
+            ack_manager=dict(for_message_id=message_id)
+        ))
+
+    def test_reply_after_completion_is_passed_on(self):
+        message_id = self.manager.r_broadcast(set(self.peers), Message(Topic.FILE, Command.MODIFIED), expect_ack=True)
+        first, second = self.peers
+
+        self.manager.deliver(self._reply(first, Command.ACK, message_id))
+        self.assertEqual(self.acked, [message_id])
+
+        rejected = self._reply(second, Command.DELTA_REJECTED, message_id)
+        self.manager.deliver(rejected)
+        self.assertEqual(self.late, [rejected])
+        self.assertEqual(self.delivered, [])
+
+        # a retransmitted reply is only passed on once
+        self.manager.deliver(self._reply(second, Command.DELTA_REJECTED, message_id))
+        self.assertEqual(self.late, [rejected])
+
+    def test_give_up(self):
+        first, second = self.peers
+        only_first = self.manager.r_broadcast({first}, Message(Topic.FILE, Command.MODIFIED), expect_ack=True)
+        both = self.manager.r_broadcast(set(self.peers), Message(Topic.FILE, Command.MODIFIED), expect_ack=True)
+
+        self.manager.give_up(first)
+        self.assertEqual(self.acked, [only_first])
+        self.assertEqual(list(self.manager.awaiting_ack), [both])
+
+
+if __name__ == "__main__":
+    unittest.main()
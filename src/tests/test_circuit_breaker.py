@@ -0,0 +1,69 @@
+import time
+import unittest
+
+from common.communication.circuit_breaker import CircuitBreaker, CircuitOpenError
+from common.communication.connection_pool import ConnectionPool
+from common.communication.transport import TcpTransport
+
+PEER = ("localhost", 50001)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker(failure_threshold=3, cooldown=60)
+        for _ in range(2):
+            breaker.before_send(PEER)
+            breaker.failure(PEER)
+        self.assertFalse(breaker.is_open(PEER))
+        breaker.failure(PEER)
+        self.assertTrue(breaker.is_open(PEER))
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_send(PEER)
+
+    def test_success_resets_the_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2, cooldown=60)
+        breaker.failure(PEER)
+        breaker.success(PEER)
+        breaker.failure(PEER)
+        self.assertFalse(breaker.is_open(PEER))
+
+    def test_single_probe_after_the_cooldown(self):
+        breaker = CircuitBreaker(failure_threshold=1, cooldown=0.01)
+        breaker.failure(PEER)
+        time.sleep(0.02)
+        self.assertFalse(breaker.is_open(PEER))
+        breaker.before_send(PEER)
+        # only one send at a time probes the peer
+        self.assertTrue(breaker.is_open(PEER))
+        breaker.failure(PEER)
+        self.assertTrue(breaker.is_open(PEER))
+        time.sleep(0.02)
+        breaker.before_send(PEER)
+        breaker.success(PEER)
+        self.assertFalse(breaker.is_open(PEER))
+
+
+class QueueWithOpenCircuitTest(unittest.TestCase):
+
+    def test_sends_to_an_open_circuit_fail_right_away(self):
+        # nobody listens on the port anymore, connecting fails
+        listener = TcpTransport().listen(("127.0.0.1", 0))
+        address = listener.getsockname()
+        listener.close()
+
+        pool = ConnectionPool()
+        pool.circuit_breaker.cooldown = 60
+        for _ in range(pool.circuit_breaker.failure_threshold):
+            pool.queue(address, b"data")
+        deadline = time.monotonic() + 5
+        while pool.is_available(address) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertFalse(pool.is_available(address))
+        with self.assertRaises(CircuitOpenError):
+            pool.queue(address, b"data")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from client import FileServiceClient, FolderEventHandler
+from common.delta import strong_hash
+from common.message import Message, Topic, Command
+from tests import support
+
+SERVERS = [("127.0.0.1", 53000), ("127.0.0.1", 53001)]
+CONTENT = b"0123456789" * 2
+
+
+class FileServiceClientTest(support.TestCase):
+
+    def setUp(self):
+        self.path = self.temporary_directory() / "file"
+        self.path.write_bytes(CONTENT)
+
+        self.client = FileServiceClient(("127.0.0.1", 0))
+        self.close_on_cleanup(self.client.comm.r_broadcaster.sender)
+        self.client.servers = list(SERVERS)
+        self.client.chunk_size = 4
+        # nothing is sent, the tests look at the queue
+        self.client.comm.window = 0
+
+        self.client.upload(Command.CREATED, "watched/file", str(self.path), len(CONTENT), strong_hash(CONTENT))
+        self.upload_id = self.client.outgoing_message_queue.pop().params["upload"]
+
+    def _status(self, server, offset: int, complete: bool = False) -> Message:
+        return Message(Topic.CLIENT, Command.UPLOAD_STATUS,
+                       params=dict(upload=self.upload_id, offset=offset, complete=complete),
+                       meta=dict(sendreceive=dict(origin=server)))
+
+    def _queued(self) -> list[tuple[Command, int | None, set | None]]:
+        return [(message.command, message.params.get("offset"), self.client._recipients.get(message))
+                for message in self.client.outgoing_message_queue]
+
+    def test_first_reply_sets_the_offset_for_all_servers(self):
+        self.client.route(self._status(SERVERS[0], 8))
+        self.assertEqual(self._queued(), [
+            (Command.UPLOAD_CHUNK, 8, None),
+            (Command.UPLOAD_CHUNK, 12, None),
+            (Command.UPLOAD_CHUNK, 16, None),
+            (Command.UPLOAD_COMMIT, None, None),
+        ])
+
+    def test_server_with_a_lower_offset_is_sent_the_missing_chunks(self):
+        self.client.route(self._status(SERVERS[0], 8))
+        self.client._handle_late_reply(self._status(SERVERS[1], 0))
+        self.assertEqual(self._queued()[:3], [
+            (Command.UPLOAD_CHUNK, 0, {SERVERS[1]}),
+            (Command.UPLOAD_CHUNK, 4, {SERVERS[1]}),
+            (Command.UPLOAD_CHUNK, 8, None),
+        ])
+
+    def test_server_with_a_higher_offset_is_sent_nothing_extra(self):
+        self.client.route(self._status(SERVERS[0], 8))
+        self.client._handle_late_reply(self._status(SERVERS[1], 12))
+        self.assertEqual(len(self._queued()), 4)
+
+    def test_server_without_the_content_is_sent_the_whole_upload(self):
+        self.client.route(self._status(SERVERS[0], len(CONTENT), complete=True))
+        self.assertEqual(self._queued(), [])
+
+        self.client._handle_late_reply(self._status(SERVERS[1], 12))
+        self.assertEqual(self._queued(), [
+            (Command.UPLOAD_CHUNK, 12, {SERVERS[1]}),
+            (Command.UPLOAD_CHUNK, 16, {SERVERS[1]}),
+            (Command.UPLOAD_COMMIT, None, {SERVERS[1]}),
+        ])
+
+        chunk = self.client.outgoing_message_queue[0]
+        self.client._prepare(chunk)
+        self.assertEqual(bytes(chunk.params["data"]), CONTENT[12:16])
+
+    def test_server_with_the_content_is_left_out(self):
+        self.client.route(self._status(SERVERS[0], 0))
+        self.client._handle_late_reply(self._status(SERVERS[1], len(CONTENT), complete=True))
+        self.assertEqual([recipients for _, _, recipients in self._queued()], [{SERVERS[0]}] * 6)
+
+    def test_codecs_of_a_new_server(self):
+        self.client.codecs = {"zlib", "zstd"}
+        self.client.route(Message(Topic.CLIENT, Command.ADD_SERVER,
+                                  params=dict(server=("127.0.0.1", 53002), codecs=["lzma", "zlib"])))
+        self.assertEqual(self.client.codecs, {"zlib"})
+
+
+class FolderEventHandlerTest(support.TestCase):
+
+    def setUp(self):
+        self.folder = self.temporary_directory() / "watched"
+        self.folder.mkdir()
+
+        self.loop = self.event_loop()
+        self.sent = []
+        # threads the contents were compressed in
+        self.threads = []
+        self.handler = FolderEventHandler(self.folder, lambda command, params: self.sent.append((command, params)),
+                                          self.loop, self._compress)
+        self.addCleanup(self.handler._executor.shutdown)
+
+    def _compress(self, params: dict) -> dict:
+        self.threads.append(threading.current_thread())
+        return params
+
+    def _wait_for(self, count: int):
+        deadline = time.monotonic() + 5
+        while len(self.sent) < count and time.monotonic() < deadline:
+            self.loop.run_until_complete(asyncio.sleep(0.01))
+
+    def test_changes_are_read_outside_the_event_loop_and_sent_in_order(self):
+        for name in ("a", "b"):
+            (self.folder / name).write_bytes(name.encode() * 100)
+        self.handler._send_change(Command.CREATED, False, str(self.folder / "a"), None)
+        self.handler._send_change(Command.MOVED, False, str(self.folder / "a"), str(self.folder / "c"))
+        self.handler._send_change(Command.CREATED, False, str(self.folder / "b"), None)
+        self._wait_for(3)
+
+        self.assertEqual([(command, params["src_path"]) for command, params in self.sent], [
+            (Command.CREATED, "watched/a"),
+            (Command.MOVED, "watched/a"),
+            (Command.CREATED, "watched/b"),
+        ])
+        self.assertEqual(self.sent[2][1]["content"], b"b" * 100)
+        self.assertEqual(set(self.handler.signatures), {str(self.folder / "c"), str(self.folder / "b")})
+        self.assertEqual(len(self.threads), 2)
+        self.assertNotIn(threading.main_thread(), self.threads)
+
+    def test_deleted_file_is_not_sent(self):
+        self.handler._send_change(Command.CREATED, False, str(self.folder / "missing"), None)
+        self.handler._send_change(Command.DELETED, False, str(self.folder / "missing"), None)
+        self._wait_for(1)
+        self.assertEqual([command for command, _ in self.sent], [Command.DELETED])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import random
+import unittest
+
+from common import compression
+
+DATA = b"compressible data " * 1000
+
+
+class CompressionTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for name, codec in compression.CODECS.items():
+            with self.subTest(name):
+                self.assertEqual(compression.decompress(name, codec.compress(DATA), len(DATA)), DATA)
+
+    def test_unsupported_encoding(self):
+        with self.assertRaises(ValueError):
+            compression.decompress("unknown", DATA, len(DATA))
+
+    def test_corrupted_data(self):
+        for name in compression.CODECS:
+            with self.subTest(name):
+                with self.assertRaises(ValueError):
+                    compression.decompress(name, b"not compressed at all", len(DATA))
+
+    def test_wrong_length(self):
+        compressed = compression.CODECS["zlib"].compress(DATA)
+        for length in (len(DATA) - 1, len(DATA) + 1):
+            with self.assertRaises(ValueError):
+                compression.decompress("zlib", compressed, length)
+
+    def test_only_supported_codecs_are_chosen(self):
+        samples = compression.samples(DATA)
+        self.assertIsNone(compression.choose_codec(samples, set()))
+        self.assertEqual(compression.choose_codec(samples, {"zlib"}).name, "zlib")
+        self.assertIsNone(compression.choose_codec(samples, {"zlib"}, preferred="lzma"))
+        self.assertIsNone(compression.choose_codec(samples, {"zlib"}, preferred="none"))
+
+    def test_incompressible_content_is_not_compressed(self):
+        random_data = random.Random(1).randbytes(20000)
+        self.assertIsNone(compression.choose_codec(compression.samples(random_data), {"zlib"}))
+
+
+if __name__ == "__main__":
+    unittest.main()
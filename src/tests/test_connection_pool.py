@@ -0,0 +1,69 @@
+import os
+import resource
+import unittest
+
+from common.communication.connection_pool import ConnectionPool, SendQueueFullError
+from common.communication.transport import TcpTransport
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = TcpTransport().listen(("127.0.0.1", 0))
+        self.address = self.listener.getsockname()
+        self.addCleanup(self.listener.close)
+        self.pool = ConnectionPool()
+        self.addCleanup(self.pool.close_all)
+
+    def _receive(self, length: int) -> bytes:
+        connection, _ = self.listener.accept()
+        connection.settimeout(5)
+        with connection:
+            data = bytearray()
+            while len(data) < length:
+                chunk = connection.recv(length - len(data))
+                self.assertTrue(chunk, "connection closed early")
+                data += chunk
+            return bytes(data)
+
+    def test_queued_data_arrives_in_order(self):
+        parts = [bytes([i % 256]) * (i * 1000) for i in range(1, 60)]
+        for i, part in enumerate(parts):
+            # blobs and segment lists are queued alike
+            self.pool.queue(self.address, part if i % 2 else [part[:10], memoryview(part)[10:]])
+        self.assertEqual(self._receive(sum(map(len, parts))), b"".join(parts))
+
+    def test_queue_is_bounded(self):
+        self.pool.max_queued_bytes = 1024
+        # the sending thread waits while the connection is in use
+        with self.pool._lock(self.address):
+            self.pool.queue(self.address, b"x" * 512)
+            self.pool.queue(self.address, b"x" * 512)
+            with self.assertRaises(SendQueueFullError):
+                self.pool.queue(self.address, b"x")
+        self.assertEqual(self._receive(1024), b"x" * 1024)
+
+    def test_reconnect_with_many_open_files(self):
+        # connections whose file descriptor is beyond the range of select()
+        needed = 1100
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < needed:
+            if hard != resource.RLIM_INFINITY and hard < needed:
+                self.skipTest(f"can't open {needed} files")
+            resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+            self.addCleanup(resource.setrlimit, resource.RLIMIT_NOFILE, (soft, hard))
+        while True:
+            fd = os.open(os.devnull, os.O_RDONLY)
+            self.addCleanup(os.close, fd)
+            if fd >= 1024:
+                break
+
+        self.pool.send(self.address, b"first")
+        self.assertEqual(self._receive(5), b"first")
+        # the first connection was closed by the peer, the pool notices and connects again
+        self.pool.send(self.address, b"second")
+        self.assertEqual(self._receive(6), b"second")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import unittest
+from pathlib import Path
+
+from common.delta import strong_hash
+from server.content_store import ContentStore
+from tests import support
+
+
+class ContentStoreTest(support.TestCase):
+
+    def setUp(self):
+        self.root = self.temporary_directory()
+        self.store = ContentStore(self.root / ".content", max_orphaned_bytes=100)
+
+    def _file(self, name: str, content: bytes) -> tuple[Path, bytes]:
+        path = self.root / name
+        path.write_bytes(content)
+        digest = strong_hash(content)
+        self.store.add(path, digest)
+        return path, digest
+
+    def test_materialize(self):
+        path, digest = self._file("a", b"content")
+        copy = self.root / "b"
+        self.assertTrue(self.store.materialize(digest, copy))
+        self.assertTrue(copy.samefile(path))
+        self.assertFalse(self.store.materialize(strong_hash(b"other"), copy))
+
+    def test_orphans_are_collected_oldest_first(self):
+        path, old = self._file("a", b"x" * 60)
+        path.unlink()
+        self.store.release(old)
+        self.assertTrue(self.store.materialize(old, self.root / "b"))
+        (self.root / "b").unlink()
+        self.store.release(old)
+
+        path, new = self._file("c", b"y" * 60)
+        path.unlink()
+        self.store.release(new)
+        self.assertFalse(self.store.materialize(old, self.root / "d"))
+        self.assertTrue(self.store.materialize(new, self.root / "d"))
+
+    def test_orphans_are_found_after_a_restart(self):
+        path, digest = self._file("a", b"x" * 60)
+        path.unlink()
+        store = ContentStore(self.root / ".content", max_orphaned_bytes=50)
+        self.assertFalse(store.materialize(digest, self.root / "b"))
+
+    def test_linked(self):
+        path, digest = self._file("a", b"content")
+        orphan, _ = self._file("b", b"other")
+        orphan.unlink()
+        stat = path.stat()
+        self.assertEqual(self.store.linked(), {(stat.st_dev, stat.st_ino): digest})
+
+    def test_detach(self):
+        path, digest = self._file("a", b"content")
+        self.assertTrue(self.store.detach(path, digest))
+        self.assertEqual(os.stat(path).st_nlink, 1)
+        self.assertFalse(self.store.materialize(digest, self.root / "b"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import random
+import unittest
+
+from common.communication.dedup import DuplicateFilter
+
+SENDER = ("localhost", 50000)
+OTHER = ("localhost", 50001)
+
+
+class DuplicateFilterTest(unittest.TestCase):
+
+    def test_duplicates_are_detected(self):
+        received = DuplicateFilter()
+        self.assertTrue(received.mark(SENDER, (1, 0)))
+        self.assertFalse(received.mark(SENDER, (1, 0)))
+        self.assertTrue(received.received(SENDER, (1, 0)))
+        self.assertFalse(received.received(SENDER, (1, 1)))
+
+    def test_senders_are_independent(self):
+        received = DuplicateFilter()
+        received.mark(SENDER, (1, 0))
+        self.assertTrue(received.mark(OTHER, (1, 0)))
+
+    def test_out_of_order_and_gaps(self):
+        received = DuplicateFilter(window=256)
+        counters = list(range(0, 200, 3))
+        random.Random(1).shuffle(counters)
+        for counter in counters:
+            self.assertTrue(received.mark(SENDER, (1, counter)), counter)
+        for counter in counters:
+            self.assertFalse(received.mark(SENDER, (1, counter)), counter)
+
+    def test_counters_behind_the_window_are_accepted_once(self):
+        received = DuplicateFilter(window=8)
+        received.mark(SENDER, (1, 0))
+        received.mark(SENDER, (1, 100))
+        self.assertFalse(received.received(SENDER, (1, 50)))
+        self.assertFalse(received.received(SENDER, (1, 99)))
+        self.assertTrue(received.mark(SENDER, (1, 50)))
+        self.assertFalse(received.mark(SENDER, (1, 50)))
+        self.assertTrue(received.mark(SENDER, (1, 99)))
+        self.assertTrue(received.received(SENDER, (1, 0)))
+
+    def test_oldest_missing_counters_are_forgotten(self):
+        received = DuplicateFilter(window=8, max_missing=10)
+        received.mark(SENDER, (1, 100))
+        self.assertTrue(received.received(SENDER, (1, 80)))
+        self.assertFalse(received.received(SENDER, (1, 83)))
+        self.assertFalse(received.received(SENDER, (1, 92)))
+        received.mark(SENDER, (1, 105))
+        self.assertTrue(received.received(SENDER, (1, 87)))
+        self.assertTrue(received.mark(SENDER, (1, 88)))
+        self.assertTrue(received.mark(SENDER, (1, 97)))
+
+    def test_mark_matches_a_set(self):
+        received = DuplicateFilter(window=4096)
+        seen = set()
+        rng = random.Random(2)
+        for _ in range(5000):
+            counter = rng.randrange(2000)
+            self.assertEqual(received.mark(SENDER, (1, counter)), counter not in seen)
+            seen.add(counter)
+
+    def test_old_incarnations_are_forgotten(self):
+        received = DuplicateFilter(max_incarnations=2)
+        received.mark(SENDER, (1, 0))
+        received.mark(SENDER, (2, 0))
+        self.assertTrue(received.mark(SENDER, (3, 0)))
+        # the first incarnation has been replaced twice, its messages are no longer delivered
+        self.assertFalse(received.mark(SENDER, (1, 1)))
+        self.assertTrue(received.received(SENDER, (1, 1)))
+        self.assertTrue(received.mark(SENDER, (2, 1)))
+
+
+if __name__ == "__main__":
+    unittest.main()
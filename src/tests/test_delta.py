@@ -0,0 +1,61 @@
+import random
+import unittest
+
+from common.delta import Signature, delta, file_digest, patch, strong_hash
+from tests import support
+
+BLOCK_SIZE = 2048
+
+
+class PatchTest(support.TestCase):
+
+    def setUp(self):
+        self.path = self.temporary_directory() / "file"
+        self.old = random.Random(1).randbytes(10 * BLOCK_SIZE + 100)
+        self.path.write_bytes(self.old)
+
+    def check(self, new: bytes, allow_in_place: bool = True):
+        ops, _ = delta(Signature.of(self.old, BLOCK_SIZE), new)
+        patch(self.path, BLOCK_SIZE, ops, len(new), strong_hash(new), allow_in_place=allow_in_place)
+        self.assertEqual(self.path.read_bytes(), new)
+        self.assertEqual(file_digest(self.path), strong_hash(new))
+
+    def test_appended(self):
+        self.check(self.old + b"appended")
+
+    def test_overwritten(self):
+        new = bytearray(self.old)
+        new[3 * BLOCK_SIZE:3 * BLOCK_SIZE + 10] = b"0123456789"
+        self.check(bytes(new))
+
+    def test_truncated(self):
+        self.check(self.old[:4 * BLOCK_SIZE + 7])
+
+    def test_shifted(self):
+        self.check(b"inserted" + self.old)
+
+    def test_not_in_place(self):
+        self.check(self.old + b"appended", allow_in_place=False)
+
+    def test_wrong_length(self):
+        ops, _ = delta(Signature.of(self.old, BLOCK_SIZE), self.old)
+        with self.assertRaises(ValueError):
+            patch(self.path, BLOCK_SIZE, ops, len(self.old) + 1)
+        self.assertEqual(self.path.read_bytes(), self.old)
+
+    def test_wrong_old_version_is_left_unchanged(self):
+        # the delta copies a block that was changed in the meantime
+        new = self.old + b"appended"
+        ops, _ = delta(Signature.of(self.old, BLOCK_SIZE), new)
+        changed = bytearray(self.old)
+        changed[0] ^= 1
+        self.path.write_bytes(changed)
+        for allow_in_place in (True, False):
+            with self.assertRaises(ValueError):
+                patch(self.path, BLOCK_SIZE, ops, len(new), strong_hash(new), allow_in_place=allow_in_place)
+            self.assertEqual(self.path.read_bytes(), changed)
+        self.assertEqual([path.name for path in self.path.parent.iterdir()], ["file"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+from common.communication.failure_detector import FailureDetector
+
+PEER = ("localhost", 50001)
+
+
+class FailureDetectorTest(unittest.TestCase):
+
+    def _regular(self, detector: FailureDetector, count: int = 20, interval: float = 1.0) -> float:
+        now = 0.0
+        for _ in range(count):
+            detector.heartbeat(PEER, now)
+            now += interval
+        return now - interval
+
+    def test_unknown_peer(self):
+        detector = FailureDetector()
+        self.assertEqual(detector.phi(PEER, 100.0), 0.0)
+        self.assertTrue(detector.is_available(PEER, 100.0))
+
+    def test_phi_grows_with_the_delay(self):
+        detector = FailureDetector()
+        last = self._regular(detector)
+        phis = [detector.phi(PEER, last + delay) for delay in (0.5, 1.5, 2.5, 3.5, 5.0)]
+        self.assertEqual(phis, sorted(phis))
+        self.assertTrue(detector.is_available(PEER, last + 1.5))
+        self.assertFalse(detector.is_available(PEER, last + 5.0))
+
+    def test_irregular_heartbeats_are_tolerated_longer(self):
+        regular = FailureDetector()
+        last_regular = self._regular(regular)
+        irregular = FailureDetector()
+        now = 0.0
+        for i in range(20):
+            irregular.heartbeat(PEER, now)
+            now += 0.2 if i % 2 else 1.8
+        last_irregular = now - (1.8 if i % 2 else 0.2)
+        self.assertLess(irregular.phi(PEER, last_irregular + 3.0), regular.phi(PEER, last_regular + 3.0))
+
+    def test_phi_is_finite_for_long_delays(self):
+        detector = FailureDetector()
+        last = self._regular(detector)
+        self.assertGreater(detector.phi(PEER, last + 1e6), detector.threshold)
+
+    def test_heartbeat_makes_peer_available_again(self):
+        detector = FailureDetector()
+        last = self._regular(detector)
+        self.assertFalse(detector.is_available(PEER, last + 10.0))
+        detector.heartbeat(PEER, last + 10.0)
+        self.assertTrue(detector.is_available(PEER, last + 10.5))
+
+    def test_removed_peer(self):
+        detector = FailureDetector()
+        last = self._regular(detector)
+        detector.remove(PEER)
+        self.assertEqual(detector.phi(PEER, last + 10.0), 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import socket
+import unittest
+
+from common.communication.framing import frame, frame_segments, FrameReader, FramingError, HEADER, MAX_FRAME_SIZE
+
+
+class FramingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sender, self.receiver = socket.socketpair()
+        self.receiver.setblocking(False)
+        self.addCleanup(self.sender.close)
+        self.addCleanup(self.receiver.close)
+
+    def test_frame_segments_matches_frame(self):
+        segments = [b"abc", memoryview(b"defg"), bytearray(b"h")]
+        self.assertEqual(b"".join(frame_segments(segments)), frame(b"abcdefgh"))
+
+    def test_frames_in_one_read(self):
+        self.sender.sendall(frame(b"first") + frame(b"") + frame(b"second"))
+        frames, closed = FrameReader().read_from(self.receiver)
+        self.assertEqual(frames, [b"first", b"", b"second"])
+        self.assertFalse(closed)
+
+    def test_frame_split_across_reads(self):
+        reader = FrameReader()
+        data = frame(b"x" * 100)
+        frames = []
+        for start, end in ((0, 3), (3, 50), (50, len(data))):
+            self.sender.sendall(data[start:end])
+            frames.extend(reader.read_from(self.receiver)[0])
+        self.assertEqual(frames, [b"x" * 100])
+
+    def test_frame_larger_than_read_buffer(self):
+        reader = FrameReader(read_size=64)
+        payload = bytes(range(256)) * 20
+        self.sender.sendall(frame(b"small") + frame(payload) + frame(b"after"))
+        frames = []
+        while len(frames) < 3:
+            frames.extend(reader.read_from(self.receiver)[0])
+        self.assertEqual(frames, [b"small", payload, b"after"])
+
+    def test_buffer_is_compacted(self):
+        reader = FrameReader(read_size=32)
+        payloads = [bytes([i]) * 10 for i in range(20)]
+        self.sender.sendall(b"".join(frame(payload) for payload in payloads))
+        frames = []
+        while len(frames) < len(payloads):
+            frames.extend(reader.read_from(self.receiver)[0])
+        self.assertEqual(frames, payloads)
+
+    def test_oversized_frame_is_rejected(self):
+        self.sender.sendall(HEADER.pack(1025))
+        with self.assertRaises(FramingError):
+            FrameReader(max_frame_size=1024).read_from(self.receiver)
+
+    def test_frames_are_limited_by_default(self):
+        self.sender.sendall(HEADER.pack(MAX_FRAME_SIZE + 1))
+        with self.assertRaises(FramingError):
+            FrameReader().read_from(self.receiver)
+
+    def test_closed_connection(self):
+        self.sender.sendall(frame(b"last"))
+        self.sender.close()
+        self.assertEqual(FrameReader().read_from(self.receiver), ([b"last"], True))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+from common import message_header
+from common.message import Message, Topic, Command
+
+ORIGIN = ("127.0.0.1", 50000)
+
+
+class MessageHeaderTest(unittest.TestCase):
+
+    def test_codes_are_unique(self):
+        self.assertEqual(len({topic.code for topic in Topic}), len(Topic))
+        self.assertEqual(len({command.code for command in Command}), len(Command))
+
+    def test_codes_are_stable(self):
+        # codes are part of the wire format, nodes of different versions must agree on them
+        self.assertEqual(Topic.BROADCAST.code, 3)
+        self.assertEqual(Command.WATCHED.code, 0)
+        self.assertEqual(Command.HEARTBEAT.code, 18)
+        self.assertEqual(Command.CONTENT_REJECTED.code, 29)
+
+    def test_commands_are_found_by_value(self):
+        self.assertIs(Command("create"), Command.CREATED)
+
+    def test_round_trip(self):
+        meta = dict(sendreceive=dict(origin=ORIGIN),
+                    r_broadcast=dict(sender=("example.org", 50001), message_id=(1, 2), to=[ORIGIN, ("::1", 50002)]))
+        message = Message(Topic.FILE, Command.UPLOAD_COMMIT, dict(src_path="a.txt"), meta)
+        decoded = message_header.decode(b"".join(message_header.encode(message)))
+        self.assertIs(decoded.topic, Topic.FILE)
+        self.assertIs(decoded.command, Command.UPLOAD_COMMIT)
+        self.assertEqual(decoded.params, dict(src_path="a.txt"))
+        self.assertEqual(decoded.meta["r_broadcast"]["sender"], ("example.org", 50001))
+        self.assertEqual(decoded.meta["r_broadcast"]["to"], [ORIGIN, ("::1", 50002)])
+
+    def test_unknown_command(self):
+        message = Message(Topic.CLIENT, Command.ACK)
+        header = bytearray(b"".join(message_header.encode(message)))
+        header[2] = 255
+        with self.assertRaises(message_header.HeaderError):
+            message_header.decode(header)
+
+    def test_long_addresses_are_rejected(self):
+        message = Message(Topic.CLIENT, Command.ACK, meta=dict(sendreceive=dict(origin=("unix:/" + "x" * 300, 0))))
+        with self.assertRaises(message_header.HeaderError):
+            message_header.encode(message)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import io
+import unittest
+
+from common.packer import pack, pack_into, pack_segments, unpack, UnexpectedEOFError, PackerError
+
+# encodings produced by the original packer, the wire format must not change
+GOLDEN = [
+    (None, "10"),
+    (True, "71"),
+    (False, "70"),
+    (0, "90"),
+    (15, "920f"),
+    (4711, "941267"),
+    (-300, "95012c"),
+    (1700000000, "986553f100"),
+    ("hello", "5568656c6c6f"),
+    ("", "50"),
+    ("x" * 20, "4114" + "78" * 20),
+    (b"\x00\x01\x02", "33000102"),
+    (1.5, "b43fc00000"),
+    ([1, "a", None], "f39201516110"),
+    ((1, 2), "f292019202"),
+    (
+        dict(topic="client", command="ack", params={}, meta=dict(
+            ack_manager=dict(for_message_id=4711),
+            r_broadcast=dict(sender=["localhost", 50000], message_id=[1700000000, 123456],
+                             to=[["localhost", 51000]]),
+        )),
+        "d455746f70696356636c69656e7457636f6d6d616e645361636b56706172616d73d0546d657461d25b61636b5f6d616e61676572"
+        "d15e666f725f6d6573736167655f69649412675b725f62726f616463617374d35673656e646572f2596c6f63616c686f737494c3"
+        "505a6d6573736167655f6964f2986553f1009601e24052746ff1f2596c6f63616c686f737494c738"
+    ),
+]
+
+
+class PackerTest(unittest.TestCase):
+
+    def test_encoding_matches_original_packer(self):
+        for value, expected in GOLDEN:
+            with self.subTest(value=value):
+                self.assertEqual(pack(value).hex(), expected)
+
+    def test_round_trip(self):
+        values = [0, 1, -1, 255, 256, -256, 65535, 65536, 2 ** 64, "ü" * 300, b"y" * 300, bytearray(b"z" * 20),
+                  memoryview(b"view"), [], {}, [[], {"a": [1, {"b": None}]}], {1: "one", "two": 2.0}]
+        for value in values:
+            with self.subTest(value=value):
+                expected = bytes(value) if isinstance(value, (bytearray, memoryview)) else value
+                self.assertEqual(unpack(pack(value)), expected)
+                self.assertEqual(unpack(io.BytesIO(pack(value))), expected)
+
+    def test_segments_reference_large_binaries(self):
+        content = b"c" * 100_000
+        value = dict(name="file", content=content, meta=dict(size=len(content)))
+        segments = pack_segments(value)
+        self.assertEqual(b"".join(segments), pack(value))
+        self.assertTrue(any(segment is content for segment in segments))
+
+    def test_pack_into(self):
+        parts = []
+        pack_into([b"abc", "d"], parts.append)
+        self.assertEqual(b"".join(parts), pack([b"abc", "d"]))
+
+    def test_zero_copy_unpack(self):
+        blob = pack(dict(content=b"data"))
+        content = unpack(blob, zero_copy=True)["content"]
+        self.assertIsInstance(content, memoryview)
+        self.assertEqual(bytes(content), b"data")
+        self.assertIsInstance(unpack(blob)["content"], bytes)
+
+    def test_truncated_data(self):
+        blob = pack(dict(key="value", number=4711))
+        for end in range(len(blob)):
+            with self.subTest(end=end), self.assertRaises(UnexpectedEOFError):
+                unpack(blob[:end])
+
+    def test_unknown_type(self):
+        with self.assertRaises(PackerError):
+            pack({1, 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+
+from common.communication.r_broadcast import RBroadcast
+from common.message import Message, Topic, Command
+from tests import support
+
+
+class BatchingTest(support.TestCase):
+
+    def setUp(self):
+        self.peer = self.listener()
+        self.broadcaster = RBroadcast(lambda message: None, ("127.0.0.1", 0))
+        self.close_on_cleanup(self.broadcaster.sender)
+        self.broadcaster.batch_window = 60
+
+    def _broadcast(self):
+        message = Message(Topic.CLIENT, Command.ACK, params=dict(data=b"x" * 1000))
+        self.broadcaster.r_broadcast({self.peer}, message)
+
+    def test_timer_is_cancelled_when_a_full_batch_is_sent(self):
+        self.broadcaster.batch_max_bytes = 2500
+        self._broadcast()
+        timer = self.broadcaster._batch_timers[frozenset({self.peer})]
+        self._broadcast()
+        self._broadcast()
+        self.assertEqual(self.broadcaster._batches, {})
+        self.assertEqual(self.broadcaster._batch_timers, {})
+        self.assertTrue(timer.cancelled())
+
+    def test_batch_waits_for_the_window(self):
+        self._broadcast()
+        self._broadcast()
+        self.assertEqual(len(self.broadcaster._batches[frozenset({self.peer})]), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
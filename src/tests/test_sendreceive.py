@@ -0,0 +1,31 @@
+import unittest
+
+from common import message_header
+from common.communication.sendreceive import SendReceive
+from common.message import Message, Topic, Command
+from tests import support
+
+PEER = ("127.0.0.1", 50001)
+
+
+class ReceiveTest(support.TestCase):
+
+    def setUp(self):
+        self.delivered = []
+        self.node = SendReceive(self.delivered.append, ("127.0.0.1", 0))
+        self.close_on_cleanup(self.node)
+
+    def test_message_from_a_peer_closes_its_circuit(self):
+        breaker = self.node.connections.circuit_breaker
+        for _ in range(breaker.failure_threshold):
+            breaker.failure(PEER)
+        self.assertTrue(breaker.is_open(PEER))
+
+        message = Message(Topic.CLIENT, Command.ACK, meta=dict(sendreceive=dict(origin=PEER)))
+        self.node.receive(b"".join(message_header.encode(message)))
+        self.assertFalse(breaker.is_open(PEER))
+        self.assertEqual(len(self.delivered), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
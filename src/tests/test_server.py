@@ -0,0 +1,96 @@
+import asyncio
+import time
+import unittest
+
+from common.delta import Signature, delta, strong_hash
+from common.message import Message, Topic, Command
+from common.users import AccessType
+from server import FileServiceServer
+from tests import support
+
+CLIENT = ("127.0.0.1", 51000)
+
+
+class FileServiceServerTest(support.TestCase):
+
+    def setUp(self):
+        self.server = FileServiceServer(("127.0.0.1", 0), self.temporary_directory())
+        self.close_on_cleanup(self.server.comm.r_broadcaster.sender)
+        self.server.clients[CLIENT] = AccessType.AUTHORIZED
+        (self.server.files / "watched").mkdir()
+
+        # replies are recorded instead of sent
+        self.replies = []
+        self.server.comm.acknowledge = lambda message: self.replies.append(Command.ACK)
+        self.server.comm.acknowledge_with_message = lambda reply, message: self.replies.append(reply.command)
+
+    def _request(self, command: Command, params: dict):
+        self.server.route(Message(Topic.FILE, command, params=params, meta=dict(sendreceive=dict(origin=CLIENT))))
+
+    def _deliver(self, command: Command, params: dict):
+        # the way TotalOrder passes on requests
+        self.server.ordering.deliver_callback(Message(Topic.FILE, command, params=params,
+                                                      meta=dict(sendreceive=dict(origin=CLIENT))))
+
+    def _wait_for(self, count: int):
+        deadline = time.monotonic() + 5
+        while len(self.replies) < count and time.monotonic() < deadline:
+            self.server.comm.loop.run_until_complete(asyncio.sleep(0.01))
+
+    def test_content_in_an_unsupported_encoding(self):
+        self._request(Command.CREATED, dict(src_path="watched/file", is_directory=False, content=b"data",
+                                            encoding="unknown", length=10))
+        self.assertEqual(self.replies, [Command.CONTENT_REJECTED])
+        self.assertFalse((self.server.files / "watched" / "file").exists())
+
+    def test_chunk_in_an_unsupported_encoding(self):
+        upload = dict(upload="0" * 32, command=Command.CREATED.value, src_path="watched/file", length=4,
+                      digest=b"\0" * 16)
+        self._request(Command.UPLOAD_START, upload)
+        self._request(Command.UPLOAD_CHUNK, dict(upload=upload["upload"], offset=0, data=b"data", encoding="unknown",
+                                                 length=4))
+        self._request(Command.UPLOAD_COMMIT, upload)
+        self.assertEqual(self.replies, [Command.UPLOAD_STATUS, Command.ACK, Command.CONTENT_REJECTED])
+
+    def test_requests_wait_for_the_upload_to_be_hashed(self):
+        content = b"content" * 1000
+        upload = dict(upload="0" * 32, command=Command.CREATED.value, src_path="watched/file", length=len(content),
+                      digest=strong_hash(content))
+        self._deliver(Command.UPLOAD_START, upload)
+        self._deliver(Command.UPLOAD_CHUNK, dict(upload=upload["upload"], offset=0, data=content))
+        self._deliver(Command.UPLOAD_COMMIT, upload)
+        self._deliver(Command.MOVED, dict(src_path="watched/file", dest_path="watched/moved", is_directory=False))
+        # the staging file is hashed in a worker thread, the move is held back until the upload is committed
+        self.assertEqual(self.replies, [Command.UPLOAD_STATUS, Command.ACK])
+
+        self._wait_for(4)
+        self.assertEqual(self.replies, [Command.UPLOAD_STATUS, Command.ACK, Command.ACK, Command.ACK])
+        self.assertEqual((self.server.files / "watched" / "moved").read_bytes(), content)
+
+    def test_requests_wait_for_the_delta_to_be_applied(self):
+        old = bytes(range(256)) * 64
+        new = old[:4096] + b"changed" + old[4096:]
+        path = self.server.files / "watched" / "file"
+        # written by somebody else, so the server has to hash it first
+        path.write_bytes(old)
+        signature = Signature.of(old)
+        ops, _ = delta(signature, new)
+        self._deliver(Command.MODIFIED, dict(src_path="watched/file", is_directory=False, delta=dict(
+            base=signature.digest, digest=strong_hash(new), block_size=signature.block_size, length=len(new), ops=ops
+        )))
+        self._deliver(Command.DELETED, dict(src_path="watched/file", is_directory=False))
+        self.assertEqual(self.replies, [])
+
+        self._wait_for(2)
+        self.assertEqual(self.replies, [Command.ACK, Command.ACK])
+        self.assertFalse(path.exists())
+
+    def test_codecs_of_a_new_server(self):
+        self.server.route(Message(Topic.REPLICATION, Command.ADD_SERVER,
+                                  params=dict(server=("127.0.0.1", 50002), codecs=["lzma", "zlib"]),
+                                  meta=dict(sendreceive=dict(origin=("127.0.0.1", 50002)))))
+        self.assertEqual(self.server.codecs, {"lzma", "zlib"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+import unittest
+from types import SimpleNamespace
+
+from common.communication.total_order import TotalOrder
+from common.message import Message, Topic, Command
+
+SERVERS = [("localhost", 50000), ("localhost", 50001), ("localhost", 50002)]
+CLIENT = ("localhost", 51000)
+
+
+class _Comm:
+    """
+    Stands in for the AckManager of one server, orders are passed on by _Group
+    """
+
+    def __init__(self, address, group: "_Group"):
+        self.address = address
+        self.group = group
+        self.r_broadcaster = SimpleNamespace(suspected=set())
+        self.loop = self
+        self.timers = []
+
+    def call_later(self, _delay, callback, *args):
+        self.timers.append((callback, args))
+
+    def r_broadcast(self, to, message):
+        self.group.in_flight.extend((recipient, message) for recipient in to)
+
+
+class _Group:
+
+    def __init__(self, servers=SERVERS):
+        self.in_flight = []
+        self.delivered = {server: [] for server in servers}
+        self.nodes = {}
+        for server in servers:
+            node = TotalOrder(self.delivered[server].append, _Comm(server, self))
+            node.set_servers(list(servers))
+            self.nodes[server] = node
+
+    def run(self):
+        """
+        Fire the timers and pass on the orders until nothing is left to do
+        """
+        while True:
+            timers = [timer for node in self.nodes.values() for timer in node.comm.timers]
+            for node in self.nodes.values():
+                node.comm.timers.clear()
+            in_flight, self.in_flight = self.in_flight, []
+            if not timers and not in_flight:
+                return
+            for callback, args in timers:
+                callback(*args)
+            for recipient, message in in_flight:
+                # failed servers don't receive anything
+                if recipient in self.nodes:
+                    self.nodes[recipient].deliver(message)
+
+
+def request(number: int, to=SERVERS, origin=CLIENT) -> Message:
+    return Message(Topic.FILE, Command.CREATED, params=dict(src_path=f"file{number}"), meta=dict(
+        sendreceive=dict(origin=origin),
+        r_broadcast=dict(sender=origin, message_id=[1, number], to=list(to)),
+        ack_manager=dict(message_id=number),
+    ))
+
+
+def paths(messages: list[Message]) -> list[str]:
+    return [message.params["src_path"] for message in messages]
+
+
+class TotalOrderTest(unittest.TestCase):
+
+    def test_same_order_on_all_servers(self):
+        group = _Group()
+        first, second, third = SERVERS
+        # every server receives the requests in a different order
+        for number in (1, 2, 3):
+            group.nodes[first].deliver(request(number))
+        for number in (3, 1, 2):
+            group.nodes[second].deliver(request(number))
+        group.run()
+        for number in (2, 3, 1):
+            group.nodes[third].deliver(request(number))
+        group.run()
+
+        expected = ["file1", "file2", "file3"]
+        for server in SERVERS:
+            self.assertEqual(paths(group.delivered[server]), expected, server)
+
+    def test_request_is_held_until_it_is_next(self):
+        group = _Group()
+        first, second, _ = SERVERS
+        group.nodes[first].deliver(request(1))
+        group.nodes[first].deliver(request(2))
+        group.nodes[second].deliver(request(2))
+        self.assertEqual(group.delivered[second], [])
+        group.run()
+        self.assertEqual(group.delivered[second], [])
+        group.nodes[second].deliver(request(1))
+        self.assertEqual(paths(group.delivered[second]), ["file1", "file2"])
+
+    def test_requests_to_a_single_server_are_not_ordered(self):
+        group = _Group()
+        second = SERVERS[1]
+        group.nodes[second].deliver(request(1, to=[second]))
+        self.assertEqual(paths(group.delivered[second]), ["file1"])
+
+    def test_messages_of_servers_are_not_ordered(self):
+        group = _Group()
+        first, second, _ = SERVERS
+        group.nodes[second].deliver(request(1, origin=first))
+        self.assertEqual(paths(group.delivered[second]), ["file1"])
+
+    def test_next_server_takes_over_as_sequencer(self):
+        group = _Group()
+        first, second, third = SERVERS
+        for server in SERVERS:
+            group.nodes[server].deliver(request(1))
+        group.run()
+
+        # the sequencer fails before it has ordered the next requests
+        for server in (second, third):
+            group.nodes[server].deliver(request(2))
+            group.nodes[server].deliver(request(3))
+        self.assertEqual(paths(group.delivered[second]), ["file1"])
+        del group.nodes[first]
+        for server in (second, third):
+            group.nodes[server].comm.r_broadcaster.suspected.add(first)
+            group.nodes[server].membership_changed()
+        group.run()
+
+        self.assertEqual(group.nodes[second].sequencer, second)
+        for server in (second, third):
+            self.assertEqual(paths(group.delivered[server]), ["file1", "file2", "file3"], server)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+
+from common.communication.framing import MAX_FRAME_SIZE
+from common.packer import pack, Unpacker, BufferFullError
+from common.packer._packer import Identifier, _pack_head
+
+VALUES = [
+    None, True, 0, -4711, 2 ** 70, "text", "", b"", b"\x00" * 20, 2.5, [], {},
+    dict(topic="file", command="modified", params=dict(src_path="a/b.txt", content=b"x" * 200_000),
+         meta=dict(ack_manager=dict(message_id=3), r_broadcast=dict(to=[["localhost", 50000]]))),
+    [[1, [2, [3, []]]], {"nested": {"deeper": [None, {}]}}],
+]
+
+
+class UnpackerTest(unittest.TestCase):
+
+    def _decode(self, data: bytes, chunk_size: int) -> list:
+        unpacker = Unpacker()
+        values = []
+        for start in range(0, len(data), chunk_size):
+            unpacker.feed(data[start:start + chunk_size])
+            values.extend(unpacker)
+        return values
+
+    def test_values_in_one_piece(self):
+        data = b"".join(pack(value) for value in VALUES)
+        self.assertEqual(self._decode(data, len(data)), VALUES)
+
+    def test_values_byte_by_byte(self):
+        # without the large file message
+        values = VALUES[:-2] + VALUES[-1:]
+        data = b"".join(pack(value) for value in values)
+        self.assertEqual(self._decode(data, 1), values)
+
+    def test_values_in_chunks(self):
+        data = b"".join(pack(value) for value in VALUES)
+        for chunk_size in (7, 1000, 65536):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self._decode(data, chunk_size), VALUES)
+
+    def test_value_is_output_once_complete(self):
+        unpacker = Unpacker()
+        data = pack(["a", "b"])
+        unpacker.feed(data[:-1])
+        self.assertEqual(list(unpacker), [])
+        unpacker.feed(data[-1:])
+        self.assertEqual(list(unpacker), [["a", "b"]])
+
+    def test_buffer_limit(self):
+        unpacker = Unpacker(max_buffer_size=100_000)
+        with self.assertRaises(BufferFullError):
+            unpacker.feed(pack(b"x" * 200_000)[:1000])
+
+    def test_buffer_is_limited_to_the_frame_size_by_default(self):
+        # only the head of the value, its length must be rejected without allocating a buffer for it
+        unpacker = Unpacker()
+        with self.assertRaises(BufferFullError):
+            unpacker.feed(_pack_head(Identifier.BINARY, MAX_FRAME_SIZE + 1))
+
+
+if __name__ == "__main__":
+    unittest.main()